@@ -55,6 +55,10 @@ def create_CF(inp, refs, clf, num_features, MAD_features_cost,
               r2i=True, datatype='Tabular', raw_text=False, causal_SCM=None,
               col_con=None, col_cat=None, predict=False):
     np.random.seed(42)
+    if not causal_SCM:
+        return create_CF_vectorized(inp, refs, clf, num_features, MAD_features_cost, r2i=r2i,
+                                    datatype=datatype, raw_text=raw_text, col_con=col_con,
+                                    col_cat=col_cat, predict=predict)
     CF = {'cfs': [], 'intervention_sets': [], 'cardinality': [],
           'original': [], 'cost': [], 'model_pred': []}
     intervention_order_ids = intervention_order(num_features)
@@ -181,6 +185,118 @@ def create_CF(inp, refs, clf, num_features, MAD_features_cost,
     return CF_df
 
 
+def intervention_mask(num_features):
+    # row f_i holds the bits of to_bitstring(f_i, num_features): a 0 at position j means
+    # feature j takes the first value of the pair, a 1 means it takes the second one
+    # (same order as itertools.product over the zipped pairs)
+    shifts = np.arange(num_features - 1, -1, -1)
+    return ((np.arange(2 ** num_features)[:, None] >> shifts) & 1).astype(bool)
+
+
+def _predict_cfs(clf, cfs, datatype='Tabular'):
+    if datatype == 'Text':
+        return clf.predict(np.array(cfs.tolist()).reshape(len(cfs), -1))
+    elif datatype == 'Dice':
+        hstacked = np.hstack(np.hstack(cfs)).reshape(len(cfs), -1)
+        return (clf.predict(hstacked) >= 0.5) * 1.
+    else:
+        return clf.predict(cfs.tolist())
+
+
+def _feature_distances(inp_values, ref_values, MAD_features_cost, col_con, col_cat, datatype='Tabular'):
+    # per (ref, feature) cost of swapping the ref value with the input value, see cost()
+    MAD_features_cost = np.array(MAD_features_cost, dtype=float)
+    MAD_features_cost = np.where(MAD_features_cost == 0, 1, MAD_features_cost)
+    distances = np.zeros(ref_values.shape, dtype=float)
+    if datatype == 'Tabular' or datatype == 'Dice':
+        if len(col_con) > 0:
+            distances[:, col_con] = np.abs(ref_values[:, col_con].astype(float) -
+                                           inp_values[None, col_con].astype(float)) / MAD_features_cost[col_con]
+        if len(col_cat) > 0:
+            distances[:, col_cat] = ref_values[:, col_cat] != inp_values[None, col_cat]
+    else:
+        for feature_i in range(ref_values.shape[1]):
+            diffs = np.abs(np.vstack(ref_values[:, feature_i]) - np.asarray(inp_values[feature_i], dtype=float))
+            distances[:, feature_i] = np.mean(diffs, axis=1) / MAD_features_cost[feature_i]
+    return distances
+
+
+def create_CF_vectorized(inp, refs, clf, num_features, MAD_features_cost,
+                         r2i=True, datatype='Tabular', raw_text=False,
+                         col_con=None, col_cat=None, predict=False, batch_size=4096, keep=None):
+    # same output as create_CF without a causal SCM, built from the chunks of iter_CF_chunks;
+    # keep (a function of a chunk returning a boolean mask) drops rows before they are concatenated.
+    # the (kept) output is entirely held in memory, only iter_CF_chunks has a memory bounded by batch_size
+    chunks = iter_CF_chunks(inp, refs, clf, num_features, MAD_features_cost, r2i=r2i, datatype=datatype,
+                            raw_text=raw_text, col_con=col_con, col_cat=col_cat, predict=predict,
+                            batch_size=batch_size)
+    if keep is not None:
+        chunks = (chunk[np.asarray(keep(chunk), dtype=bool)] for chunk in chunks)
+    chunks = list(chunks)
+    if len(chunks) == 0:
+        # no refs, same (empty) frame as create_CF
+        columns = list(inp.columns[:num_features])
+        if not raw_text:
+            columns += ['Original', 'Intervention_index'] + (['Model_pred'] if predict else []) + \
+                       ['Cost', 'Cardinality']
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def iter_CF_chunks(inp, refs, clf, num_features, MAD_features_cost,
+                   r2i=True, datatype='Tabular', raw_text=False,
+                   col_con=None, col_cat=None, predict=False, batch_size=4096):
+    # yields the rows of create_CF (without a causal SCM) as frames of at most batch_size rows, the
+    # (refs x 2^n) interventions are obtained by broadcasting the intervention mask over input and
+    # reference values, so that only one chunk of them is materialized at a time
+    n_interventions = 2 ** num_features
+    intervention_order_ids = np.array(intervention_order(num_features), dtype=object)
+    mask = intervention_mask(num_features)
+    columns = inp.columns[:num_features]
+
+    if not col_con:
+        col_con = [i for i in range(num_features)
+                   if (isinstance(inp.iloc[0, i], int) | isinstance(inp.iloc[0, i], float))]
+        col_cat = list(set(range(num_features)) - set(col_con))
+
+    inp_values = np.array(inp, dtype=object)[0][:num_features]
+    ref_values = np.array(refs, dtype=object)[:, :num_features]
+    n_refs = len(ref_values)
+    if r2i:
+        first, second = inp_values[None, :], ref_values
+    else:
+        first, second = ref_values, inp_values[None, :]
+    first = np.broadcast_to(first, (n_refs, num_features))
+    second = np.broadcast_to(second, (n_refs, num_features))
+
+    if not raw_text:
+        if r2i:
+            originals = np.array([str(ref.values[:num_features]) for _, ref in refs.iterrows()], dtype=object)
+        else:
+            originals = np.array([str(inp.values[0][:num_features])] * n_refs, dtype=object)
+        # both in r2i and i2r the cost of a cf is the distance between input and ref over the
+        # features where the cf departs from the original (i.e. mask is 0)
+        distances = _feature_distances(inp_values, ref_values, MAD_features_cost, col_con, col_cat,
+                                       datatype=datatype)
+        cardinalities = (~mask).sum(axis=1)
+
+    total = n_refs * n_interventions
+    for start in range(0, total, batch_size):
+        flat = np.arange(start, min(start + batch_size, total))
+        ref_ids = flat // n_interventions
+        interventions = flat % n_interventions
+        cfs = np.where(mask[interventions], second[ref_ids], first[ref_ids])
+        chunk = pd.DataFrame(cfs, columns=columns, index=flat)
+        if not raw_text:
+            chunk['Original'] = originals[ref_ids]
+            chunk['Intervention_index'] = intervention_order_ids[interventions]
+            if predict:
+                chunk['Model_pred'] = list(_predict_cfs(clf, cfs, datatype=datatype))
+            chunk['Cost'] = (distances[ref_ids] * ~mask[interventions]).sum(axis=1)
+            chunk['Cardinality'] = cardinalities[interventions]
+        yield chunk
+
+
 # Causal model fitting and predicting
 def fit_scm(dataset):
     np.random.seed(42)
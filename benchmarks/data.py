@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def generate_sources(num_records: int = 1000, num_attributes: int = 4, vocab_size: int = 500,
+                     tokens_per_value: int = 3, seed: int = 0):
+    '''
+    Generate a pair of synthetic data sources where the i-th "right" record is a noisy copy of the i-th "left" record.
+    :param num_records: the no. of records in each source
+    :param num_attributes: the no. of attributes (besides the id) of each record
+    :param vocab_size: the no. of distinct tokens
+    :param tokens_per_value: the no. of tokens of each attribute value
+    :param seed: the random seed
+    :return: the "left" and the "right" data sources
+    '''
+    rng = np.random.RandomState(seed)
+    vocab = np.array(['t%d' % i for i in range(vocab_size)])
+    columns = ['attr_%d' % i for i in range(num_attributes)]
+    tokens = rng.randint(0, vocab_size, size=(num_records, num_attributes, tokens_per_value))
+    lsource = pd.DataFrame({c: [' '.join(vocab[t]) for t in tokens[:, i]] for i, c in enumerate(columns)})
+
+    # replace some of the tokens of the copies
+    noise = rng.rand(num_records, num_attributes, tokens_per_value) < 0.3
+    tokens = np.where(noise, rng.randint(0, vocab_size, size=tokens.shape), tokens)
+    rsource = pd.DataFrame({c: [' '.join(vocab[t]) for t in tokens[:, i]] for i, c in enumerate(columns)})
+
+    lsource.insert(0, 'id', np.arange(num_records))
+    rsource.insert(0, 'id', np.arange(num_records))
+    return lsource, rsource
+
+
+def generate_pairs(num_records: int, num_pairs: int = 100, match_ratio: float = 0.5, seed: int = 0):
+    '''
+    Generate labelled pairs of record ids, matching pairs share the same id.
+    :param num_records: the no. of records in each source
+    :param num_pairs: the no. of pairs
+    :param match_ratio: the fraction of matching pairs
+    :param seed: the random seed
+    :return: a pd.DataFrame with ltable_id, rtable_id and label columns
+    '''
+    rng = np.random.RandomState(seed)
+    lids = rng.randint(0, num_records, size=num_pairs)
+    matches = rng.rand(num_pairs) < match_ratio
+    rids = np.where(matches, lids, (lids + rng.randint(1, num_records, size=num_pairs)) % num_records)
+    return pd.DataFrame({'ltable_id': lids, 'rtable_id': rids, 'label': matches.astype(int)})
+
+
+def write_dataset(datadir: str, num_records: int = 1000, num_attributes: int = 4, num_pairs: int = 100,
+                  seed: int = 0):
+    '''
+    Write a synthetic dataset with the same layout as the ones used by eval.py (tableA, tableB, train, valid, test).
+    '''
+    os.makedirs(datadir, exist_ok=True)
+    lsource, rsource = generate_sources(num_records, num_attributes, seed=seed)
+    lsource.to_csv(os.path.join(datadir, 'tableA.csv'), index=False)
+    rsource.to_csv(os.path.join(datadir, 'tableB.csv'), index=False)
+    for i, split in enumerate(['train', 'valid', 'test']):
+        generate_pairs(num_records, num_pairs, seed=seed + i).to_csv(os.path.join(datadir, split + '.csv'),
+                                                                     index=False)
@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.data import generate_pairs, generate_sources
+from benchmarks.stub import StubERModel
+from certa import triangles_method
+from certa.explain import CertaExplainer
+from certa.local_explain import get_original_prediction, support_predictions
+from certa.metrics.counterfactual import get_diversity, get_proximity, get_sparsity, get_validity
+from certa.metrics.saliency import get_faithfulness
+from certa.utils import merge_sources
+
+lprefix = 'ltable_'
+rprefix = 'rtable_'
+
+
+def setup(args):
+    '''
+    Build the data, the model and the intermediate results each benchmark starts from.
+    '''
+    lsource, rsource = generate_sources(args.records, args.attributes, seed=args.seed)
+    test = generate_pairs(args.records, args.pairs, seed=args.seed)
+    model = StubERModel(row_latency=args.row_latency, call_latency=args.call_latency)
+
+    def predict_fn(x, **kwargs):
+        return model.predict(x, **kwargs)
+
+    explainer = CertaExplainer(lsource, rsource, data_augmentation=args.da)
+    l_tuple = lsource.iloc[int(test['ltable_id'].iloc[0])]
+    r_tuple = rsource.iloc[int(test['rtable_id'].iloc[0])]
+    np.random.seed(args.seed)
+    pc = np.argmax(get_original_prediction(l_tuple, r_tuple, predict_fn))
+    support, gleft_df, gright_df = support_predictions(l_tuple, r_tuple, explainer.lsource, explainer.rsource,
+                                                       predict_fn, lprefix, rprefix, num_triangles=args.triangles,
+                                                       class_to_explain=pc, use_all=explainer.use_all)
+
+    def sources():
+        extended_sources = [pd.concat([explainer.lsource, gright_df]), pd.concat([explainer.rsource, gleft_df])]
+        triangles_method._renameColumnsWithPrefix(lprefix, extended_sources[0])
+        triangles_method._renameColumnsWithPrefix(rprefix, extended_sources[1])
+        return extended_sources
+
+    triangles, sources_map = triangles_method.getMixedTriangles(support, sources())
+    attributes = [lprefix + c for c in lsource.columns if c != 'id'] + [rprefix + c for c in rsource.columns if
+                                                                        c != 'id']
+
+    # explanations of a few test pairs, to measure the metrics on
+    test_df = merge_sources(test[:args.metrics_samples], lprefix, rprefix, lsource, rsource, ['label'], [])
+    saliency_rows = []
+    cf_ex = pd.DataFrame()
+    for i in range(len(test_df)):
+        row = test_df.iloc[i]
+        l_row = lsource[lsource['id'] == row[lprefix + 'id']].iloc[0]
+        r_row = rsource[rsource['id'] == row[rprefix + 'id']].iloc[0]
+        saliency_df, _, cfs, _, _ = explainer.explain(l_row, r_row, predict_fn, num_triangles=args.triangles)
+        prediction = get_original_prediction(l_row, r_row, predict_fn)
+        explanation = saliency_df.iloc[0].to_dict() if len(saliency_df) > 0 else dict()
+        saliency_rows.append({'match': int(np.argmax(prediction)), 'explanation': str(explanation)})
+        if len(cf_ex) == 0 and len(cfs) > 0:
+            cf_ex = cfs.to_frame().drop(['triangle'], axis=1)
+            cf_instance = pd.concat([l_row.add_prefix(lprefix), r_row.add_prefix(rprefix)])
+            cf_class = int(np.argmax(prediction))
+    saliency_dir = tempfile.mkdtemp()
+    pd.DataFrame(saliency_rows).to_csv(os.path.join(saliency_dir, 'certa.csv'), index=False)
+
+    benchmarks = {
+        'certa_init': lambda: CertaExplainer(lsource, rsource, data_augmentation=args.da),
+        'explain': lambda: explainer.explain(l_tuple, r_tuple, predict_fn, num_triangles=args.triangles),
+        'support_predictions': lambda: support_predictions(l_tuple, r_tuple, explainer.lsource, explainer.rsource,
+                                                           predict_fn, lprefix, rprefix,
+                                                           num_triangles=args.triangles, class_to_explain=pc,
+                                                           use_all=explainer.use_all),
+        'getMixedTriangles': lambda: triangles_method.getMixedTriangles(support, sources()),
+        'perturb_predict': lambda: triangles_method.perturb_predict(list(triangles), attributes, False, pc, False,
+                                                                    args.attributes, predict_fn, sources_map,
+                                                                    lprefix, rprefix),
+        'merge_sources': lambda: merge_sources(test, lprefix, rprefix, lsource, rsource, ['label'], []),
+        'metrics_faithfulness': lambda: get_faithfulness(['certa'], model, saliency_dir, test_df.copy()),
+    }
+    if len(cf_ex) > 0:
+        benchmarks.update({
+            'metrics_validity': lambda: get_validity(model, cf_ex, cf_class),
+            'metrics_proximity': lambda: get_proximity(cf_ex, cf_instance),
+            'metrics_sparsity': lambda: get_sparsity(cf_ex, cf_instance),
+            'metrics_diversity': lambda: get_diversity(cf_ex),
+        })
+    return benchmarks, model
+
+
+def measure(fn, model, repeats: int, seed: int):
+    '''
+    Time repeats runs of fn, then run it once more under tracemalloc to get its peak memory.
+    '''
+    times = []
+    for _ in range(repeats):
+        np.random.seed(seed)
+        model.reset()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    calls, rows = model.calls, model.rows
+
+    np.random.seed(seed)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'time': statistics.median(times), 'min_time': min(times), 'repeats': repeats,
+            'peak_memory': peak, 'predict_calls': calls, 'predict_rows': rows}
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    '''
+    Print the time and memory ratios against a baseline and return the names of the regressed benchmarks.
+    '''
+    regressions = []
+    print('%-24s %10s %10s %8s %8s' % ('benchmark', 'time', 'baseline', 'ratio', 'memory'))
+    for name, result in results.items():
+        if name not in baseline:
+            print('%-24s %10.4f %10s' % (name, result['time'], '-'))
+            continue
+        base = baseline[name]
+        ratio = result['time'] / max(base['time'], 1e-9)
+        memory_ratio = result['peak_memory'] / max(base['peak_memory'], 1)
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+        print('%-24s %10.4f %10.4f %8.2f %8.2f%s' % (name, result['time'], base['time'], ratio, memory_ratio,
+                                                    ' REGRESSION' if regressed else ''))
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Run the CERTA benchmarks on synthetic data.')
+    parser.add_argument('--records', type=int, default=1000, help='no. of records in each data source')
+    parser.add_argument('--attributes', type=int, default=4, help='no. of attributes of each record')
+    parser.add_argument('--pairs', type=int, default=100, help='no. of test pairs')
+    parser.add_argument('--triangles', type=int, default=20, help='no. of open triangles per explanation')
+    parser.add_argument('--row_latency', type=float, default=0.0, help='model latency per predicted row (s)')
+    parser.add_argument('--call_latency', type=float, default=0.0, help='model latency per predict call (s)')
+    parser.add_argument('--da', type=str, default='on_demand', help='CERTA data augmentation mode')
+    parser.add_argument('--metrics_samples', type=int, default=5, help='no. of explanations used by the metrics')
+    parser.add_argument('--repeats', type=int, default=3, help='no. of timed runs of each benchmark')
+    parser.add_argument('--seed', type=int, default=0, help='the random seed')
+    parser.add_argument('--only', type=str, nargs='+', default=None, help='the benchmarks to run')
+    parser.add_argument('--output', type=str, default='benchmarks.json', help='where to write the results')
+    parser.add_argument('--baseline', type=str, default=None, help='a results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown against the baseline reported as a regression')
+
+    args = parser.parse_args()
+
+    benchmarks, model = setup(args)
+    results = dict()
+    for name, fn in benchmarks.items():
+        if args.only is not None and name not in args.only:
+            continue
+        results[name] = measure(fn, model, args.repeats, args.seed)
+        print('%-24s %10.4fs %12d B %6d calls %8d rows' % (name, results[name]['time'], results[name]['peak_memory'],
+                                                          results[name]['predict_calls'],
+                                                          results[name]['predict_rows']))
+
+    config = {k: v for k, v in vars(args).items() if k not in ['output', 'baseline', 'only']}
+    config.update({'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__})
+    with open(args.output, 'w') as fout:
+        json.dump({'config': config, 'results': results}, fout, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        if baseline['config'] != config:
+            print('warning: the baseline was run with a different configuration')
+        if len(compare(results, baseline['results'], args.tolerance)) > 0:
+            sys.exit(1)
@@ -0,0 +1,74 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from certa.models.ermodel import ERModel
+
+
+class StubERModel(ERModel):
+    '''
+    Deterministic ER model scoring a pair of records by the average Jaccard similarity of their attribute values.
+    Each call to predict sleeps for call_latency seconds plus row_latency seconds per row, to simulate the cost of a
+    real model.
+    '''
+
+    def __init__(self, row_latency: float = 0.0, call_latency: float = 0.0, lprefix='ltable_', rprefix='rtable_'):
+        super(StubERModel, self).__init__()
+        self.name = 'stub'
+        self.row_latency = row_latency
+        self.call_latency = call_latency
+        self.lprefix = lprefix
+        self.rprefix = rprefix
+        self.calls = 0
+        self.rows = 0
+
+    def reset(self):
+        self.calls = 0
+        self.rows = 0
+
+    def scores(self, x: pd.DataFrame):
+        attributes = [c[len(self.lprefix):] for c in x.columns
+                      if c.startswith(self.lprefix) and c != self.lprefix + 'id'
+                      and self.rprefix + c[len(self.lprefix):] in x.columns]
+        if len(attributes) == 0:
+            return np.zeros(len(x))
+        total = np.zeros(len(x))
+        for a in attributes:
+            lvalues = x[self.lprefix + a].astype(str).values
+            rvalues = x[self.rprefix + a].astype(str).values
+            for i, (lv, rv) in enumerate(zip(lvalues, rvalues)):
+                ltokens = set(lv.split())
+                rtokens = set(rv.split())
+                union = len(ltokens | rtokens)
+                total[i] += len(ltokens & rtokens) / union if union > 0 else 0
+        return total / len(attributes)
+
+    def predict(self, x, mojito=False, expand_dim=False, **kwargs):
+        self.calls += 1
+        self.rows += len(x)
+        delay = self.call_latency + self.row_latency * len(x)
+        if delay > 0:
+            time.sleep(delay)
+        xc = x.copy()
+        # scale so that records sharing half of their tokens are matches
+        xc['match_score'] = np.clip(self.scores(xc) * 1.5, 0, 1)
+        xc['nomatch_score'] = 1 - xc['match_score']
+        if mojito:
+            res = np.dstack((xc['nomatch_score'], xc['match_score'])).squeeze()
+            if len(res.shape) == 1 and expand_dim:
+                res = np.expand_dims(res, axis=1).T
+            return res
+        return xc
+
+    def evaluation(self, test_set):
+        predicted = self.predict(test_set)['match_score'].values > 0.5
+        actual = test_set['label'].astype(int).values == 1
+        tp = np.sum(predicted & actual)
+        precision = tp / max(np.sum(predicted), 1)
+        recall = tp / max(np.sum(actual), 1)
+        fmeasure = 2 * precision * recall / max(precision + recall, 1e-10)
+        return precision, recall, fmeasure
+
+    def predict_proba(self, x, **kwargs):
+        return self.predict(x, mojito=True, expand_dim=True)
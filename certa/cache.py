@@ -0,0 +1,130 @@
+import hashlib
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+
+def model_fingerprint(model):
+    '''
+    Compute a fingerprint of an ER model from its weights, so that explanations cached for a model are not reused
+    once it is retrained.
+    :param model: the ERModel (or the wrapped torch / keras model)
+    :return: a hex digest
+    '''
+    h = hashlib.sha1(type(model).__name__.encode())
+    inner = getattr(model, 'model', model)
+    if hasattr(inner, 'state_dict'):
+        for name, tensor in inner.state_dict().items():
+            h.update(name.encode())
+            h.update(tensor.detach().cpu().numpy().tobytes())
+    elif hasattr(inner, 'get_weights'):
+        for weights in inner.get_weights():
+            h.update(np.asarray(weights).tobytes())
+    else:
+        try:
+            h.update(pickle.dumps(inner))
+        except Exception:
+            h.update(repr(inner).encode())
+    return h.hexdigest()
+
+
+def sources_fingerprint(*sources):
+    '''
+    Compute a fingerprint of the contents of a list of data sources.
+    '''
+    h = hashlib.sha1()
+    for source in sources:
+        h.update(','.join(map(str, source.columns)).encode())
+        h.update(pd.util.hash_pandas_object(source.astype(str), index=False).values.tobytes())
+    return h.hexdigest()
+
+
+class ExplanationCache:
+    '''
+    Persistent store of CERTA explanations, backed by a SQLite database (in memory if no path is given).
+
+    Entries are keyed by a fingerprint of the model, of the data sources, of the explained pair and of the explain
+    parameters, plus the no. of open triangles. They expire after ttl seconds (if set) and the least recently used ones
+    are evicted when more than max_entries are stored.
+    '''
+
+    def __init__(self, path: str = ':memory:', max_entries: int = 10000, ttl: float = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS explanations (key TEXT, num_triangles INTEGER, created REAL, '
+                        'accessed REAL, payload BLOB, PRIMARY KEY (key, num_triangles))')
+        self.db.commit()
+
+    @staticmethod
+    def key(model_fingerprint: str, sources_fingerprint: str, l_tuple: pd.Series, r_tuple: pd.Series, params: dict):
+        h = hashlib.sha1()
+        for part in [model_fingerprint, sources_fingerprint, l_tuple.astype(str).to_json(),
+                     r_tuple.astype(str).to_json(), repr(sorted(params.items()))]:
+            h.update(part.encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _alive(self):
+        return -1 if self.ttl is None else time.time() - self.ttl
+
+    def _load(self, key: str, num_triangles: int):
+        row = self.db.execute('SELECT payload FROM explanations WHERE key = ? AND num_triangles = ? AND created > ?',
+                              (key, num_triangles, self._alive())).fetchone()
+        if row is None:
+            return None
+        self.db.execute('UPDATE explanations SET accessed = ? WHERE key = ? AND num_triangles = ?',
+                        (time.time(), key, num_triangles))
+        self.db.commit()
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def get(self, key: str, num_triangles: int):
+        '''
+        Get the explanation stored for a key with exactly num_triangles open triangles.
+        :return: the stored payload or None
+        '''
+        with self.lock:
+            return self._load(key, num_triangles)
+
+    def warm(self, key: str, num_triangles: int):
+        '''
+        Get the explanation stored for a key with the largest no. of open triangles smaller than num_triangles.
+        :return: the stored payload or None
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT MAX(num_triangles) FROM explanations WHERE key = ? AND num_triangles < ? '
+                                  'AND created > ?', (key, num_triangles, self._alive())).fetchone()
+            if row is None or row[0] is None:
+                return None
+            return self._load(key, row[0])
+
+    def put(self, key: str, num_triangles: int, payload: dict):
+        now = time.time()
+        blob = zlib.compress(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO explanations VALUES (?, ?, ?, ?, ?)',
+                            (key, num_triangles, now, now, blob))
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        if self.ttl is not None:
+            self.db.execute('DELETE FROM explanations WHERE created <= ?', (self._alive(),))
+        self.db.execute('DELETE FROM explanations WHERE rowid IN (SELECT rowid FROM explanations '
+                        'ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM explanations')
+            self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM explanations').fetchone()[0]
@@ -0,0 +1,207 @@
+import numpy as np
+import pandas as pd
+
+from certa.triangles_method import attribute_masks
+
+
+def _csr(lists: list, dtype=np.int32):
+    lengths = np.fromiter((len(x) for x in lists), dtype=np.int64, count=len(lists))
+    indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    data = np.fromiter((v for x in lists for v in x), dtype=dtype, count=int(indptr[-1]))
+    return indptr, data
+
+
+def _select_csr(indptr: np.ndarray, data: np.ndarray, rows: np.ndarray):
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    new_indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    positions = np.repeat(starts - new_indptr[:-1], lengths) + np.arange(new_indptr[-1])
+    return new_indptr, data[positions]
+
+
+class CounterfactualExamples(object):
+    '''
+    Compact set of counterfactual examples generated by CERTA.
+
+    Each example is stored as the sparse difference from a base pair (the explained one): the indexes of the
+    attributes having a different value and the ids of their new values in a value dictionary shared by all the
+    examples. The altered attributes are stored both as attribute indexes and as a bitmask, the dropped and the copied
+    values as value ids aligned with the altered attributes. The pd.DataFrame view (see to_frame) is only built when
+    requested.
+    '''
+
+    def __init__(self, attributes: list, values: np.ndarray, base: np.ndarray, diff_indptr: np.ndarray,
+                 diff_attributes: np.ndarray, diff_values: np.ndarray, altered_indptr: np.ndarray,
+                 altered: np.ndarray, altered_masks: np.ndarray, dropped: np.ndarray, copied: np.ndarray,
+                 match_score: np.ndarray, nomatch_score: np.ndarray, triangles: np.ndarray, triangle_ids: np.ndarray):
+        self.attributes = list(attributes)
+        self.values = values
+        self.base = base
+        self.diff_indptr = diff_indptr
+        self.diff_attributes = diff_attributes
+        self.diff_values = diff_values
+        self.altered_indptr = altered_indptr
+        self.altered = altered
+        self.altered_masks = altered_masks
+        self.dropped = dropped
+        self.copied = copied
+        self.match_score = match_score
+        self.nomatch_score = nomatch_score
+        self.triangles = triangles
+        self.triangle_ids = triangle_ids
+        self._frame = None
+
+    @classmethod
+    def from_frame(cls, examples: pd.DataFrame, l_tuple: pd.Series, r_tuple: pd.Series, lprefix='ltable_',
+                   rprefix='rtable_'):
+        '''
+        Encode the counterfactual examples generated by triangles_method.explain_samples.
+        :param examples: the flipped predictions, with a column per (prefixed) attribute, the scores and the
+            alteredAttributes, droppedValues, copiedValues and triangle columns
+        :param l_tuple: the "left" record of the explained pair
+        :param r_tuple: the "right" record of the explained pair
+        :param lprefix: the prefix of attributes from the "left" table
+        :param rprefix: the prefix of attributes from the "right" table
+        :return: the CounterfactualExamples
+        '''
+        attributes = [c for c in examples.columns if (c.startswith(lprefix) or c.startswith(rprefix))
+                      and c not in [lprefix + 'id', rprefix + 'id']]
+        index = {a: i for i, a in enumerate(attributes)}
+        n = len(examples)
+        base_values = [l_tuple.get(a[len(lprefix):], np.nan) if a.startswith(lprefix)
+                       else r_tuple.get(a[len(rprefix):], np.nan) for a in attributes]
+        altered_sets = list(examples['alteredAttributes']) if 'alteredAttributes' in examples.columns \
+            else [()] * n
+        dropped_values = list(examples['droppedValues']) if 'droppedValues' in examples.columns else [[]] * n
+        copied_values = list(examples['copiedValues']) if 'copiedValues' in examples.columns else [[]] * n
+
+        # a single value dictionary for the example cells, the base pair, the dropped and the copied values
+        cells = examples[attributes].values.ravel() if len(attributes) > 0 else np.empty(0, dtype=object)
+        flat_dropped = [v for x in dropped_values for v in x]
+        flat_copied = [v for x in copied_values for v in x]
+        everything = np.empty(len(cells) + len(base_values) + len(flat_dropped) + len(flat_copied), dtype=object)
+        everything[:] = list(cells) + base_values + flat_dropped + flat_copied
+        codes, values = pd.factorize(everything)
+        values = np.asarray(values, dtype=object)
+        if (codes == -1).any():
+            codes = np.where(codes == -1, len(values), codes)
+            values = np.append(values, np.array([np.nan], dtype=object))
+        codes = codes.astype(np.int32)
+        cell_ids = codes[:len(cells)].reshape(n, len(attributes))
+        base = codes[len(cells):len(cells) + len(base_values)]
+        dropped = codes[len(cells) + len(base_values):len(cells) + len(base_values) + len(flat_dropped)]
+        copied = codes[len(codes) - len(flat_copied):]
+
+        rows, columns = np.nonzero(cell_ids != base[None, :])
+        diff_indptr = np.searchsorted(rows, np.arange(n + 1)).astype(np.int64)
+        altered_indptr, altered = _csr([[index[a] for a in t] for t in altered_sets])
+        masks = attribute_masks(altered_sets, index)
+
+        def scores(column):
+            if column in examples.columns:
+                return examples[column].astype(float).values
+            return np.full(n, np.nan)
+
+        if 'triangle' in examples.columns:
+            triangle_ids, triangles = pd.factorize(examples['triangle'].astype(str))
+            triangles = np.asarray(triangles, dtype=object)
+        else:
+            triangle_ids, triangles = np.full(n, -1), np.empty(0, dtype=object)
+        return cls(attributes, values, base, diff_indptr, columns.astype(np.int32),
+                   cell_ids[rows, columns].astype(np.int32), altered_indptr, altered, masks, dropped, copied,
+                   scores('match_score'), scores('nomatch_score'), triangles, triangle_ids.astype(np.int32))
+
+    def __len__(self):
+        return len(self.match_score)
+
+    def select(self, rows):
+        '''
+        The examples at the given positions (or where the given boolean array is True).
+        '''
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.nonzero(rows)[0]
+        rows = rows.astype(np.int64)
+        diff_indptr, diff_attributes = _select_csr(self.diff_indptr, self.diff_attributes, rows)
+        _, diff_values = _select_csr(self.diff_indptr, self.diff_values, rows)
+        altered_indptr, altered = _select_csr(self.altered_indptr, self.altered, rows)
+        _, dropped = _select_csr(self.altered_indptr, self.dropped, rows)
+        _, copied = _select_csr(self.altered_indptr, self.copied, rows)
+        return CounterfactualExamples(self.attributes, self.values, self.base, diff_indptr, diff_attributes,
+                                       diff_values, altered_indptr, altered, self.altered_masks[rows], dropped,
+                                       copied, self.match_score[rows], self.nomatch_score[rows], self.triangles,
+                                       self.triangle_ids[rows])
+
+    def attribute_mask(self, attribute_set):
+        mask = 0
+        for a in attribute_set:
+            if a not in self.attributes:
+                return None
+            mask |= 1 << self.attributes.index(a)
+        return mask
+
+    def filter_attribute_sets(self, attribute_sets):
+        '''
+        The examples whose altered attributes are one of the given sets (tuples or '/' joined strings).
+        '''
+        masks = [self.attribute_mask(tuple(s.split('/')) if isinstance(s, str) else s) for s in attribute_sets]
+        masks = [m for m in masks if m is not None]
+        return self.select(np.isin(self.altered_masks, np.array(masks, dtype=self.altered_masks.dtype)))
+
+    def drop_duplicates(self):
+        '''
+        The examples having distinct altered attributes, dropped and copied values (the first of each).
+        '''
+        seen = set()
+        keep = []
+        for i in range(len(self)):
+            start, end = self.altered_indptr[i], self.altered_indptr[i + 1]
+            key = (self.altered[start:end].tobytes(), self.dropped[start:end].tobytes(),
+                   self.copied[start:end].tobytes())
+            if key not in seen:
+                seen.add(key)
+                keep.append(i)
+        return self.select(np.array(keep, dtype=np.int64))
+
+    def attr_count(self):
+        return np.diff(self.altered_indptr)
+
+    def nbytes(self):
+        return sum(a.nbytes for a in [self.base, self.diff_indptr, self.diff_attributes, self.diff_values,
+                                      self.altered_indptr, self.altered, self.altered_masks, self.dropped,
+                                      self.copied, self.match_score, self.nomatch_score, self.triangle_ids]) \
+            + sum(len(str(v)) for v in self.values) + sum(len(t) for t in self.triangles)
+
+    def to_frame(self):
+        '''
+        The examples as a pd.DataFrame with a column per attribute, the scores and the alteredAttributes,
+        droppedValues, copiedValues, triangle and attr_count columns.
+        '''
+        if self._frame is None:
+            n = len(self)
+            cell_ids = np.repeat(self.base[None, :], n, axis=0)
+            rows = np.repeat(np.arange(n), np.diff(self.diff_indptr))
+            cell_ids[rows, self.diff_attributes] = self.diff_values
+            frame = pd.DataFrame(self.values[cell_ids] if n > 0 else None, columns=self.attributes,
+                                 index=pd.RangeIndex(n)).infer_objects()
+            frame['match_score'] = self.match_score
+            frame['nomatch_score'] = self.nomatch_score
+            attributes = np.array(self.attributes, dtype=object)
+            splits = self.altered_indptr[1:-1]
+            frame['alteredAttributes'] = [tuple(a) for a in np.split(attributes[self.altered], splits)] \
+                if n > 0 else []
+            frame['droppedValues'] = [list(v) for v in np.split(self.values[self.dropped], splits)] if n > 0 else []
+            frame['copiedValues'] = [list(v) for v in np.split(self.values[self.copied], splits)] if n > 0 else []
+            frame['triangle'] = [self.triangles[t] if t >= 0 else None for t in self.triangle_ids]
+            frame['attr_count'] = self.attr_count()
+            self._frame = frame
+        return self._frame
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_frame'] = None
+        return state
+
+    def __repr__(self):
+        return 'CounterfactualExamples(%d examples, %d attributes, %d values)' % (len(self), len(self.attributes),
+                                                                                 len(self.values))
@@ -4,20 +4,31 @@ import numpy as np
 import pandas as pd
 
 from certa import local_explain, triangles_method
+from certa.cache import ExplanationCache, sources_fingerprint
+from certa.counterfactuals import CounterfactualExamples
 from certa.local_explain import generate_subsequences
-from certa.utils import lattice, get_row
+from certa.sampling import saliency_convergence
+from certa.stats import ExplanationStats
+from certa.utils import bitset_lattice, get_row
 
 
 class CertaExplainer(object):
 
-    def __init__(self, lsource, rsource, data_augmentation: str = 'on_demand'):
+    def __init__(self, lsource, rsource, data_augmentation: str = 'on_demand', hooks: list = None,
+                 cache: ExplanationCache = None):
         '''
         Create the CERTA explainer
         :param lsource: the data source for "left" records
         :param rsource: the data source for "right" records
         :param data_augmentation: 'no' to avoid usage of DA at all, 'on_demand' to use it only when needed, 'always'
             to always use DA generated records even when the no. of found support records is sufficient.
+        :param hooks: callables invoked with the event name and data for each stage and model call of an explanation
+        :param cache: the ExplanationCache storing the explanations generated for a given model fingerprint
         '''
+        self.hooks = list(hooks) if hooks is not None else []
+        self.cache = cache
+        self.data_augmentation = data_augmentation
+        self.sources_fingerprint = sources_fingerprint(lsource, rsource) if cache is not None else None
         if data_augmentation in ['always', 'on_demand']:
             gen_left, gen_right = generate_subsequences(lsource, rsource)
             self.lsource = pd.concat([lsource, gen_left])
@@ -33,7 +44,10 @@ class CertaExplainer(object):
 
     def explain(self, l_tuple, r_tuple, predict_fn, left=True, right=True, attr_length=-1,
                 num_triangles: int = 100, lprefix='ltable_', rprefix='rtable_',
-                max_predict: int = -1, debug: bool = False):
+                max_predict: int = -1, debug: bool = False, return_stats: bool = False,
+                model_fingerprint: str = None, sampling='extremes', adaptive: bool = False,
+                tolerance: float = 0.02, round_size: int = 5, persist_predictions: bool = False,
+                predictions_path: str = 'predictions.parquet', seed: int = 0):
         '''
         Explain the prediction generated by an ER model via its prediction function predict_fn on a pair of records
          l_tuple and r_tuple.
@@ -49,110 +63,185 @@ class CertaExplainer(object):
         :param max_predict: the maximum number of predictions to be performed by the ER model to generate the requested
         number of open triangles
         :param debug: whether to produce lattice data for debugging
-        :return: saliency explanation, the probabilities of sufficiency, all the generated cf explanations, the open triangles
+        :param return_stats: whether to also return the ExplanationStats of this explanation
+        :param model_fingerprint: the fingerprint of the ER model (see certa.cache.model_fingerprint), explanations are
+        cached only when both this and the explainer cache are set. A cached explanation of the same pair with fewer
+        triangles is used as a warm start: its support records are kept and only the missing ones are searched for
+        :param sampling: the strategy selecting the support records for the open triangles (see certa.sampling), the
+        no. of triangles the saliency needed to converge is reported in the ExplanationStats (if return_stats is set)
+        :param adaptive: whether to process the open triangles in rounds, stopping as soon as the saliency and the
+        counterfactual summary are stable within tolerance, or when max_predict predictions have been performed. In
+        this case num_triangles is the maximum no. of open triangles
+        :param tolerance: the maximum change of the saliency of any attribute between two rounds for the explanation
+        to be stable
+        :param round_size: the no. of open triangles processed in each round
+        :param seed: the seed of the random choices of an explanation: the sampling of the support records and the
+        shuffling of the open triangles before they are split in rounds (when adaptive)
+        :param persist_predictions: whether to write the lattice predictions to predictions_path (Parquet) in the
+        background (requires pyarrow), see triangles_method.wait_persisted to wait for the write
+        :param predictions_path: the file the lattice predictions are written to
+        :return: saliency explanation, the probabilities of sufficiency, all the generated cf explanations (as
+        CounterfactualExamples, see to_frame), the open triangles, the lattices (and the ExplanationStats if
+        return_stats is set)
         '''
-        prediction = local_explain.get_original_prediction(l_tuple, r_tuple, predict_fn)
+        stats = ExplanationStats(self.hooks)
+        stats.triangles_requested = num_triangles
+        predict_fn = stats.predict(predict_fn)
+        key = None
+        warm = None
+        if self.cache is not None and model_fingerprint is not None:
+            # the data augmentation mode determines the (augmented) sources the support records come from
+            params = {'data_augmentation': self.data_augmentation, 'use_all': self.use_all, 'left': left,
+                      'right': right, 'attr_length': attr_length, 'lprefix': lprefix, 'rprefix': rprefix,
+                      'max_predict': max_predict, 'debug': debug, 'seed': seed,
+                      'sampling': sampling if isinstance(sampling, str) else getattr(sampling, '__name__', ''),
+                      'adaptive': (tolerance, round_size) if adaptive else False}
+            key = self.cache.key(model_fingerprint, self.sources_fingerprint, l_tuple, r_tuple, params)
+            cached = self.cache.get(key, num_triangles)
+            if cached is not None:
+                stats.hit()
+                if return_stats:
+                    return cached['explanation'] + (stats,)
+                return cached['explanation']
+            warm = self.cache.warm(key, num_triangles)
+        with stats.stage('explain'):
+            explanation, support = self._explain(l_tuple, r_tuple, predict_fn, left, right, attr_length,
+                                                 num_triangles, lprefix, rprefix, max_predict, debug, stats, warm,
+                                                 sampling, adaptive, tolerance, round_size, persist_predictions,
+                                                 predictions_path, seed, return_stats)
+        if key is not None:
+            self.cache.put(key, num_triangles, {'explanation': explanation, 'support': support})
+        if return_stats:
+            return explanation + (stats,)
+        return explanation
+
+    def _explain(self, l_tuple, r_tuple, predict_fn, left, right, attr_length, num_triangles, lprefix, rprefix,
+                 max_predict, debug, stats, warm=None, sampling='extremes', adaptive=False, tolerance=0.02,
+                 round_size=5, persist_predictions=False, predictions_path='predictions.parquet', seed=0,
+                 convergence=False):
+        with stats.stage('prediction'):
+            prediction = local_explain.get_original_prediction(l_tuple, r_tuple, predict_fn)
         pc = np.argmax(prediction)
-        support_samples, gleft_df, gright_df = local_explain.support_predictions(l_tuple, r_tuple, self.lsource,
-                                                                                 self.rsource,
-                                                                                 predict_fn, lprefix, rprefix,
-                                                                                 class_to_explain=pc, use_w=left,
-                                                                                 use_q=right, use_all=self.use_all,
-                                                                                 num_triangles=num_triangles,
-                                                                                 max_predict=max_predict)
+        warm_support, warm_left, warm_right = None, pd.DataFrame(), pd.DataFrame()
+        if warm is not None:
+            stats.hit()
+            warm_support, warm_left, warm_right = warm['support']
+        with stats.stage('support'):
+            support_samples, gleft_df, gright_df = local_explain.support_predictions(l_tuple, r_tuple, self.lsource,
+                                                                                     self.rsource,
+                                                                                     predict_fn, lprefix, rprefix,
+                                                                                     class_to_explain=pc, use_w=left,
+                                                                                     use_q=right,
+                                                                                     use_all=self.use_all,
+                                                                                     num_triangles=num_triangles,
+                                                                                     max_predict=max_predict,
+                                                                                     stats=stats,
+                                                                                     warm_support=warm_support,
+                                                                                     sampling=sampling, seed=seed)
+        stats.support_found = max(len(support_samples) - 1, 0)
+        gleft_df = pd.concat([warm_left, gleft_df]).drop_duplicates(subset=['id']) if len(warm_left) > 0 else gleft_df
+        gright_df = pd.concat([warm_right, gright_df]).drop_duplicates(subset=['id']) if len(warm_right) > 0 \
+            else gright_df
+        # the support records (without the explained pair) and the generated copies, to warm start larger explanations
+        support = (support_samples[1:], gleft_df, gright_df)
 
         if attr_length <= 0:
             attr_length = min(len(l_tuple) - 1, len(r_tuple) - 1)
         if len(support_samples) > 0:
             extended_sources = [pd.concat([self.lsource, gright_df]), pd.concat([self.rsource, gleft_df])]
-            pns, pss, cf_ex, triangles = triangles_method.explain_samples(support_samples, extended_sources, predict_fn,
-                                                                          lprefix, rprefix, pc, attr_length=attr_length,
-                                                                          persist_predictions=debug)
+            pns, pss, cf_ex, triangles, triangle_predictions = triangles_method.explain_samples(
+                support_samples, extended_sources, predict_fn, lprefix, rprefix, pc, attr_length=attr_length,
+                return_predictions=True, stats=stats, round_size=round_size if adaptive else -1,
+                tolerance=tolerance, max_predict=max_predict if adaptive else -1,
+                persist_predictions=persist_predictions, predictions_path=predictions_path, seed=seed)
+            if convergence:
+                # from the same flips (the predicted and the assumed ones) as the returned saliency
+                stats.triangles_to_converge = saliency_convergence(cf_ex, triangles, list(pns.keys()))
             cf_summary = triangles_method.cf_summary(pss)
             saliency_df = pd.DataFrame(data=[pns.values()], columns=pns.keys())
+            cf_ex = CounterfactualExamples.from_frame(cf_ex, l_tuple, r_tuple, lprefix, rprefix)
             if len(cf_ex) > 0:
-                cf_ex['attr_count'] = cf_ex.alteredAttributes.astype(str) \
-                    .str.split(',').str.len()
-                cf_ex = cf_ex[cf_ex['alteredAttributes'].isin([tuple(k.split('/')) for k in cf_summary.keys()])] \
-                    .astype(str).drop_duplicates(subset=['copiedValues', 'alteredAttributes', 'droppedValues'])
+                cf_ex = cf_ex.filter_attribute_sets(cf_summary.keys()).drop_duplicates()
             lattices = []
             if debug:
-                # generate lattice debug data
-                triangle_predictions = pd.read_csv('predictions.csv')
-                gbo = triangle_predictions.groupby('triangle')
-                triangle_ids = list(gbo.groups.keys())
-                for i in np.arange(len(triangle_ids)):
-                    triangle = triangle_ids[i]
-                    triangle_lattice = gbo.get_group(triangle)[['alteredAttributes', 'match_score']]
-                    triangle_lattice['alteredAttributes'] = triangle_lattice['alteredAttributes'].apply(lambda x: tuple(
-                        x.replace("'", '').replace('(', '').replace(')', '').replace(',', '').split(' ')))
-                    lattice_dict = dict(zip(triangle_lattice.alteredAttributes, triangle_lattice.match_score))
-                    triangle_edges = triangle.split(' ')
-                    if triangle[0].startswith('0'):
-                        powerset = [set()] + [set(s) for s in lattice_dict.keys()] + [
-                            set([c for c in saliency_df.columns if c[0] == 'l'])]
-                        if pc == 0:
-                            f = extended_sources[0][extended_sources[0]['ltable_id'] == int(triangle_edges[2].split('@')[1])].iloc[0]
-                            s = extended_sources[0][extended_sources[0]['ltable_id'] == int(triangle_edges[0].split('@')[1])].iloc[0]
-                        else:
-                            f = extended_sources[0][extended_sources[0]['ltable_id'] == int(triangle_edges[0].split('@')[1])].iloc[0]
-                            s = extended_sources[0][extended_sources[0]['ltable_id'] == int(triangle_edges[2].split('@')[1])].iloc[0]
-                        p = extended_sources[1][extended_sources[1]['rtable_id'] == int(triangle_edges[1].split('@')[1])].iloc[0]
-                        tl_tuple = s
-                        tr_tuple = p
-                    else:
-                        powerset = [set()] + [set(s) for s in lattice_dict.keys()] + [
-                            set([c for c in saliency_df.columns if c[0] == 'r'])]
-                        if pc == 0:
-                            f = extended_sources[1][extended_sources[1]['rtable_id'] == int(triangle_edges[2].split('@')[1])].iloc[0]
-                            s = extended_sources[1][extended_sources[1]['rtable_id'] == int(triangle_edges[0].split('@')[1])].iloc[0]
-                        else:
-                            f = extended_sources[1][extended_sources[1]['rtable_id'] == int(triangle_edges[0].split('@')[1])].iloc[0]
-                            s = extended_sources[1][extended_sources[1]['rtable_id'] == int(triangle_edges[2].split('@')[1])].iloc[0]
-                        p = extended_sources[0][extended_sources[0]['ltable_id'] == int(triangle_edges[1].split('@')[1])].iloc[0]
-                        tl_tuple = p
-                        tr_tuple = s
-
-                    tl_tuple.index = tl_tuple.index.str.lstrip("ltable_")
-                    tr_tuple.index = tr_tuple.index.str.lstrip("rtable_")
-
-                    top_lattice_prediction = local_explain.get_original_prediction(tl_tuple, tr_tuple, predict_fn)
-                    if np.argmax(top_lattice_prediction) == pc:
-                        top_lattice_prediction = local_explain.get_original_prediction(tr_tuple, tl_tuple, predict_fn)
-                    rank = [prediction[1]] + list(lattice_dict.values()) + [top_lattice_prediction[1]]
-                    triangle_df = pd.concat([p, f, s], axis=1).T
-                    triangle_df['type'] = ['pivot', 'free', 'support']
-                    lattice_predictions = gbo.get_group(triangle).drop(
-                        ['Unnamed: 0', 'triangle', 'droppedValues', 'copiedValues', 'nomatch_score'],
-                        axis=1)
-
-                    op = get_row(l_tuple, r_tuple).drop(['ltable_id', 'rtable_id'], axis=1)
-                    op['alteredAttributes'] = ''
-                    op['match_score'] = prediction[1]
-
-                    sp = get_row(tl_tuple, tr_tuple)
-                    if 'ltable_id' in sp.columns:
-                        sp = sp.drop(['ltable_id'], axis=1)
-                    if 'rtable_id' in sp.columns:
-                        sp = sp.drop(['rtable_id'], axis=1)
-                    sp['alteredAttributes'] = str(powerset[-1:][0])
-                    sp['match_score'] = top_lattice_prediction[1]
-
-                    lattice_predictions['alteredAttributes'] = lattice_predictions['alteredAttributes'].apply(
-                        lambda x: tuple(
-                            x.replace("'", '').replace('(', '').replace(')', '').replace(',', '').split(' ')))
-
-                    lattice_predictions = pd.concat([sp, lattice_predictions, op], ignore_index=True)
-
-                    lattice_predictions = lattice_predictions.sort_values(by="alteredAttributes",
-                                                                          key=lambda x: x.str.count(
-                                                                              '|'.join(['ltable_', 'rtable_'])),
-                                                                          ascending=False)
-
-                    latt = lattice(powerset, rank, triangle=lattice_predictions)
-                    lattices.append(latt)
-
-            return saliency_df, pss, cf_ex, triangles, lattices
+                lattices = self._lattices(triangle_predictions, saliency_df, extended_sources, prediction, pc,
+                                          l_tuple, r_tuple, predict_fn, stats)
+
+            return (saliency_df, pss, cf_ex, triangles, lattices), support
         else:
             logging.warning('no triangles found -> empty explanation')
-            return pd.DataFrame(), pd.Series(), pd.DataFrame(), [], []
+            cf_ex = CounterfactualExamples.from_frame(pd.DataFrame(), l_tuple, r_tuple, lprefix, rprefix)
+            return (pd.DataFrame(), pd.Series(), cf_ex, [], []), support
+
+    def _lattices(self, triangle_predictions, saliency_df, extended_sources, prediction, pc, l_tuple, r_tuple,
+                  predict_fn, stats):
+        lattices = []
+        with stats.stage('lattice_debug'):
+            # generate lattice debug data
+            gbo = triangle_predictions.groupby('triangle')
+            triangle_ids = list(gbo.groups.keys())
+            for i in np.arange(len(triangle_ids)):
+                triangle = triangle_ids[i]
+                triangle_lattice = gbo.get_group(triangle)[['alteredAttributes', 'match_score']]
+                lattice_dict = dict(zip(triangle_lattice.alteredAttributes, triangle_lattice.match_score))
+                triangle_edges = triangle.split(' ')
+                if triangle[0].startswith('0'):
+                    powerset = [set()] + [set(s) for s in lattice_dict.keys()] + [
+                        set([c for c in saliency_df.columns if c[0] == 'l'])]
+                    if pc == 0:
+                        f = extended_sources[0][extended_sources[0]['ltable_id'] == int(triangle_edges[2].split('@')[1])].iloc[0]
+                        s = extended_sources[0][extended_sources[0]['ltable_id'] == int(triangle_edges[0].split('@')[1])].iloc[0]
+                    else:
+                        f = extended_sources[0][extended_sources[0]['ltable_id'] == int(triangle_edges[0].split('@')[1])].iloc[0]
+                        s = extended_sources[0][extended_sources[0]['ltable_id'] == int(triangle_edges[2].split('@')[1])].iloc[0]
+                    p = extended_sources[1][extended_sources[1]['rtable_id'] == int(triangle_edges[1].split('@')[1])].iloc[0]
+                    tl_tuple = s
+                    tr_tuple = p
+                else:
+                    powerset = [set()] + [set(s) for s in lattice_dict.keys()] + [
+                        set([c for c in saliency_df.columns if c[0] == 'r'])]
+                    if pc == 0:
+                        f = extended_sources[1][extended_sources[1]['rtable_id'] == int(triangle_edges[2].split('@')[1])].iloc[0]
+                        s = extended_sources[1][extended_sources[1]['rtable_id'] == int(triangle_edges[0].split('@')[1])].iloc[0]
+                    else:
+                        f = extended_sources[1][extended_sources[1]['rtable_id'] == int(triangle_edges[0].split('@')[1])].iloc[0]
+                        s = extended_sources[1][extended_sources[1]['rtable_id'] == int(triangle_edges[2].split('@')[1])].iloc[0]
+                    p = extended_sources[0][extended_sources[0]['ltable_id'] == int(triangle_edges[1].split('@')[1])].iloc[0]
+                    tl_tuple = p
+                    tr_tuple = s
+
+                tl_tuple.index = tl_tuple.index.str.lstrip("ltable_")
+                tr_tuple.index = tr_tuple.index.str.lstrip("rtable_")
+
+                top_lattice_prediction = local_explain.get_original_prediction(tl_tuple, tr_tuple, predict_fn)
+                if np.argmax(top_lattice_prediction) == pc:
+                    top_lattice_prediction = local_explain.get_original_prediction(tr_tuple, tl_tuple, predict_fn)
+                rank = [prediction[1]] + list(lattice_dict.values()) + [top_lattice_prediction[1]]
+                triangle_df = pd.concat([p, f, s], axis=1).T
+                triangle_df['type'] = ['pivot', 'free', 'support']
+                lattice_predictions = gbo.get_group(triangle).drop(
+                    ['triangle', 'droppedValues', 'copiedValues', 'nomatch_score'],
+                    axis=1)
+
+                op = get_row(l_tuple, r_tuple).drop(['ltable_id', 'rtable_id'], axis=1)
+                op['alteredAttributes'] = ''
+                op['match_score'] = prediction[1]
+
+                sp = get_row(tl_tuple, tr_tuple)
+                if 'ltable_id' in sp.columns:
+                    sp = sp.drop(['ltable_id'], axis=1)
+                if 'rtable_id' in sp.columns:
+                    sp = sp.drop(['rtable_id'], axis=1)
+                sp['alteredAttributes'] = str(powerset[-1:][0])
+                sp['match_score'] = top_lattice_prediction[1]
+
+                lattice_predictions = pd.concat([sp, lattice_predictions, op], ignore_index=True)
+
+                lattice_predictions = lattice_predictions.sort_values(by="alteredAttributes",
+                                                                      key=lambda x: x.astype(str).str.count(
+                                                                          '|'.join(['ltable_', 'rtable_'])),
+                                                                      ascending=False)
+
+                latt = bitset_lattice(powerset, rank, triangle=lattice_predictions)
+                lattices.append(latt)
+        return lattices
@@ -6,6 +6,8 @@ from collections import Counter
 import numpy as np
 import pandas as pd
 
+from certa.sampling import sample_support
+from certa.stats import ExplanationStats
 from certa.utils import diff, get_row
 
 
@@ -17,7 +19,9 @@ def get_original_prediction(r1, r2, predict_fn):
 def support_predictions(r1: pd.Series, r2: pd.Series, lsource: pd.DataFrame,
                         rsource: pd.DataFrame, predict_fn, lprefix, rprefix, num_triangles: int = 100,
                         class_to_explain: int = None, max_predict: int = -1,
-                        use_w: bool = True, use_q: bool = True, use_all: bool = False):
+                        use_w: bool = True, use_q: bool = True, use_all: bool = False,
+                        stats: ExplanationStats = None, warm_support: pd.DataFrame = None,
+                        sampling='extremes', seed=0):
     '''
     generate a pd.DataFrame of support predictions to be used to generate open triangles.
     :param r1: the "left" record
@@ -35,6 +39,12 @@ def support_predictions(r1: pd.Series, r2: pd.Series, lsource: pd.DataFrame,
     :param use_q: whether to use right open triangles
     :param use_all: whether to use all possible records in the existing data sources to create support records, not
         stopping when _num_triangles_ records have been found
+    :param stats: the ExplanationStats recording the time spent in the support search and in the augmentation
+    :param warm_support: support records found by a previous explanation of the same pair, which are kept and not
+        searched again, so that only the missing ones are looked for
+    :param sampling: the strategy selecting the support records when more than _num_triangles_ are found, either
+        the name of one of certa.sampling.strategies or a callable with the same signature
+    :param seed: the seed (or the np.random.Generator) of the random choices made when selecting the support records
     :return: a pd.DataFrame of record pairs with one record from the original prediction and one record yielding an
         opposite prediction by the ER model
     '''
@@ -43,36 +53,59 @@ def support_predictions(r1: pd.Series, r2: pd.Series, lsource: pd.DataFrame,
 
     r1r2['id'] = "0@" + str(r1r2[lprefix + 'id'].values[0]) + "#" + "1@" + str(r1r2[rprefix + 'id'].values[0])
 
-    find_positives, support = get_support(class_to_explain, lsource, max_predict,
-                                         original_prediction, predict_fn, r1, r2, rsource,
-                                         use_w, use_q, lprefix, rprefix, num_triangles, use_all=use_all)
+    if stats is None:
+        stats = ExplanationStats()
+    rng = np.random.default_rng(seed)
+    if warm_support is None:
+        warm_support = pd.DataFrame()
+    search_lsource = lsource
+    search_rsource = rsource
+    if len(warm_support) > 0:
+        known_l = warm_support.loc[warm_support[rprefix + 'id'] == r1r2[rprefix + 'id'].values[0], lprefix + 'id']
+        known_r = warm_support.loc[warm_support[lprefix + 'id'] == r1r2[lprefix + 'id'].values[0], rprefix + 'id']
+        search_lsource = lsource[~lsource['id'].isin(known_l)]
+        search_rsource = rsource[~rsource['id'].isin(known_r)]
+    num_triangles = num_triangles - len(warm_support)
+
+    support = pd.DataFrame()
+    if num_triangles > 0:
+        with stats.stage('support_search'):
+            find_positives, support = get_support(class_to_explain, search_lsource, max_predict,
+                                                 original_prediction, predict_fn, r1, r2, search_rsource,
+                                                 use_w, use_q, lprefix, rprefix, num_triangles, use_all=use_all,
+                                                 sampling=sampling, rng=rng)
     copies_left = pd.DataFrame()
     copies_right = pd.DataFrame()
     if len(support) < num_triangles:
         try:
-            copies, copies_left, copies_right = expand_copies(lprefix, lsource, r1, r2, rprefix, rsource)
-            find_positives2, support2 = get_support(class_to_explain, copies_right, max_predict,
-                                              original_prediction, predict_fn, r1, r2, copies_left,
-                                              use_w, use_q, lprefix, rprefix, num_triangles, use_all=use_all)
+            with stats.stage('augmentation'):
+                copies, copies_left, copies_right = expand_copies(lprefix, lsource, r1, r2, rprefix, rsource)
+            with stats.stage('augmented_support_search'):
+                find_positives2, support2 = get_support(class_to_explain, copies_right, max_predict,
+                                                  original_prediction, predict_fn, r1, r2, copies_left,
+                                                  use_w, use_q, lprefix, rprefix, num_triangles, use_all=use_all,
+                                                  sampling=sampling, rng=rng)
             if len(support2) > 0:
                 support = pd.concat([support, support2])
         except:
             pass
 
-    if len(support) > 0:
+    if len(support) > 0 or len(warm_support) > 0:
         if len(support) > num_triangles:
-            support = pd.concat([support[:int(num_triangles/2)], support[-int(num_triangles/2):]], axis=0)
-        else:
+            support = sample_support(support, num_triangles, r1, r2, strategy=sampling, lprefix=lprefix,
+                                     rprefix=rprefix, rng=rng)
+        elif num_triangles > 0:
             logging.warning(f'could find {str(len(support))} triangles of the {str(num_triangles)} requested')
 
-        support['label'] = list(map(lambda predictions: int(round(predictions)),
-                                         support.match_score.values))
-        support = support.drop(['match_score', 'nomatch_score'], axis=1)
+        if len(support) > 0:
+            support['label'] = list(map(lambda predictions: int(round(predictions)),
+                                             support.match_score.values))
+            support = support.drop(['match_score', 'nomatch_score'], axis=1)
         if class_to_explain == None:
             r1r2['label'] = np.argmax(original_prediction)
         else:
             r1r2['label'] = class_to_explain
-        support_pairs = pd.concat([r1r2, support], ignore_index=True)
+        support_pairs = pd.concat([r1r2, warm_support, support], ignore_index=True)
         return support_pairs, copies_left, copies_right
     else:
         logging.warning('no triangles found')
@@ -80,61 +113,97 @@ def support_predictions(r1: pd.Series, r2: pd.Series, lsource: pd.DataFrame,
 
 
 def find_candidates_predict(record, source, find_positives, predict_fn, num_candidates, lj=True, scored: bool = True,
-                            max_predict=-1, lprefix='ltable_', rprefix='rtable_', batched: bool = True):
-    if lj:
-        prefix = rprefix
-        records = pd.DataFrame()
-        records = records.append([record] * len(source), ignore_index=True)
-        copy = source.copy()
-        records.columns = list(map(lambda col: lprefix + col, records.columns))
-        copy.columns = list(map(lambda col: rprefix + col, copy.columns))
-        records.index = copy.index
-        samples = pd.concat([records, copy], axis=1)
-    else:
-        prefix = lprefix
-        copy = source.copy()
-        records = pd.DataFrame()
-        records = records.append([record] * len(source), ignore_index=True)
-        records.index = copy.index
-        copy.columns = list(map(lambda col: lprefix + col, copy.columns))
-        records.columns = list(map(lambda col: rprefix + col, records.columns))
-        samples = pd.concat([copy, records], axis=1)
-
-    if max_predict > 0:
-        samples = samples.sample(frac=1)[:max_predict]
-
-    record_text = record_to_text(record)
-    if scored:
-        samples['score'] = samples.filter(regex='^'+prefix).T.apply(lambda row: cs(record_text, record_to_text(row)))
-        samples = samples.sort_values(by='score', ascending=not find_positives)
-        samples = samples.drop(['score'], axis=1)
-    result = pd.DataFrame()
-    batch = num_candidates * 4
-    splits = min(20, int(len(samples) / batch))
-    i = 0
-    if batched:
-        while len(result) < num_candidates and i < splits:
-            start = batch * i
-            end = batch * (i + 1)
-            batch_samples = samples[start:end]
-            predicted = predict_fn(batch_samples)
-            if find_positives:
-                out = predicted[predicted["match_score"] > 0.5]
-            else:
-                out = predicted[predicted["match_score"] < 0.5]
-            if len(out) > 0:
-                result = pd.concat([result, out], axis=0)
-            logging.info(f'{i}:{len(out)},{len(result)}')
-            i += 1
-    else:
-        predicted = predict_fn(samples)
+                            max_predict=-1, lprefix='ltable_', rprefix='rtable_', batched: bool = True,
+                            max_batches: int = 20):
+    '''
+    find pairs made of a given record and records from a data source that the ER model predicts as matching (or
+    non-matching). Candidates are streamed to the model in similarity order, the batch size is adapted to the observed
+    hit rate and the search stops as soon as enough candidates are found or the prediction budget is exhausted.
+    :param record: the record to be paired with records from the data source
+    :param source: the data source
+    :param find_positives: whether to look for matching (True) or non-matching (False) pairs
+    :param predict_fn: the ER model prediction function
+    :param num_candidates: the number of pairs to be found
+    :param lj: whether the record is the "left" one in the generated pairs
+    :param scored: whether to sort candidates by similarity with the record
+    :param max_predict: the maximum number of pairs to be predicted by the ER model (-1 for no limit)
+    :param lprefix: the prefix of attributes from the "left" table
+    :param rprefix: the prefix of attributes from the "right" table
+    :param batched: whether to stop once _num_candidates_ pairs have been found, otherwise all the candidates are
+        predicted (still in batches)
+    :param max_batches: the maximum number of calls to predict_fn when batched
+    :return: a pd.DataFrame of predicted pairs
+    '''
+    result = []
+    found = 0
+    predicted_count = 0
+    hits = 0
+    calls = 0
+    batch = max(1, num_candidates * 4)
+    max_batch = batch * 16
+    if not batched:
+        batch = max_batch
+    budget = len(source) if max_predict <= 0 else min(max_predict, len(source))
+    candidates = get_candidates(record, source, find_positives, lj=lj, scored=scored, lprefix=lprefix,
+                                rprefix=rprefix)
+    next(candidates)
+    while predicted_count < budget:
+        if batched and (found >= num_candidates or calls >= max_batches):
+            break
+        size = min(batch, budget - predicted_count)
+        batch_samples = candidates.send(size)
+        predicted = predict_fn(batch_samples)
         if find_positives:
             out = predicted[predicted["match_score"] > 0.5]
         else:
             out = predicted[predicted["match_score"] < 0.5]
         if len(out) > 0:
-            result = pd.concat([result, out], axis=0)
-    return result
+            result.append(out)
+        found += len(out)
+        hits += len(out)
+        predicted_count += len(batch_samples)
+        logging.info(f'{calls}:{len(out)},{found}')
+        calls += 1
+        # adapt the next batch to the no. of candidates still missing given the observed hit rate
+        if hits == 0:
+            batch = min(batch * 2, max_batch)
+        elif batched:
+            batch = int(min(max(np.ceil((num_candidates - found) * predicted_count / hits), 1), max_batch))
+    candidates.close()
+    if len(result) > 0:
+        return pd.concat(result, axis=0)
+    return pd.DataFrame()
+
+
+def get_candidates(record, source, find_positives, lj=True, scored: bool = True, lprefix='ltable_',
+                   rprefix='rtable_'):
+    '''
+    generator of candidate pairs made of a given record and records from a data source, in similarity order.
+    After being primed with next(), it yields the next _n_ pairs for each _n_ sent to it.
+    '''
+    if scored:
+        record_text = record_to_text(record)
+        scores = pd.Series([cs(record_text, record_to_text(row)) for _, row in source.iterrows()],
+                           index=source.index, dtype=float)
+        order = np.argsort(-scores.values if find_positives else scores.values, kind='stable')
+    else:
+        order = np.arange(len(source))
+    start = 0
+    size = yield
+    while start < len(order):
+        copy = source.iloc[order[start:start + size]].copy()
+        records = pd.DataFrame(np.repeat(record.values[None, :], len(copy), axis=0), columns=record.index,
+                               index=copy.index).infer_objects()
+        if lj:
+            records.columns = list(map(lambda col: lprefix + col, records.columns))
+            copy.columns = list(map(lambda col: rprefix + col, copy.columns))
+            samples = pd.concat([records, copy], axis=1)
+        else:
+            copy.columns = list(map(lambda col: lprefix + col, copy.columns))
+            records.columns = list(map(lambda col: rprefix + col, records.columns))
+            samples = pd.concat([copy, records], axis=1)
+        start += len(copy)
+        size = yield samples
 
 
 def record_to_text(record, ignored_columns = ['id', 'ltable_id', 'rtable_id', 'label']):
@@ -142,25 +211,14 @@ def record_to_text(record, ignored_columns = ['id', 'ltable_id', 'rtable_id', 'l
 
 
 def generate_subsequences(lsource, rsource, max=-1):
-    new_records_left_df = pd.DataFrame()
-    for i in np.arange(len(lsource[:max])):
-        r = lsource.iloc[i]
-        nr_df = pd.DataFrame(generate_modified(r, start_id=len(new_records_left_df) + len(lsource)))
-        if len(nr_df) > 0:
-            nr_df.columns = lsource.columns
-            new_records_left_df = pd.concat([new_records_left_df, nr_df])
-    new_records_right_df = pd.DataFrame()
-    for i in np.arange(len(rsource[:max])):
-        r = rsource.iloc[i]
-        nr_df = pd.DataFrame(generate_modified(r, start_id=len(new_records_right_df) + len(rsource)))
-        if len(nr_df) > 0:
-            nr_df.columns = rsource.columns
-            new_records_right_df = pd.concat([new_records_right_df, nr_df])
+    new_records_left_df = generate_modified_records(lsource[:max], start_id=len(lsource))
+    new_records_right_df = generate_modified_records(rsource[:max], start_id=len(rsource))
     return new_records_left_df, new_records_right_df
 
 
 def get_support(class_to_explain, lsource, max_predict, original_prediction, predict_fn, r1, r2,
-                rsource, use_w, use_q, lprefix, rprefix, num_triangles, use_all: bool = False):
+                rsource, use_w, use_q, lprefix, rprefix, num_triangles, use_all: bool = False,
+                sampling='extremes', rng=None):
     candidates4r1 = pd.DataFrame()
     candidates4r2 = pd.DataFrame()
     num_candidates = int(num_triangles / 2)
@@ -179,11 +237,14 @@ def get_support(class_to_explain, lsource, max_predict, original_prediction, pre
     if max_len == 0:
         max_len = max(len(candidates4r1), len(candidates4r2))
 
-    if len(candidates4r1) > max_len:
-        candidates4r1 = candidates4r1.sample(n=max_len)
-    if len(candidates4r2) > max_len:
-        candidates4r2 = candidates4r2.sample(n=max_len)
-    candidates = pd.concat([candidates4r1, candidates4r2]).sample(frac=1)
+    # balance the candidates found for each record (at random unless a sampling strategy is set)
+    trim = 'random' if sampling == 'extremes' else sampling
+    rng = np.random.default_rng(rng)
+    candidates4r1 = sample_support(candidates4r1, max_len, r1, r2, strategy=trim, lprefix=lprefix, rprefix=rprefix,
+                                   rng=rng)
+    candidates4r2 = sample_support(candidates4r2, max_len, r1, r2, strategy=trim, lprefix=lprefix, rprefix=rprefix,
+                                   rng=rng)
+    candidates = pd.concat([candidates4r1, candidates4r2]).sample(frac=1, random_state=rng)
 
     neighborhood = pd.DataFrame()
     if len(candidates) > 0:
@@ -197,22 +258,52 @@ def get_support(class_to_explain, lsource, max_predict, original_prediction, pre
     return findPositives, neighborhood
 
 
+def drop_prefix_suffix(values: np.ndarray):
+    '''
+    tokenize each attribute value once and generate all the values having a prefix / suffix dropped.
+    :param values: a 2-d array of attribute values (records x attributes)
+    :return: the record positions, the attribute positions and the new values, ordered by record, attribute and cut
+    '''
+    record_pos = []
+    attr_pos = []
+    new_values = []
+    for t in range(values.shape[1]):
+        for i, attr_value in enumerate(values[:, t]):
+            tokens = str(attr_value).split()
+            for cut in range(1, len(tokens)):
+                new_values += [" ".join(tokens[cut:]),
+                               " ".join(tokens[:cut])]  # generate new values with prefix / suffix dropped
+            generated = 2 * max(len(tokens) - 1, 0)
+            record_pos += [i] * generated
+            attr_pos += [t] * generated
+    record_pos = np.array(record_pos, dtype=int)
+    attr_pos = np.array(attr_pos, dtype=int)
+    order = np.lexsort((attr_pos, record_pos))
+    return record_pos[order], attr_pos[order], np.array(new_values, dtype=object)[order]
+
+
+def generate_modified_records(source: pd.DataFrame, start_id: int = 0):
+    '''
+    generate copies of the records in a data source where a prefix / suffix has been dropped from one attribute.
+    :param source: the data source
+    :param start_id: the first id assigned to generated records (ids are kept as they are if 0)
+    :return: a pd.DataFrame of generated records, indexed as the records they have been generated from
+    '''
+    values = source.values
+    record_pos, attr_pos, new_values = drop_prefix_suffix(values)
+    if len(new_values) == 0:
+        return pd.DataFrame()
+    new_records = values[record_pos].astype(object)
+    new_records[np.arange(len(new_records)), attr_pos] = new_values
+    new_records_df = pd.DataFrame(new_records, columns=source.columns, index=source.index[record_pos])
+    if start_id > 0:
+        new_records_df['id'] = start_id + np.arange(len(new_records_df))
+    return new_records_df.infer_objects()
+
+
 def generate_modified(record, start_id: int = 0):
-    new_copies = []
-    t_len = len(record)
-    copy = record.copy()
-    for t in range(t_len):
-        attr_value = str(copy.get(t))
-        values = attr_value.split()
-        for cut in range(1, len(values)):
-            for new_val in [" ".join(values[cut:]),
-                            " ".join(values[:cut])]:  # generate new values with prefix / suffix dropped
-                new_copy = record.copy()
-                new_copy[t] = new_val  # substitute the new value with missing prefix / suffix on the target attribute
-                if start_id > 0:
-                    new_copy['id'] = len(new_copies) + start_id
-                new_copies.append(new_copy)
-    return new_copies
+    new_records_df = generate_modified_records(pd.DataFrame([record]), start_id=start_id)
+    return [new_records_df.iloc[i] for i in range(len(new_records_df))]
 
 
 WORD = re.compile(r'\w+')
@@ -236,68 +327,55 @@ def cs(text1, text2):
 
 def expand_copies(lprefix, lsource, r1, r2, rprefix, rsource):
     generated_df = pd.DataFrame()
-    new_copies_left = []
-    new_copies_right = []
+    new_copies_left = pd.DataFrame()
+    new_copies_right = pd.DataFrame()
     left = True
     for record in [r1, r2]:
-        r1_df = pd.DataFrame(data=[record.values], columns=record.index)
-        r2_df = pd.DataFrame(data=[record.values], columns=record.index)
-        r1_df.columns = list(map(lambda col: 'ltable_' + col, r1_df.columns))
-        r2_df.columns = list(map(lambda col: 'rtable_' + col, r2_df.columns))
-        r1r2c = pd.concat([r1_df, r2_df], axis=1)
-
-        original = r1r2c.iloc[0].copy()
+        r1r2c = get_row(record, record, lprefix=lprefix, rprefix=rprefix)
         t_len = int(len(r1r2c.columns) / 2)
+        # r1 copies are generated on the right side, r2 copies on the left side
+        if left:
+            prefix = rprefix
+            idn = rprefix + 'id'
+            offset = t_len
+            id_start = len(rsource)
+        else:
+            prefix = lprefix
+            idn = lprefix + 'id'
+            offset = 0
+            id_start = len(lsource)
+
+        original = r1r2c.values[0]
+        attr_values = original[offset:offset + t_len]
+        _, attr_pos, new_values = drop_prefix_suffix(attr_values.reshape(1, -1))
+        new_ids = id_start + np.arange(len(new_values))
+
+        new_rows = np.tile(original, (len(new_values), 1)).astype(object)
+        new_rows[np.arange(len(new_values)), offset + attr_pos] = new_values
+        new_rows_df = pd.DataFrame(new_rows, columns=r1r2c.columns)
+        new_rows_df[idn] = new_ids
+
+        new_records = new_rows_df.filter(regex='^' + prefix).copy()
+        if left:
+            new_copies_left = new_records
+        else:
+            new_copies_right = new_records
+
         # only used for reporting
+        new_rows_df['diff'] = [diff(str(attr_values[p]), v) for p, v in zip(attr_pos, new_values)]
+        new_rows_df['attr_name'] = r1r2c.columns[offset + attr_pos]
+        new_rows_df['attr_pos'] = offset + attr_pos
         r1r2c['diff'] = ''
         r1r2c['attr_name'] = ''
         r1r2c['attr_pos'] = ''
-        copy = original.copy()
-        for t in range(t_len):
-            if left:
-                t = t_len + t
-            attr_value = str(copy.get(t))
-            values = attr_value.split()
-            for cut in range(1, len(values)):
-                for new_val in [" ".join(values[cut:]),
-                                " ".join(values[:cut])]:  # generate new values with prefix / suffix dropped
-                    new_copy = original.copy()
-                    new_copy[
-                        t] = new_val  # substitute the new value with missing prefix / suffix on the target attribute
-                    if left:
-                        prefix = rprefix
-                        new_id = len(new_copies_left) + len(rsource)
-                        idn = 'rtable_id'
-                    else:
-                        prefix = lprefix
-                        idn = 'ltable_id'
-                        new_id = len(new_copies_right) + len(lsource)
-
-                    new_record = pd.DataFrame(new_copy).transpose().filter(regex='^' + prefix).iloc[0]
-                    new_record[idn] = new_id
-                    new_copy[idn] = new_id
-                    if left:
-                        new_copies_left.append(new_record)
-                    else:
-                        new_copies_right.append(new_record)
-
-                    # only used for reporting
-                    new_copy['diff'] = diff(attr_value, new_val)
-                    new_copy['attr_name'] = r1r2c.columns[t]
-                    new_copy['attr_pos'] = t
-
-                    r1r2c = r1r2c.append(new_copy, ignore_index=True)
-        if left:
-            r1r2c['id'] = "0@" + r1r2c[lprefix + 'id'].astype(str) + "#" + "1@" + r1r2c[
-                rprefix + 'id'].astype(str)
-            left = False
-        else:
-            r1r2c['id'] = "0@" + r1r2c[lprefix + 'id'].astype(str) + "#" + "1@" + r1r2c[
-                rprefix + 'id'].astype(str)
+        r1r2c = pd.concat([r1r2c, new_rows_df], ignore_index=True)
+        r1r2c['id'] = "0@" + r1r2c[lprefix + 'id'].astype(str) + "#" + "1@" + r1r2c[
+            rprefix + 'id'].astype(str)
+        left = False
 
         generated_df = pd.concat([generated_df, r1r2c], axis=0)
-    generated_records_left_df = pd.DataFrame(new_copies_left).rename(columns=lambda x: x[len(lprefix):])
-    generated_records_right_df = pd.DataFrame(new_copies_right).rename(columns=lambda x: x[len(rprefix):])
+    generated_records_left_df = new_copies_left.rename(columns=lambda x: x[len(lprefix):])
+    generated_records_right_df = new_copies_right.rename(columns=lambda x: x[len(rprefix):])
 
     return generated_df, generated_records_left_df, generated_records_right_df
 
@@ -1,4 +1,5 @@
 import os
+from collections import OrderedDict
 
 import pandas as pd
 import numpy as np
@@ -147,22 +148,45 @@ def data2Inputs(data, tokenizer, categorical=True):
     return table1, table2, labels
 
 
-# InPut: data = [(t1, t2),...], tokenizer = tokenizzatore per le tuple
+# InPut: data = [(t1, t2),...], tokenizer = tokenizzatore per le tuple, cache = token delle tuple già viste
 # OutPut: table1, table2 = matrici di tokens
-def data2InputsUnlabel(data, tokenizer):
+def data2InputsUnlabel(data, tokenizer, cache=None, cache_size=100000):
     # Tokenizza le tuple e prepara l'input per il modello
-    table1, table2 = [], []
-    for t1, t2 in data:
-        # Sperimentale: ordino gli attributi per lunghezza decrescente
-        # Attributi con molti tokens conengono più informazioni utili
-        table1.append(' '.join(str(t1)).replace(', ', ' '))
-        table2.append(' '.join(str(t2)).replace(', ', ' '))
-    table1 = tokenizer.texts_to_sequences(table1)
-    table1 = pad_sequences(table1, padding='post')
-    table2 = tokenizer.texts_to_sequences(table2)
-    table2 = pad_sequences(table2, padding='post')
+    if cache is None:
+        cache = OrderedDict()
+    table1 = records2sequences([t1 for t1, _ in data], tokenizer, cache, cache_size)
+    table2 = records2sequences([t2 for _, t2 in data], tokenizer, cache, cache_size)
+
+    return pad_np(table1), pad_np(table2)
+
+
+# InPut: records = [tupla,...], tokenizer, cache = {valori della tupla: tokens}
+# OutPut: lista di sequenze di tokens, una per tupla
+def records2sequences(records, tokenizer, cache, cache_size=100000):
+    keys = [tuple(str(v) for v in record) for record in records]
+    missing = list(dict.fromkeys(k for k in keys if k not in cache))
+    # Stessa serializzazione usata in addestramento (data2Inputs)
+    texts = [' '.join(k).replace(', ', ' ') for k in missing]
+    for k, seq in zip(missing, tokenizer.texts_to_sequences(texts)):
+        cache[k] = np.asarray(seq, dtype='int32')
+    res = []
+    for k in keys:
+        cache.move_to_end(k)
+        res.append(cache[k])
+    while len(cache) > cache_size:
+        cache.popitem(last=False)
+    return res
+
 
-    return table1, table2
+# InPut: lista di sequenze di tokens
+# OutPut: matrice di tokens con padding in coda (come pad_sequences(padding='post'))
+def pad_np(sequences):
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+    table = np.zeros((len(sequences), lengths.max() if len(sequences) > 0 else 0), dtype='int32')
+    mask = np.arange(table.shape[1]) < lengths[:, None]
+    if len(sequences) > 0 and lengths.sum() > 0:
+        table[mask] = np.concatenate(sequences)
+    return table
 
 
 # InPut: modello, nuovo output layer
@@ -304,9 +328,9 @@ def model_statistics(data, model, embeddings_model, tokenizer):
     return (precision, recall, fmeasure)
 
 
-def predict(data, model, embeddings_model, tokenizer):
+def predict(data, model, embeddings_model, tokenizer, cache=None):
     # Crea matrici di tokens e labels
-    table1, table2 = data2InputsUnlabel(data, tokenizer)
+    table1, table2 = data2InputsUnlabel(data, tokenizer, cache=cache)
 
     # Calcola inputs di embeddings
     emb1, emb2 = embeddings_model.predict([table1, table2])
@@ -461,22 +485,53 @@ def deeper_mojito_predict(predict_fn):
     return wrapper
 
 
-class DeepERModel(ERModel):
+_embeddings = {}
 
-    def __init__(self):
 
-        super(DeepERModel, self).__init__()
-        self.name = 'deeper'
-        if not os.path.exists('models/glove.6B.300d.txt'):
+def get_embeddings(embeddings_file='models/glove.6B.300d.txt'):
+    # Gli embeddings sono condivisi da tutti i modelli DeepER del processo
+    if embeddings_file not in _embeddings:
+        if not os.path.exists(embeddings_file):
             word_vectors = api.load("glove-wiki-gigaword-300")
-            word_vectors.save_word2vec_format('models/glove.6B.300d.txt', binary=False)
+            word_vectors.save_word2vec_format(embeddings_file, binary=False)
 
-        self.embeddings_index = init_embeddings_index('models/glove.6B.300d.txt')
-        emb_dim = len(self.embeddings_index['cat'])
+        embeddings_index = init_embeddings_index(embeddings_file)
+        emb_dim = len(embeddings_index['cat'])
+        embeddings_model, tokenizer = init_embeddings_model(embeddings_index)
+        _embeddings[embeddings_file] = (emb_dim, embeddings_model, tokenizer)
+    return _embeddings[embeddings_file]
 
-        self.embeddings_model, self.tokenizer = init_embeddings_model(self.embeddings_index)
 
-        self.model = init_DeepER_model(emb_dim)
+class DeepERModel(ERModel):
+
+    def __init__(self, lazy=False):
+
+        super(DeepERModel, self).__init__()
+        self.name = 'deeper'
+        # when lazy, the embeddings and the network are only built once they are needed
+        self._model = None
+        # tokens of the already seen records, keyed by their attribute values
+        self.record_cache = OrderedDict()
+        if not lazy:
+            self.model
+
+    @property
+    def embeddings_model(self):
+        return get_embeddings()[1]
+
+    @property
+    def tokenizer(self):
+        return get_embeddings()[2]
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = init_DeepER_model(get_embeddings()[0])
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
 
     def train(self, label_train_df, label_valid_df, DATASET_NAME):
 
@@ -529,7 +584,7 @@ class DeepERModel(ERModel):
             data = to_deeper_data(x.drop([c for c in ignore_columns if c in x.columns], axis=1))
             x_index = x.index
             x_copy = x.copy()
-        out = predict(data, self.model, self.embeddings_model, self.tokenizer)
+        out = predict(data, self.model, self.embeddings_model, self.tokenizer, cache=self.record_cache)
         out_df = pd.DataFrame(out, columns=['nomatch_score', 'match_score'])
         out_df.index = x_index
         res = pd.concat([x_copy, out_df], axis=1)
@@ -552,31 +607,18 @@ class DeepERModel(ERModel):
 
 
 def to_deeper_data(df: pd.DataFrame, ignore_columns=['id', 'ltable_id', 'rtable_id']):
-    res = []
     df = df.drop([c for c in ignore_columns if c in df.columns], axis=1)
-    for r in range(len(df)):
-        row = df.iloc[r]
-        lpd = row.filter(regex='^ltable_')
-        rpd = row.filter(regex='^rtable_')
-        if 'label' in row:
-            label = row['label']
-            res.append((lpd.values.astype('str'), rpd.values.astype('str'), label))
-        else:
-            res.append((lpd.values.astype('str'), rpd.values.astype('str')))
-    return res
+    lpd = df.filter(regex='^ltable_').astype('str').values
+    rpd = df.filter(regex='^rtable_').astype('str').values
+    if 'label' in df.columns:
+        return list(zip(lpd, rpd, df['label'].values))
+    return list(zip(lpd, rpd))
 
 
 def to_deeper_data_np(array: np.array):
-    res = []
     if array.shape[1] % 2 != 0:
-        columns = (array.shape[1] - 1) // 2 + 1
         start = 1
     else:
-        columns = (array.shape[1]) // 2 + 1
         start = 0
-    for r in range(len(array)):
-        row = array[r]
-        lpd = row[start:columns]
-        rpd = row[columns:]
-        res.append((lpd, rpd))
-    return res
+    columns = start + (array.shape[1] - start) // 2
+    return list(zip(array[:, start:columns], array[:, columns:]))
@@ -1,7 +1,6 @@
 import logging
 import os
-import random
-import string
+import time
 
 import numpy as np
 import pandas as pd
@@ -10,17 +9,19 @@ from scipy.sparse import csr_matrix
 from torch.utils.data import DataLoader
 
 from certa.models.emt.model import load_model
-from certa.models.emt.prediction import predict
-from certa.models.ditto.ditto import DittoModel, DittoDataset
+from certa.models.emt.prediction import predict_scores
+from certa.models.ditto.ditto import DittoModel, DittoDataset, quantize
+from certa.models.ditto.dataset import TokenBudgetBatchSampler
 from certa.models.ditto.knowledge import GeneralDKInjector, ProductDKInjector
-from certa.models.ditto.matcher import to_str
+from certa.models.ditto.matcher import to_str_batch
 from certa.models.emt.config import Config
-from certa.models.emt.data_loader import load_data, DataType
+from certa.models.emt.data_loader import load_data, load_dataframe, DataType
 from certa.models.emt.data_representation import DeepMatcherProcessor
 from certa.models.emt.evaluation import Evaluation
+from certa.models.emt.feature_extraction import get_fast_tokenizer
 from certa.models.emt.model import save_model
 from certa.models.emt.optimizer import build_optimizer
-from certa.models.emt.torch_initializer import initialize_gpu_seed
+from certa.models.emt.torch_initializer import initialize_gpu_seed, setup_cpu_threads
 from certa.models.emt.training import train
 from certa.models.ermodel import ERModel
 
@@ -28,6 +29,8 @@ BATCH_SIZE = 8
 
 MAX_SEQ_LENGTH = 250
 
+MAX_TOKENS = 16384
+
 
 def emt_mojito_predict(model):
     def wrapper(dataframe):
@@ -40,29 +43,45 @@ def emt_mojito_predict(model):
 
 class EMTERModel(ERModel):
 
-    def __init__(self, ditto=True, dk='product', summarizer=None):
+    def __init__(self, ditto=True, dk='product', summarizer=None, cpu_inference: bool = False,
+                 num_threads: int = None, num_interop_threads: int = None, dk_model: str = 'en_core_web_lg',
+                 lazy: bool = False):
         self.name = 'bert'
         self.ditto = ditto
+        # when enabled, loaded models are replaced by an int8 dynamically quantized copy run on cpu
+        self.cpu_inference = cpu_inference
+        if cpu_inference:
+            setup_cpu_threads(num_threads, num_interop_threads)
         super(EMTERModel, self).__init__()
         self.model_type = 'distilbert'
         config_class, model_class, tokenizer_class = Config().MODEL_CLASSES[self.model_type]
         config = config_class.from_pretrained('distilbert-base-uncased')
+        self.config = config
         self.tokenizer = tokenizer_class.from_pretrained('distilbert-base-uncased', do_lower_case=True)
-        device, n_gpu = initialize_gpu_seed(22)
+        # the batched (fast) tokenizer used by predict, built once rather than on each call
+        self.fast_tokenizer = get_fast_tokenizer(self.tokenizer)
+        # when lazy, the pre-trained weights are not instantiated since load replaces them anyway
+        self.model = None if lazy else self.init_model()
         if self.ditto:
-            self.model = DittoModel(lm=self.model_type, device=device)
             self.summarizer = summarizer
             if dk == 'product':
-                injector = ProductDKInjector(config, dk)
+                injector = ProductDKInjector(config, dk, model=dk_model)
             elif dk == 'general':
-                injector = GeneralDKInjector(config, '')
+                injector = GeneralDKInjector(config, '', model=dk_model)
             else:
                 injector = None
             self.injector = injector
-        else:
-            self.model = model_class.from_pretrained('distilbert-base-uncased', config=config)
+
+    def init_model(self):
+        device, n_gpu = initialize_gpu_seed(22)
+        if self.ditto:
+            return DittoModel(lm=self.model_type, device=device)
+        model_class = Config().MODEL_CLASSES[self.model_type][1]
+        return model_class.from_pretrained('distilbert-base-uncased', config=self.config)
 
     def train(self, label_train, label_valid, dataset_name, epochs=7):
+        if self.model is None:
+            self.model = self.init_model()
         try:
             device, n_gpu = initialize_gpu_seed(22)
             self.model = self.model.to(device)
@@ -160,7 +179,8 @@ class EMTERModel(ERModel):
 
         return float(p), float(r), float(f1)
 
-    def predict(self, x, given_columns=None, mojito=False, expand_dim=False, max_len=256, **kwargs):
+    def predict(self, x, given_columns=None, mojito=False, expand_dim=False, max_len=256, max_tokens=MAX_TOKENS,
+                **kwargs):
         if isinstance(x, csr_matrix):
             x = pd.DataFrame(data=np.zeros(x.shape))
             if given_columns is not None:
@@ -180,6 +200,9 @@ class EMTERModel(ERModel):
         if 'label' not in xc.columns:
             xc.insert(0, 'label', '')
         device, n_gpu = initialize_gpu_seed(22)
+        if self.cpu_inference:
+            # the quantized model only runs on cpu
+            device = 'cpu'
         if self.ditto:
             inputs = []
             for idx in range(len(xc)):
@@ -198,20 +221,20 @@ class EMTERModel(ERModel):
                     lrec = 'NaN'
                 if len(rrec) == 0:
                     rrec = 'NaN'
-                input_text = to_str(lrec, rrec, summarizer=self.summarizer, dk_injector=self.injector, max_len=max_len)
-                inputs.append(input_text)
+                inputs.append((lrec, rrec))
+            inputs = to_str_batch(inputs, summarizer=self.summarizer, dk_injector=self.injector, max_len=max_len)
             dataset = DittoDataset(inputs,
                                    max_len=max_len,
                                    lm=self.model_type)
+            batch_sampler = TokenBudgetBatchSampler(dataset.token_lengths(), max_tokens=max_tokens)
             iterator = DataLoader(dataset=dataset,
-                                  batch_size=len(dataset),
-                                  shuffle=False,
+                                  batch_sampler=batch_sampler,
                                   num_workers=0,
                                   collate_fn=DittoDataset.pad)
             # prediction
             all_probs = []
             all_logits = []
-            with torch.no_grad():
+            with torch.inference_mode():
                 for i, batch in enumerate(iterator):
                     x_in, _ = batch
                     logits = self.model(x_in)
@@ -221,7 +244,7 @@ class EMTERModel(ERModel):
 
             # threshold = 0.5
             # pred = [1 if p > threshold else 0 for p in all_probs]
-            xc['match_score'] = all_probs
+            xc['match_score'] = batch_sampler.restore(all_probs)
             xc['nomatch_score'] = 1 - xc['match_score']
             if isinstance(x, pd.DataFrame):
                 if 'id' in x.columns:
@@ -241,20 +264,12 @@ class EMTERModel(ERModel):
                     xc = full_df
             return xc
         else:
-            processor = DeepMatcherProcessor()
-            tmpf = "./{}.csv".format("".join([random.choice(string.ascii_lowercase) for _ in range(10)]))
-            xc.to_csv(tmpf)
-            examples = processor.get_test_examples_file(tmpf)
-            test_data_loader = load_data(examples,
-                                                                processor.get_labels(),
-                                                                self.tokenizer,
-                                                                MAX_SEQ_LENGTH,
-                                                                BATCH_SIZE,
-                                                                DataType.TEST, self.model_type)
-
-            simple_accuracy, f1, classification_report, predictions = predict(self.model, device,
-                                                                                                    test_data_loader)
-            os.remove(tmpf)
+            test_data_loader = load_dataframe(xc, self.fast_tokenizer, MAX_SEQ_LENGTH, BATCH_SIZE, self.model_type,
+                                              max_tokens=max_tokens)
+
+            scores, labels = predict_scores(self.model, device, test_data_loader, return_labels=True)
+            predictions = pd.DataFrame({'classes': np.argmax(scores, axis=1), 'labels': labels,
+                                        'nomatch_score': scores[:, 0], 'match_score': scores[:, 1]})
 
             predictions.index = np.arange(len(predictions))
             if mojito:
@@ -286,8 +301,11 @@ class EMTERModel(ERModel):
             self.model = ditto_model
         else:
             self.model, self.tokenizer = load_model(path, True)
+            self.fast_tokenizer = get_fast_tokenizer(self.tokenizer)
             device, n_gpu = initialize_gpu_seed(22)
             self.model = self.model.to(device)
+        if self.cpu_inference:
+            self.model = quantize(self.model)
         return self.model
 
     def save(self, path):
@@ -295,3 +313,36 @@ class EMTERModel(ERModel):
 
     def predict_proba(self, x, **kwargs):
         return self.predict(x, mojito=True, expand_dim=True)
+
+
+def benchmark_cpu_inference(model: EMTERModel, x: pd.DataFrame, repeats: int = 3, **kwargs):
+    '''
+    Compare the throughput and the match scores of the full precision model and of its int8 quantized copy on the same
+    inputs (e.g. the perturbations generated by CERTA).
+    :param model: an EMTERModel with a loaded full precision model
+    :param x: the record pairs to predict
+    :param repeats: the no. of times predictions are repeated for each model
+    :return: a dict with the rows predicted per second by each model, the speedup and the match score drift
+    '''
+    fp32_model = model.model
+    int8_model = quantize(fp32_model)
+    cpu_inference = model.cpu_inference
+    results = dict()
+    scores = dict()
+    try:
+        for name, m, inference_mode in [('fp32', fp32_model, False), ('int8', int8_model, True)]:
+            model.model = m
+            model.cpu_inference = inference_mode
+            t0 = time.perf_counter()
+            for _ in range(repeats):
+                scores[name] = model.predict(x.copy(), **kwargs)['match_score'].values.astype(float)
+            results[name + '_rows_per_sec'] = repeats * len(x) / (time.perf_counter() - t0)
+    finally:
+        model.model = fp32_model
+        model.cpu_inference = cpu_inference
+    drift = np.abs(scores['fp32'] - scores['int8'])
+    results['speedup'] = results['int8_rows_per_sec'] / results['fp32_rows_per_sec']
+    results['max_drift'] = float(drift.max()) if len(drift) > 0 else 0.0
+    results['mean_drift'] = float(drift.mean()) if len(drift) > 0 else 0.0
+    results['flipped'] = int(((scores['fp32'] > 0.5) != (scores['int8'] > 0.5)).sum())
+    return results
@@ -1,3 +1,7 @@
+import hashlib
+import os
+
+import numpy as np
 import torch
 
 from torch.utils import data
@@ -48,6 +52,7 @@ class DittoDataset(data.Dataset):
             self.augmenter = Augmenter()
         else:
             self.augmenter = None
+        self.encoded = None
 
 
     def __len__(self):
@@ -69,10 +74,13 @@ class DittoDataset(data.Dataset):
         right = self.pairs[idx][1]
 
         # left + right
-        x = self.tokenizer.encode(text=left,
-                                  text_pair=right,
-                                  max_length=self.max_len,
-                                  truncation=True)
+        if self.encoded is not None:
+            x = self.encoded[idx]
+        else:
+            x = self.tokenizer.encode(text=left,
+                                      text_pair=right,
+                                      max_length=self.max_len,
+                                      truncation=True)
 
         # augment if da is set
         if self.da is not None:
@@ -87,6 +95,49 @@ class DittoDataset(data.Dataset):
             return x, self.labels[idx]
 
 
+    def fingerprint(self):
+        """Return a digest of the pairs, the labels and the tokenization settings,
+        so that cached encodings are not reused once any of them changes.
+
+        Returns:
+            str: a hex digest
+        """
+        h = hashlib.sha1(('%s|%d|' % (self.tokenizer.name_or_path, self.max_len)).encode())
+        for (left, right), label in zip(self.pairs, self.labels):
+            h.update(('%s\t%s\t%d\n' % (left, right, label)).encode())
+        return h.hexdigest()
+
+    def pretokenize(self, cache_path=None):
+        """Tokenize all the pairs at once, optionally caching the encodings on disk.
+
+        Args:
+            cache_path (str, optional): the file storing the encoded pairs
+
+        Returns:
+            None
+        """
+        if self.encoded is None and cache_path is not None and os.path.exists(cache_path):
+            self.encoded = torch.load(cache_path)
+        self.token_lengths()
+        if cache_path is not None and not os.path.exists(cache_path):
+            os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+            torch.save(self.encoded, cache_path)
+
+    def token_lengths(self):
+        """Tokenize all the pairs at once and return their lengths.
+
+        The encoded pairs are cached and reused by __getitem__.
+
+        Returns:
+            List of int: the no. of tokens of each item
+        """
+        if self.encoded is None:
+            lefts, rights = zip(*self.pairs) if len(self.pairs) > 0 else ([], [])
+            self.encoded = self.tokenizer(list(lefts), list(rights),
+                                          max_length=self.max_len,
+                                          truncation=True)['input_ids']
+        return [len(x) for x in self.encoded]
+
     @staticmethod
     def pad(batch):
         """Merge a list of dataset items into a train/test batch
@@ -115,3 +166,83 @@ class DittoDataset(data.Dataset):
             return torch.LongTensor(x12), \
                    torch.LongTensor(y)
 
+
+class EpochRandomSampler(data.Sampler):
+    """Random sampler whose order only depends on a seed and the epoch, so that
+    an interrupted epoch can be resumed from any position"""
+
+    def __init__(self, size, seed=0):
+        """
+        Args:
+            size (int): the no. of items
+            seed (int, optional): the seed of the per-epoch permutations
+        """
+        self.size = size
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """Select the permutation of an epoch and the position it starts from.
+
+        Args:
+            epoch (int): the epoch
+            start (int, optional): the no. of items of the permutation to skip
+        """
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        order = np.random.default_rng([self.seed, self.epoch]).permutation(self.size)
+        return iter(order[self.start:].tolist())
+
+    def __len__(self):
+        return max(0, self.size - self.start)
+
+
+class TokenBudgetBatchSampler(data.Sampler):
+    """Batch sampler grouping items of similar length under a token budget"""
+
+    def __init__(self, lengths, max_tokens=16384, max_batch_size=None):
+        """Sort the items by length and split them into batches.
+
+        Args:
+            lengths (List of int): the no. of tokens of each item
+            max_tokens (int, optional): the max no. of (padded) tokens in a batch
+            max_batch_size (int, optional): the max no. of items in a batch
+        """
+        self.batches = []
+        current = []
+        longest = 0
+        for idx in np.argsort(lengths, kind='stable'):
+            length = lengths[idx]
+            if len(current) > 0 and (max(longest, length) * (len(current) + 1) > max_tokens or
+                                     (max_batch_size is not None and len(current) >= max_batch_size)):
+                self.batches.append(current)
+                current = []
+                longest = 0
+            current.append(int(idx))
+            longest = max(longest, length)
+        if len(current) > 0:
+            self.batches.append(current)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def restore(self, values):
+        """Put values computed batch by batch back in the original order of the items.
+
+        Args:
+            values (array-like): values in the order the batches were yielded
+
+        Returns:
+            np.ndarray: the values in the original order
+        """
+        values = np.asarray(values)
+        restored = np.empty_like(values)
+        if len(self.batches) > 0:
+            restored[np.concatenate(self.batches)] = values
+        return restored
@@ -1,3 +1,4 @@
+import copy
 import os
 import sys
 import torch
@@ -6,10 +7,9 @@ import torch.nn.functional as F
 import torch.optim as optim
 import random
 import numpy as np
-import sklearn.metrics as metrics
 import argparse
 
-from .dataset import DittoDataset
+from .dataset import DittoDataset, EpochRandomSampler
 from torch.utils import data
 from transformers import AutoModel, AdamW, get_linear_schedule_with_warmup
 from tensorboardX import SummaryWriter
@@ -61,20 +61,34 @@ class DittoModel(nn.Module):
         return self.fc(enc) # .squeeze() # .sigmoid()
 
 
-def evaluate(model, iterator, threshold=None):
-    """Evaluate a model on a validation/test dataset
+def quantize(model):
+    """Create an int8 dynamically quantized copy of a model for CPU inference
+
+    Args:
+        model (nn.Module): the (full precision) model
+
+    Returns:
+        nn.Module: the quantized copy of the model, on cpu and in eval mode
+    """
+    qmodel = torch.quantization.quantize_dynamic(copy.deepcopy(model).to('cpu'),
+                                                 {nn.Linear},
+                                                 dtype=torch.qint8)
+    if isinstance(qmodel, DittoModel):
+        qmodel.device = 'cpu'
+    return qmodel.eval()
+
+
+def predict_proba(model, iterator):
+    """Compute the match probabilities of a dataset
 
     Args:
         model (DMModel): the EM model
-        iterator (Iterator): the valid/test dataset iterator
-        threshold (float, optional): the threshold on the 0-class
+        iterator (Iterator): the dataset iterator
 
     Returns:
-        float: the F1 score
-        float (optional): if threshold is not provided, the threshold
-            value that gives the optimal F1
+        np.ndarray: the match probabilities
+        np.ndarray: the labels
     """
-    all_p = []
     all_y = []
     all_probs = []
     with torch.no_grad():
@@ -84,26 +98,79 @@ def evaluate(model, iterator, threshold=None):
             probs = logits.softmax(dim=1)[:, 1]
             all_probs += probs.cpu().numpy().tolist()
             all_y += y.cpu().numpy().tolist()
+    return np.array(all_probs), np.array(all_y)
 
-    if threshold is not None:
-        pred = [1 if p > threshold else 0 for p in all_probs]
-        f1 = metrics.f1_score(all_y, pred)
-        return f1
-    else:
-        best_th = 0.5
-        f1 = 0.0 # metrics.f1_score(all_y, all_p)
 
-        for th in np.arange(0.0, 1.0, 0.05):
-            pred = [1 if p > th else 0 for p in all_probs]
-            new_f1 = metrics.f1_score(all_y, pred)
-            if new_f1 > f1:
-                f1 = new_f1
-                best_th = th
+def f1_scores(probs, labels, thresholds):
+    """Compute the F1 score of the predictions (p > threshold) for many thresholds at once
 
-        return f1, best_th
+    Probabilities are sorted once, the no. of predicted and true positives
+    for each threshold are then obtained with cumulative sums.
 
+    Args:
+        probs (np.ndarray): the match probabilities
+        labels (np.ndarray): the labels
+        thresholds (np.ndarray): the thresholds on the 0-class
+
+    Returns:
+        np.ndarray: the F1 score for each threshold
+    """
+    probs = np.asarray(probs, dtype=float)
+    labels = np.asarray(labels, dtype=int)
+    order = np.argsort(probs, kind='stable')
+    sorted_probs = probs[order]
+    # positives among the k lowest probabilities
+    cum_pos = np.concatenate([[0], np.cumsum(labels[order])])
+    below = np.searchsorted(sorted_probs, thresholds, side='right')
+    predicted_pos = len(probs) - below
+    true_pos = cum_pos[-1] - cum_pos[below]
+    denominator = predicted_pos + cum_pos[-1]
+    return np.divide(2.0 * true_pos, denominator, out=np.zeros(len(below)), where=denominator > 0)
+
+
+def tune(probs, labels, thresholds=None):
+    """Find the threshold that gives the optimal F1
 
-def train_step(train_iter, model, optimizer, scheduler, hp):
+    Args:
+        probs (np.ndarray): the match probabilities
+        labels (np.ndarray): the labels
+        thresholds (np.ndarray, optional): the candidate thresholds
+
+    Returns:
+        float: the best F1 score
+        float: the threshold giving the best F1 (0.5 if no threshold gives a positive F1)
+    """
+    if thresholds is None:
+        thresholds = np.arange(0.0, 1.0, 0.05)
+    f1s = f1_scores(probs, labels, thresholds)
+    best = int(np.argmax(f1s))
+    if f1s[best] > 0:
+        return float(f1s[best]), thresholds[best]
+    return 0.0, 0.5
+
+
+def evaluate(model, iterator, threshold=None):
+    """Evaluate a model on a validation/test dataset
+
+    Args:
+        model (DMModel): the EM model
+        iterator (Iterator): the valid/test dataset iterator
+        threshold (float, optional): the threshold on the 0-class
+
+    Returns:
+        float: the F1 score
+        float (optional): if threshold is not provided, the threshold
+            value that gives the optimal F1
+    """
+    all_probs, all_y = predict_proba(model, iterator)
+
+    if threshold is not None:
+        return float(f1_scores(all_probs, all_y, np.array([threshold]))[0])
+    else:
+        return tune(all_probs, all_y)
+
+
+def train_step(train_iter, model, optimizer, scheduler, hp, scaler=None, checkpoint=None, first_batch=0):
     """Perform a single training step
 
     Args:
@@ -111,37 +178,62 @@ def train_step(train_iter, model, optimizer, scheduler, hp):
         model (DMModel): the model
         optimizer (Optimizer): the optimizer (Adam or AdamW)
         scheduler (LRScheduler): learning rate scheduler
-        hp (Namespace): other hyper-parameters (e.g., fp16)
+        hp (Namespace): other hyper-parameters (e.g., fp16, accumulation_steps)
+        scaler (GradScaler, optional): the loss scaler for fp16 training on gpu
+        checkpoint (function, optional): called with the no. of batches seen
+            after each optimizer step
+        first_batch (int, optional): the position in the epoch of the first
+            batch of train_iter (when resuming)
 
     Returns:
         None
     """
     criterion = nn.CrossEntropyLoss()
     # criterion = nn.MSELoss()
-    for i, batch in enumerate(train_iter):
-        optimizer.zero_grad()
-
-        if len(batch) == 2:
-            x, y = batch
-            prediction = model(x)
-        else:
-            x1, x2, y = batch
-            prediction = model(x1, x2)
-
-        loss = criterion(prediction, y.to(model.device))
-
-        if hp.fp16:
-            with amp.scale_loss(loss, optimizer) as scaled_loss:
-                scaled_loss.backward()
+    accumulation_steps = max(1, getattr(hp, 'accumulation_steps', 1))
+    device_type, amp_dtype = autocast_type(model.device)
+    # the batches preceding first_batch are skipped by the sampler, not loaded
+    num_batches = first_batch + len(train_iter)
+    optimizer.zero_grad()
+    for i, batch in enumerate(train_iter, start=first_batch):
+        # bfloat16 on cpu, float16 on gpu
+        with torch.autocast(device_type=device_type, dtype=amp_dtype, enabled=hp.fp16):
+            if len(batch) == 2:
+                x, y = batch
+                prediction = model(x)
+            else:
+                x1, x2, y = batch
+                prediction = model(x1, x2)
+
+            loss = criterion(prediction, y.to(model.device)) / accumulation_steps
+
+        if scaler is not None:
+            scaler.scale(loss).backward()
         else:
             loss.backward()
-        optimizer.step()
-        scheduler.step()
+
+        if (i + 1) % accumulation_steps == 0 or (i + 1) == num_batches:
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            scheduler.step()
+            optimizer.zero_grad()
+            if checkpoint is not None:
+                checkpoint(i + 1)
         if i % 10 == 0: # monitoring
-            print(f"step: {i}, loss: {loss.item()}")
+            print(f"step: {i}, loss: {loss.item() * accumulation_steps}")
         del loss
 
 
+def autocast_type(device):
+    """Return the autocast device type and the reduced precision type for a device"""
+    if str(device).startswith('cuda'):
+        return 'cuda', torch.float16
+    return 'cpu', torch.bfloat16
+
+
 def train(trainset, validset, testset, run_tag, hp):
     """Train and evaluate the model
 
@@ -151,51 +243,115 @@ def train(trainset, validset, testset, run_tag, hp):
         testset (DittoDataset): the test set
         run_tag (str): the tag of the run
         hp (Namespace): Hyper-parameters (e.g., batch_size,
-                        learning rate, fp16)
+                        learning rate, fp16, accumulation_steps,
+                        num_workers, checkpoint_every, resume)
 
     Returns:
         None
     """
     padder = trainset.pad
+    num_workers = getattr(hp, 'num_workers', 0)
+    accumulation_steps = max(1, getattr(hp, 'accumulation_steps', 1))
+    checkpoint_every = getattr(hp, 'checkpoint_every', 0)
+    cache_dir = getattr(hp, 'cache_dir', None)
+
+    # tokenize once in the main process, workers only pad the cached encodings
+    for name, dataset in [('train', trainset), ('valid', validset), ('test', testset)]:
+        cache_path = None
+        if cache_dir is not None:
+            # the contents and max_len are part of the name, stale encodings are never loaded
+            cache_path = os.path.join(cache_dir, '%s_%s_%s_%d_%s.pt' % (hp.task, name, hp.lm, dataset.max_len,
+                                                                      dataset.fingerprint()[:16]))
+        dataset.pretokenize(cache_path)
+
+    directory = os.path.join(hp.logdir, hp.task)
+    checkpoint_path = os.path.join(directory, 'checkpoint.pt')
+    resume = getattr(hp, 'resume', False) and os.path.exists(checkpoint_path)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    ckpt = torch.load(checkpoint_path, map_location=device) if resume else None
+
+    # the order of each epoch is fixed by the seed (saved in the checkpoints),
+    # so that a resumed epoch visits exactly the items not seen yet
+    seed = ckpt.get('seed') if ckpt is not None else None
+    if seed is None:
+        seed = getattr(hp, 'seed', None)
+    if seed is None:
+        seed = int(torch.randint(2 ** 31 - 1, ()).item())
+    train_sampler = EpochRandomSampler(len(trainset), seed=seed)
+
     # create the DataLoaders
     train_iter = data.DataLoader(dataset=trainset,
                                  batch_size=hp.batch_size,
-                                 shuffle=True,
-                                 num_workers=0,
+                                 sampler=train_sampler,
+                                 num_workers=num_workers,
+                                 persistent_workers=num_workers > 0,
                                  collate_fn=padder)
     valid_iter = data.DataLoader(dataset=validset,
                                  batch_size=hp.batch_size*16,
                                  shuffle=False,
-                                 num_workers=0,
+                                 num_workers=num_workers,
                                  collate_fn=padder)
     test_iter = data.DataLoader(dataset=testset,
                                  batch_size=hp.batch_size*16,
                                  shuffle=False,
-                                 num_workers=0,
+                                 num_workers=num_workers,
                                  collate_fn=padder)
 
     # initialize model, optimizer, and LR scheduler
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
     model = DittoModel(device=device,
                        lm=hp.lm,
                        alpha_aug=hp.alpha_aug)
+    model = model.to(device)
     optimizer = AdamW(model.parameters(), lr=hp.lr)
 
-    if hp.fp16:
-        model, optimizer = amp.initialize(model, optimizer, opt_level='O2')
-    num_steps = (len(trainset) // hp.batch_size) * hp.n_epochs
+    # loss scaling is only needed for float16 (gpu), bfloat16 (cpu) has the float32 range
+    scaler = None
+    if hp.fp16 and device == 'cuda':
+        scaler = torch.cuda.amp.GradScaler()
+    num_steps = (len(trainset) // (hp.batch_size * accumulation_steps)) * hp.n_epochs
     scheduler = get_linear_schedule_with_warmup(optimizer,
                                                 num_warmup_steps=0,
                                                 num_training_steps=num_steps)
 
+    first_epoch = 1
+    skip_batches = 0
+    best_dev_f1 = best_test_f1 = 0.0
+    if ckpt is not None:
+        model.load_state_dict(ckpt['model'])
+        optimizer.load_state_dict(ckpt['optimizer'])
+        scheduler.load_state_dict(ckpt['scheduler'])
+        if scaler is not None and ckpt.get('scaler') is not None:
+            scaler.load_state_dict(ckpt['scaler'])
+        first_epoch = ckpt['epoch']
+        skip_batches = ckpt['batches']
+        best_dev_f1 = ckpt['best_dev_f1']
+        best_test_f1 = ckpt['best_test_f1']
+        print(f"resuming from epoch {first_epoch}, batch {skip_batches}")
+
     # logging with tensorboardX
     writer = SummaryWriter(log_dir=hp.logdir)
 
-    best_dev_f1 = best_test_f1 = 0.0
-    for epoch in range(1, hp.n_epochs+1):
+    for epoch in range(first_epoch, hp.n_epochs+1):
+        def save_checkpoint(batches, epoch=epoch):
+            # periodic resumable checkpoint
+            if checkpoint_every > 0 and (batches // accumulation_steps) % checkpoint_every == 0:
+                os.makedirs(directory, exist_ok=True)
+                torch.save({'model': model.state_dict(),
+                            'optimizer': optimizer.state_dict(),
+                            'scheduler': scheduler.state_dict(),
+                            'scaler': scaler.state_dict() if scaler is not None else None,
+                            'epoch': epoch,
+                            'batches': batches,
+                            'seed': seed,
+                            'best_dev_f1': best_dev_f1,
+                            'best_test_f1': best_test_f1}, checkpoint_path)
+
         # train
         model.train()
-        train_step(train_iter, model, optimizer, scheduler, hp)
+        train_sampler.set_epoch(epoch, start=skip_batches * hp.batch_size)
+        train_step(train_iter, model, optimizer, scheduler, hp, scaler=scaler,
+                   checkpoint=save_checkpoint, first_batch=skip_batches)
+        skip_batches = 0
 
         # eval
         model.eval()
@@ -207,7 +363,6 @@ def train(trainset, validset, testset, run_tag, hp):
             best_test_f1 = test_f1
             if hp.save_model:
                 # create the directory if not exist
-                directory = os.path.join(hp.logdir, hp.task)
                 if not os.path.exists(directory):
                     os.makedirs(directory)
 
@@ -226,4 +381,7 @@ def train(trainset, validset, testset, run_tag, hp):
                    't_f1': test_f1}
         writer.add_scalars(run_tag, scalars, epoch)
 
+        # the next epoch starts from scratch when resuming
+        save_checkpoint(0, epoch=epoch + 1)
+
     writer.close()
@@ -4,7 +4,18 @@ import sys
 import os
 import spacy
 
-from collections import Counter
+from collections import Counter, OrderedDict
+
+_pipelines = {}
+
+
+def load_pipeline(model, disable):
+    """Load a spacy pipeline once per process and share it between injectors."""
+    key = (model, tuple(disable))
+    if key not in _pipelines:
+        _pipelines[key] = spacy.load(model, disable=list(disable))
+    return _pipelines[key]
+
 
 class DKInjector:
     """Inject domain knowledge to the data entry pairs.
@@ -12,17 +23,62 @@ class DKInjector:
     Attributes:
         config: the task configuration
         name: the injector name
+        model: the spacy pipeline to load
+        disable: the pipeline components to disable when loading it
+        batch_size: the no. of entries per batch in transform_many
+        n_process: the no. of processes used by transform_many
+        cache_size: the max no. of transformed entries to keep
     """
-    def __init__(self, config, name):
+    def __init__(self, config, name, model='en_core_web_lg', disable=('tagger', 'parser'),
+                 batch_size=256, n_process=1, cache_size=100000):
         self.config = config
         self.name = name
+        self.model = model
+        self.disable = list(disable)
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.nlp = None
         self.initialize()
 
     def initialize(self):
         pass
 
     def transform(self, entry):
-        return entry
+        if self.nlp is None:
+            return entry
+        return self.transform_many([entry])[0]
+
+    def transform_doc(self, doc):
+        return doc.text
+
+    def transform_many(self, entries):
+        """Transform a list of data entries.
+
+        The entries which are not cached are run through the spacy pipeline in batches.
+
+        Args:
+            entries (list of str): the serialized data entries
+
+        Returns:
+            list of str: the transformed entries
+        """
+        if self.nlp is None:
+            return [self.transform(entry) for entry in entries]
+        res = {}
+        for entry in entries:
+            if entry in self.cache:
+                self.cache.move_to_end(entry)
+                res[entry] = self.cache[entry]
+        missing = list(dict.fromkeys(entry for entry in entries if entry not in res))
+        docs = self.nlp.pipe(missing, batch_size=self.batch_size, n_process=self.n_process)
+        for entry, doc in zip(missing, docs):
+            res[entry] = self.transform_doc(doc)
+            self.cache[entry] = res[entry]
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return [res[entry] for entry in entries]
 
     def transform_file(self, input_fn, overwrite=False):
         """Transform all lines of a tsv file.
@@ -40,13 +96,12 @@ class DKInjector:
         if not os.path.exists(out_fn) or \
             os.stat(out_fn).st_size == 0 or overwrite:
 
+            lines = [line.split('\t') for line in open(input_fn)]
+            lines = [LL for LL in lines if len(LL) == 3]
+            entries = self.transform_many([LL[0] for LL in lines] + [LL[1] for LL in lines])
             with open(out_fn, 'w') as fout:
-                for line in open(input_fn):
-                    LL = line.split('\t')
-                    if len(LL) == 3:
-                        entry0 = self.transform(LL[0])
-                        entry1 = self.transform(LL[1])
-                        fout.write(entry0 + '\t' + entry1 + '\t' + LL[2])
+                for LL, entry0, entry1 in zip(lines, entries[:len(lines)], entries[len(lines):]):
+                    fout.write(entry0 + '\t' + entry1 + '\t' + LL[2])
         return out_fn
 
 
@@ -55,22 +110,21 @@ class ProductDKInjector(DKInjector):
     """
     def initialize(self):
         """Initialize spacy"""
-        self.nlp = spacy.load('en_core_web_lg')
+        self.nlp = load_pipeline(self.model, self.disable)
 
-    def transform(self, entry):
+    def transform_doc(self, doc):
         """Transform a data entry.
 
         Use NER to regconize the product-related named entities and
         mark them in the sequence. Normalize the numbers into the same format.
 
         Args:
-            entry (str): the serialized data entry
+            doc (Doc): the serialized data entry processed by spacy
 
         Returns:
             str: the transformed entry
         """
         res = ''
-        doc = self.nlp(entry, disable=['tagger', 'parser'])
         ents = doc.ents
         start_indices = {}
         end_indices = {}
@@ -112,22 +166,21 @@ class GeneralDKInjector(DKInjector):
     """
     def initialize(self):
         """Initialize spacy"""
-        self.nlp = spacy.load('en_core_web_lg')
+        self.nlp = load_pipeline(self.model, self.disable)
 
-    def transform(self, entry):
+    def transform_doc(self, doc):
         """Transform a data entry.
 
         Use NER to regconize the product-related named entities and
         mark them in the sequence. Normalize the numbers into the same format.
 
         Args:
-            entry (str): the serialized data entry
+            doc (Doc): the serialized data entry processed by spacy
 
         Returns:
             str: the transformed entry
         """
         res = ''
-        doc = self.nlp(entry, disable=['tagger', 'parser'])
         ents = doc.ents
         start_indices = {}
         end_indices = {}
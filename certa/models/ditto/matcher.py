@@ -10,7 +10,6 @@ import re
 import time
 import argparse
 import sys
-import sklearn
 import traceback
 
 from torch.utils import data
@@ -47,26 +46,46 @@ def to_str(ent1, ent2, summarizer=None, max_len=256, dk_injector=None):
     Returns:
         string: the serialized version
     """
-    content = ''
-    for ent in [ent1, ent2]:
-        if isinstance(ent, str):
-            content += ent
-        else:
-            for attr in ent.keys():
-                content += 'COL %s VAL %s ' % (attr, ent[attr])
-        content += '\t'
+    return to_str_batch([(ent1, ent2)], summarizer, max_len, dk_injector)[0]
+
+
+def to_str_batch(pairs, summarizer=None, max_len=256, dk_injector=None):
+    """Serialize a list of pairs of data entries, summarizing them in one batch
+
+    Args:
+        pairs (list of tuple): the pairs of data entries
+        summarizer (Summarizer, optional): the summarization module
+        max_len (int, optional): the max sequence length
+        dk_injector (DKInjector, optional): the domain-knowledge injector
 
-    content += '0'
+    Returns:
+        list of string: the serialized versions
+    """
+    contents = []
+    for ent1, ent2 in pairs:
+        content = ''
+        for ent in [ent1, ent2]:
+            if isinstance(ent, str):
+                content += ent
+            else:
+                for attr in ent.keys():
+                    content += 'COL %s VAL %s ' % (attr, ent[attr])
+            content += '\t'
+
+        content += '0'
+        contents.append(content)
 
     if summarizer is not None:
-        content = summarizer.transform(content, max_len=max_len)
+        contents = summarizer.transform_batch(contents, max_len=max_len)
 
-    new_ent1, new_ent2, _ = content.split('\t')
+    ents = [content.split('\t')[:2] for content in contents]
+    new_ents1 = [ent[0] for ent in ents]
+    new_ents2 = [ent[1] for ent in ents]
     if dk_injector is not None:
-        new_ent1 = dk_injector.transform(new_ent1)
-        new_ent2 = dk_injector.transform(new_ent2)
+        new_ents = dk_injector.transform_many(new_ents1 + new_ents2)
+        new_ents1, new_ents2 = new_ents[:len(ents)], new_ents[len(ents):]
 
-    return new_ent1 + '\t' + new_ent2 + '\t0'
+    return [new_ent1 + '\t' + new_ent2 + '\t0' for new_ent1, new_ent2 in zip(new_ents1, new_ents2)]
 
 
 def classify(sentence_pairs, model,
@@ -170,17 +189,16 @@ def predict(input_path, output_path, config,
     start_time = time.time()
     with jsonlines.open(input_path) as reader,\
          jsonlines.open(output_path, mode='w') as writer:
-        pairs = []
         rows = []
         for idx, row in tqdm(enumerate(reader)):
-            pairs.append(to_str(row[0], row[1], summarizer, max_len, dk_injector))
             rows.append(row)
-            if len(pairs) == batch_size:
+            if len(rows) == batch_size:
+                pairs = to_str_batch([(row[0], row[1]) for row in rows], summarizer, max_len, dk_injector)
                 process_batch(rows, pairs, writer)
-                pairs.clear()
                 rows.clear()
 
-        if len(pairs) > 0:
+        if len(rows) > 0:
+            pairs = to_str_batch([(row[0], row[1]) for row in rows], summarizer, max_len, dk_injector)
             process_batch(rows, pairs, writer)
 
     run_time = time.time() - start_time
@@ -223,31 +241,9 @@ def tune_threshold(config, model, hp):
 
     # acc, prec, recall, f1, v_loss, th = eval_classifier(model, valid_iter,
     #                                                     get_threshold=True)
+    # the threshold is tuned on the scores of a single pass over the validation set
     f1, th = evaluate(model, valid_iter, threshold=None)
-
-    # verify F1
-    set_seed(123)
-    predict(validset, "tmp.jsonl", config, model,
-            summarizer=summarizer,
-            max_len=hp.max_len,
-            lm=hp.lm,
-            dk_injector=injector,
-            threshold=th)
-
-    predicts = []
-    with jsonlines.open("tmp.jsonl", mode="r") as reader:
-        for line in reader:
-            predicts.append(int(line['match']))
-    os.system("rm tmp.jsonl")
-
-    labels = []
-    with open(validset) as fin:
-        for line in fin:
-            labels.append(int(line.split('\t')[-1]))
-
-    real_f1 = sklearn.metrics.f1_score(labels, predicts)
     print("load_f1 =", f1)
-    print("real_f1 =", real_f1)
 
     return th
 
@@ -2,39 +2,61 @@ import numpy as np
 import csv
 import sys
 import os
+import json
 
 from sklearn.feature_extraction.text import TfidfVectorizer
 from collections import Counter
 from nltk.corpus import stopwords
 
+from certa.cache import sources_fingerprint
 from .dataset import get_tokenizer
 
 stopwords = set(stopwords.words('english'))
 
+_indexes = {}
+
+
 class Summarizer:
     """To summarize a data entry pair into length up to the max sequence length.
 
     Args:
-        task_config (Dictionary): the task configuration
+        lsource (DataFrame): the left data source
+        rsource (DataFrame): the right data source
         lm (string): the language model (bert, albert, or distilbert)
+        index_path (string, optional): the directory of a persistent index, built
+            on first use and memory-mapped afterwards (it is rebuilt when it was
+            saved for different sources or a different lm)
 
     Attributes:
-        config (Dictionary): the task configuration
         tokenizer (Tokenizer): a tokenizer from the huggingface library
+        vocab (Dictionary): the tf-idf vocabulary
+        idf (ndarray): the idf of each vocabulary term
+        lengths (ndarray): the wordpiece length of each vocabulary term
     """
-    def __init__(self, lsource, rsource, lm):
+    def __init__(self, lsource, rsource, lm, index_path=None):
         self.lsource = lsource
         self.rsource = rsource
         self.tokenizer = get_tokenizer(lm=lm)
         self.len_cache = {}
-
-        # build the tfidf index
-        self.build_index()
+        self.fingerprint = sources_fingerprint(lsource, rsource) + '|' + str(lm) if index_path is not None else None
+
+        if index_path is not None and index_path in _indexes and _indexes[index_path][0] == self.fingerprint:
+            _, self.vocab, self.idf, self.lengths = _indexes[index_path]
+        elif index_path is not None and self.index_fingerprint(index_path) == self.fingerprint:
+            self.load_index(index_path)
+        else:
+            # build the tfidf index
+            self.build_index()
+            if index_path is not None:
+                self.save_index(index_path)
+        if index_path is not None:
+            _indexes[index_path] = (self.fingerprint, self.vocab, self.idf, self.lengths)
 
     def build_index(self):
         """Build the idf index.
 
-        Store the index and vocabulary in self.idf and self.vocab.
+        Store the index and vocabulary in self.idf and self.vocab, and the wordpiece
+        length of each term in self.lengths.
         """
 
         content = self.lsource.drop(['id'], axis=1).astype(str).values.flatten().tolist()
@@ -48,16 +70,71 @@ class Summarizer:
         vectorizer = TfidfVectorizer().fit(content)
         self.vocab = vectorizer.vocabulary_
         self.idf = vectorizer.idf_
+        terms = sorted(self.vocab, key=self.vocab.get)
+        self.lengths = np.array(self.get_lens(terms), dtype=np.int32)
+
+    def save_index(self, index_path):
+        """Save the vocabulary, the idf array and the wordpiece length table.
+
+        Args:
+            index_path (str): the index directory
+        """
+        os.makedirs(index_path, exist_ok=True)
+        terms = sorted(self.vocab, key=self.vocab.get)
+        with open(os.path.join(index_path, 'vocab.json'), 'w') as fout:
+            json.dump(terms, fout)
+        np.save(os.path.join(index_path, 'idf.npy'), self.idf)
+        np.save(os.path.join(index_path, 'lengths.npy'), self.lengths)
+        # written last, an index without it (e.g. interrupted while saving) is rebuilt
+        with open(os.path.join(index_path, 'fingerprint.json'), 'w') as fout:
+            json.dump(self.fingerprint, fout)
+
+    @staticmethod
+    def index_fingerprint(index_path):
+        """Return the fingerprint of the sources and lm an index was built for.
+
+        Args:
+            index_path (str): the index directory
+
+        Returns:
+            str: the fingerprint, None if there is no (complete) index
+        """
+        path = os.path.join(index_path, 'fingerprint.json')
+        if not os.path.exists(path) or not os.path.exists(os.path.join(index_path, 'idf.npy')):
+            return None
+        with open(path) as fin:
+            return json.load(fin)
+
+    def load_index(self, index_path):
+        """Load an index saved by save_index, memory-mapping the arrays.
+
+        Args:
+            index_path (str): the index directory
+        """
+        with open(os.path.join(index_path, 'vocab.json')) as fin:
+            self.vocab = {term: i for i, term in enumerate(json.load(fin))}
+        self.idf = np.load(os.path.join(index_path, 'idf.npy'), mmap_mode='r')
+        self.lengths = np.load(os.path.join(index_path, 'lengths.npy'), mmap_mode='r')
 
     def get_len(self, word):
         """Return the sentence_piece length of a token.
         """
+        if word in self.vocab:
+            return int(self.lengths[self.vocab[word]])
         if word in self.len_cache:
             return self.len_cache[word]
         length = len(self.tokenizer.tokenize(word))
         self.len_cache[word] = length
         return length
 
+    def get_lens(self, words):
+        """Return the sentence_piece lengths of a list of tokens, tokenizing them in one call.
+        """
+        if len(words) == 0:
+            return []
+        ids = self.tokenizer(list(words), add_special_tokens=False)['input_ids']
+        return [len(x) for x in ids]
+
     def transform(self, row, max_len=128):
         """Summarize one single example.
 
@@ -70,45 +147,81 @@ class Summarizer:
         Returns:
             str: the summarized example
         """
-        sentA, sentB, label = row.strip().split('\t')
-        res = ''
-        cnt = Counter()
-        for sent in [sentA, sentB]:
-            tokens = sent.split(' ')
-            for token in tokens:
-                if token not in ['COL', 'VAL'] and \
-                   token not in stopwords:
-                    if token in self.vocab:
-                        cnt[token] += self.idf[self.vocab[token]]
-
-        for sent in [sentA, sentB]:
-            token_cnt = Counter(sent.split(' '))
-            total_len = token_cnt['COL'] + token_cnt['VAL']
-
-            subset = Counter()
-            for token in set(token_cnt.keys()):
-                subset[token] = cnt[token]
-            subset = subset.most_common(max_len)
-
-            topk_tokens_copy = set([])
-            for word, _ in subset:
-                bert_len = self.get_len(word)
-                if total_len + bert_len > max_len:
-                    break
-                total_len += bert_len
-                topk_tokens_copy.add(word)
-
-            num_tokens = 0
-            for token in sent.split(' '):
-                if token in ['COL', 'VAL']:
-                    res += token + ' '
-                elif token in topk_tokens_copy:
-                    res += token + ' '
-                    topk_tokens_copy.remove(token)
-
-            res += '\t'
-
-        res += label + '\n'
+        return self.transform_batch([row], max_len=max_len)[0]
+
+    def transform_batch(self, rows, max_len=128):
+        """Summarize a list of examples.
+
+        The idf scores and wordpiece lengths are looked up once for the distinct
+        tokens of the whole batch.
+
+        Args:
+            rows (list of str): matching examples of two data entries and a binary label,
+                separated by tab
+            max_len (int, optional): the maximum sequence length to be summarized to
+
+        Returns:
+            list of str: the summarized examples
+        """
+        token_ids = {}
+        splits = []
+        for row in rows:
+            sentA, sentB, label = row.strip().split('\t')
+            sents = []
+            for sent in [sentA, sentB]:
+                tokens = sent.split(' ')
+                sents.append((tokens, np.array([token_ids.setdefault(t, len(token_ids)) for t in tokens],
+                                               dtype=np.int64)))
+            splits.append((sents, label))
+
+        tokens = list(token_ids)
+        scores = np.zeros(len(tokens))
+        lengths = np.zeros(len(tokens), dtype=np.int64)
+        unknown = []
+        for i, token in enumerate(tokens):
+            if token in self.vocab:
+                lengths[i] = self.lengths[self.vocab[token]]
+                if token not in ['COL', 'VAL'] and token not in stopwords:
+                    scores[i] = self.idf[self.vocab[token]]
+            elif token in self.len_cache:
+                lengths[i] = self.len_cache[token]
+            else:
+                unknown.append(i)
+        for i, length in zip(unknown, self.get_lens([tokens[i] for i in unknown])):
+            self.len_cache[tokens[i]] = length
+            lengths[i] = length
+        markers = np.array([token_ids.get('COL', -1), token_ids.get('VAL', -1)])
+
+        res = []
+        for sents, label in splits:
+            pair_ids = np.concatenate([ids for _, ids in sents])
+            pair_unique, inverse = np.unique(pair_ids, return_inverse=True)
+            cnt = np.bincount(inverse, weights=scores[pair_ids], minlength=len(pair_unique))
+            out = ''
+            for tokens_, ids in sents:
+                unique, first = np.unique(ids, return_index=True)
+                total_len = np.isin(ids, markers).sum()
+
+                # highest tf-idf first, ties by position
+                order = np.argsort(first, kind='stable')
+                unique = unique[order]
+                weights = cnt[np.searchsorted(pair_unique, unique)]
+                unique = unique[np.argsort(-weights, kind='stable')][:max_len]
+                fits = total_len + np.cumsum(lengths[unique]) <= max_len
+                keep = unique[:np.argmin(fits) if not fits.all() else len(fits)]
+
+                topk_tokens_copy = set(keep.tolist())
+                for token, tid in zip(tokens_, ids.tolist()):
+                    if token in ['COL', 'VAL']:
+                        out += token + ' '
+                    elif tid in topk_tokens_copy:
+                        out += token + ' '
+                        topk_tokens_copy.remove(tid)
+
+                out += '\t'
+
+            out += label + '\n'
+            res.append(out)
         return res
 
     def transform_file(self, input_fn, max_len=256, overwrite=False):
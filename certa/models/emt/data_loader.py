@@ -2,9 +2,12 @@ from enum import Enum
 
 import torch
 from torch.utils.data import TensorDataset, RandomSampler, DataLoader, SequentialSampler
+from torch.utils.data.dataloader import default_collate
+
+from certa.models.ditto.dataset import TokenBudgetBatchSampler
 
 from certa.models.emt.logging_customized import setup_logging
-from certa.models.emt.feature_extraction import convert_examples_to_features
+from certa.models.emt.feature_extraction import convert_examples_to_features, convert_dataframe_to_features
 
 setup_logging()
 
@@ -15,7 +18,20 @@ class DataType(Enum):
     TEST = "Test"
 
 
-def load_data(examples, label_list, tokenizer, max_seq_length, batch_size, data_type: DataType, model_type, output_mode="classification"):
+def trim_padding(pad_on_left: bool = False):
+    # drop the padding columns shared by all the items of a batch
+    def collate(batch):
+        input_ids, input_mask, segment_ids, label_ids = default_collate(batch)
+        max_len = max(int(input_mask.sum(dim=1).max()), 1)
+        if pad_on_left:
+            return input_ids[:, -max_len:], input_mask[:, -max_len:], segment_ids[:, -max_len:], label_ids
+        return input_ids[:, :max_len], input_mask[:, :max_len], segment_ids[:, :max_len], label_ids
+
+    return collate
+
+
+def load_data(examples, label_list, tokenizer, max_seq_length, batch_size, data_type: DataType, model_type,
+              output_mode="classification", max_tokens: int = None):
     features = convert_examples_to_features(examples,
                                             label_list,
                                             max_seq_length,
@@ -38,9 +54,32 @@ def load_data(examples, label_list, tokenizer, max_seq_length, batch_size, data_
     all_label_ids = torch.tensor([f.label_id for f in features], dtype=torch.long)
     data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
 
+    if data_type != DataType.TRAINING and max_tokens is not None:
+        # length bucketed batches, padded to their longest item
+        lengths = all_input_mask.sum(dim=1).tolist()
+        batch_sampler = TokenBudgetBatchSampler(lengths, max_tokens=max_tokens)
+        return DataLoader(data, batch_sampler=batch_sampler,
+                          collate_fn=trim_padding(pad_on_left=bool(model_type in ['xlnet'])))
+
     if data_type == DataType.TRAINING:
         sampler = RandomSampler(data)
     else:
         sampler = SequentialSampler(data)
 
     return DataLoader(data, sampler=sampler, batch_size=batch_size)
+
+
+def load_dataframe(df, tokenizer, max_seq_length, batch_size, model_type, max_tokens: int = None,
+                   lprefix='ltable_', rprefix='rtable_'):
+    pad_on_left = bool(model_type in ['xlnet'])
+    input_ids, input_mask, segment_ids, label_ids = convert_dataframe_to_features(df, tokenizer, max_seq_length,
+                                                                                lprefix=lprefix, rprefix=rprefix,
+                                                                                pad_on_left=pad_on_left)
+    data = TensorDataset(torch.from_numpy(input_ids).long(), torch.from_numpy(input_mask).long(),
+                         torch.from_numpy(segment_ids).long(), torch.from_numpy(label_ids).long())
+
+    if max_tokens is not None:
+        batch_sampler = TokenBudgetBatchSampler(input_mask.sum(axis=1).tolist(), max_tokens=max_tokens)
+        return DataLoader(data, batch_sampler=batch_sampler, collate_fn=trim_padding(pad_on_left=pad_on_left))
+
+    return DataLoader(data, sampler=SequentialSampler(data), batch_size=batch_size)
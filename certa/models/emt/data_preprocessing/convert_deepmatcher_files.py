@@ -15,29 +15,46 @@ LABEL = "label"
 
 def convert_deepmatcher_structure(filename_matches: str, filename_table_a: str,
                                   filename_table_b: str, filename_destination: str,
-                                  fun_join_left: Callable, fun_join_right: Callable):
+                                  fun_join_left: Callable, fun_join_right: Callable, chunk_size: int = 100000):
     df_table_a = pd.read_csv(filename_table_a, sep=",", encoding="UTF-8")
     df_table_b = pd.read_csv(filename_table_b, sep=",", encoding="UTF-8")
 
-    with open(filename_matches) as src, open(filename_destination, "w+") as dest:
-        reader = csv.DictReader(src, delimiter=",")
-        writer = csv.writer(dest, delimiter="\t")
+    # join the attributes once per record and index the text blobs by id (as string, since keys can be strings).
+    # As there should only exist one row per id, we keep the first one
+    left_texts = text_blobs(df_table_a, fun_join_left)
+    right_texts = text_blobs(df_table_b, fun_join_right)
 
+    offset = 0
+    with open(filename_destination, "w+") as dest:
+        writer = csv.writer(dest, delimiter="\t")
         writer.writerow([INDEX_KEY, TEXT_LEFT, TEXT_RIGHT, LABEL])
 
-        for idx, line in enumerate(reader):
-            # find the row in tableA and tableB which contain the actual values. Make sure both keys have the same data type (we use string comparison as keys can be strings)
-            # As there should only exist one row per id, we use iloc (which returns a data series)
-            left = df_table_a.loc[df_table_a['id'].astype(str) == line['ltable_id']].iloc[0]
-            right = df_table_b.loc[df_table_b['id'].astype(str) == line['rtable_id']].iloc[0]
+        for chunk in pd.read_csv(filename_matches, sep=",", dtype=str, keep_default_na=False, chunksize=chunk_size):
+            writer.writerows(zip(range(offset, offset + len(chunk)),
+                                 lookup(left_texts, chunk['ltable_id']),
+                                 lookup(right_texts, chunk['rtable_id']),
+                                 chunk['label'].values))
+            offset += len(chunk)
 
-            # which attributes we join is depending on the dataset
-            left_joined_attributes = fun_join_left(left)
-            right_joined_attributes = fun_join_right(right)
+    logging.info("Created new tsv. Filename: {}".format(filename_destination))
 
-            writer.writerow([idx, left_joined_attributes, right_joined_attributes, line['label']])
 
-    logging.info("Created new tsv. Filename: {}".format(filename_destination))
+def text_blobs(df_table: pd.DataFrame, fun_join: Callable):
+    df_table = df_table.drop_duplicates(subset='id', keep='first')
+    if fun_join in FRAME_JOINS:
+        texts = FRAME_JOINS[fun_join](df_table)
+    else:
+        texts = df_table.apply(fun_join, axis=1)
+    return pd.Series(texts.values, index=df_table['id'].astype(str).values)
+
+
+def lookup(texts: pd.Series, ids: pd.Series):
+    joined = pd.DataFrame({'id': ids.values}).merge(texts.rename('text'), how='left', left_on='id',
+                                                    right_index=True, indicator=True)
+    missing = joined['_merge'] == 'left_only'
+    if missing.any():
+        raise KeyError("ids not found: {}".format(list(joined['id'][missing].unique()[:10])))
+    return joined['text'].values
 
 
 def abt_buy_join_left(row: pd.Series):
@@ -67,6 +84,36 @@ def full_join_except_id(row: pd.Series):
     return " ".join(single_text_blob)
 
 
+def abt_buy_join_left_frame(df: pd.DataFrame):
+    return df['description']
+
+
+def abt_buy_join_right_frame(df: pd.DataFrame):
+    return df['name'].where(df['description'].isnull(), df['name'] + " " + df['description'])
+
+
+def company_join_frame(df: pd.DataFrame):
+    return df['content']
+
+
+def full_join_except_id_frame(df: pd.DataFrame):
+    text = pd.Series("", index=df.index)
+    not_empty = pd.Series(False, index=df.index)
+    for column in df.columns[1:]:
+        not_null = df[column].notnull()
+        values = df[column].astype(str)
+        text = text.where(~not_null, text.where(~not_empty, text + " ") + values)
+        not_empty |= not_null
+    return text
+
+
+# column-wise equivalents of the row join functions
+FRAME_JOINS = {abt_buy_join_left: abt_buy_join_left_frame,
+               abt_buy_join_right: abt_buy_join_right_frame,
+               company_join: company_join_frame,
+               full_join_except_id: full_join_except_id_frame}
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Convert Deepmatcher-Files')
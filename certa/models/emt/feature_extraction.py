@@ -1,4 +1,8 @@
 import logging
+from functools import reduce
+
+import numpy as np
+from transformers import AutoTokenizer
 
 from certa.models.emt.logging_customized import setup_logging
 from certa.models.emt.data_representation import InputFeatures
@@ -148,3 +152,69 @@ def convert_examples_to_features(examples, label_list, max_seq_length,
                           segment_ids=segment_ids,
                           label_id=label_id))
     return features
+
+
+_fast_tokenizers = dict()
+
+
+def get_fast_tokenizer(tokenizer):
+    """ Returns the fast (Rust backed) version of a tokenizer, loaded once per name_or_path """
+    if tokenizer.is_fast:
+        return tokenizer
+    key = (tokenizer.name_or_path, tokenizer.do_lower_case)
+    if key not in _fast_tokenizers:
+        _fast_tokenizers[key] = AutoTokenizer.from_pretrained(tokenizer.name_or_path,
+                                                              do_lower_case=tokenizer.do_lower_case, use_fast=True)
+    return _fast_tokenizers[key]
+
+
+def move_padding(attention_mask, *arrays, to_left=True):
+    """ Moves the padding of each row to its left (right) side, so that the shared tokenizer padding_side is never
+        changed """
+    width = attention_mask.shape[1]
+    shift = width - attention_mask.sum(axis=1, keepdims=True)
+    if not to_left:
+        shift = -shift
+    positions = (np.arange(width)[None, :] - shift) % width
+    return [np.take_along_axis(a, positions, axis=1) for a in (attention_mask,) + arrays]
+
+
+def join_columns(df, columns):
+    """ Concatenates the string values of the given columns with a whitespace, missing values become empty strings """
+    if len(columns) == 0:
+        return np.full(len(df), '', dtype=object)
+    texts = [df[c].fillna('').astype(str) for c in columns]
+    return reduce(lambda a, b: a + ' ' + b, texts).values
+
+
+def convert_dataframe_to_features(df, tokenizer, max_seq_length, lprefix='ltable_', rprefix='rtable_',
+                                  pad_on_left=False):
+    """ Converts a dataframe of record pairs into padded arrays of input ids, input mask, segment ids and labels
+        using a single call to the batched fast tokenizer.
+        Left (right) text is the concatenation of the values of the columns starting with `lprefix` (`rprefix`).
+    """
+    left_columns = [c for c in df.columns if c.startswith(lprefix) and c != lprefix + 'id']
+    right_columns = [c for c in df.columns if c.startswith(rprefix) and c != rprefix + 'id']
+    text_a = join_columns(df, left_columns).tolist()
+    text_b = join_columns(df, right_columns).tolist()
+
+    tokenizer = get_fast_tokenizer(tokenizer)
+    encoded = tokenizer(text_a, text_b,
+                        max_length=max_seq_length,
+                        truncation='longest_first',
+                        padding='longest',
+                        return_token_type_ids=True,
+                        return_attention_mask=True,
+                        return_tensors='np')
+    input_ids, attention_mask, token_type_ids = encoded['input_ids'], encoded['attention_mask'], \
+        encoded['token_type_ids']
+    if pad_on_left != (tokenizer.padding_side == 'left'):
+        attention_mask, input_ids, token_type_ids = move_padding(attention_mask, input_ids, token_type_ids,
+                                                                 to_left=pad_on_left)
+
+    if 'label' in df.columns:
+        label_ids = (df['label'].astype(str) == '1').values.astype(np.int64)
+    else:
+        label_ids = np.zeros(len(df), dtype=np.int64)
+
+    return input_ids, attention_mask, token_type_ids, label_ids
@@ -6,36 +6,43 @@ from tqdm import tqdm
 
 from functools import partialmethod
 
+from certa.models.ditto.dataset import TokenBudgetBatchSampler
+
 tqdm.__init__ = partialmethod(tqdm.__init__, disable=True)
 
+def predict_scores(model, device, test_data_loader, return_labels: bool = False):
+    """ Inference only prediction: returns the (nomatch, match) probabilities as a float32 array of shape (n, 2),
+        in the order of the dataset. Labels are returned as well, if requested. """
+    n = len(test_data_loader.dataset)
+    scores = np.empty((n, 2), dtype=np.float32)
+    labels = np.empty(n, dtype=np.int64) if return_labels else None
+
+    model.eval()
+    start = 0
+    with torch.inference_mode():
+        for batch in tqdm(test_data_loader, desc="Test"):
+            end = start + len(batch[0])
+            inputs = {'input_ids': batch[0].to(device),
+                      'attention_mask': batch[1].to(device)}
+            logits = model(**inputs)[0]
+            scores[start:end] = torch.softmax(logits, dim=1).cpu().numpy()
+            if return_labels:
+                labels[start:end] = batch[3].numpy()
+            start = end
+
+    # length bucketed batches are not in the original order
+    if isinstance(test_data_loader.batch_sampler, TokenBudgetBatchSampler):
+        scores = test_data_loader.batch_sampler.restore(scores)
+        if return_labels:
+            labels = test_data_loader.batch_sampler.restore(labels)
+
+    if return_labels:
+        return scores, labels
+    return scores
+
+
 def predict(model, device, test_data_loader):
-    nb_prediction_steps = 0
-    predictions = None
-    labels = None
-
-    for batch in tqdm(test_data_loader, desc="Test"):
-        model.eval()
-        batch = tuple(t.to(device) for t in batch)
-        with torch.no_grad():
-            inputs = {'input_ids': batch[0],
-                      'attention_mask': batch[1],
-                      #'token_type_ids': batch[2],
-                      'labels': batch[3]}
-
-            outputs = model(**inputs)
-            logits = outputs[1]
-
-        m = torch.nn.Softmax(dim=1)
-        proba = m(logits)
-        # proba = F.softmax(logits, dim=1)
-        nb_prediction_steps += 1
-
-        if predictions is None:
-            predictions = proba.detach().cpu().numpy()
-            labels = inputs['labels'].detach().cpu().numpy()
-        else:
-            predictions = np.append(predictions, proba.detach().cpu().numpy(), axis=0)
-            labels = np.append(labels, inputs['labels'].detach().cpu().numpy(), axis=0)
+    predictions, labels = predict_scores(model, device, test_data_loader, return_labels=True)
 
     # remember, the logits are simply the output from the last layer, without applying an activation function (e.g. sigmoid).
     # for a simple classification this is also not necessary, we just take the index of the neuron with the maximal output.
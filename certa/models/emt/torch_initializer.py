@@ -1,3 +1,4 @@
+import logging
 import random
 import numpy as np
 import torch
@@ -29,3 +30,17 @@ def setup_gpu():
     n_gpu = torch.cuda.device_count()
 
     return device, n_gpu
+
+
+def setup_cpu_threads(num_threads: int = None, num_interop_threads: int = None):
+    # Setup intra-op / inter-op CPU parallelism
+    if num_threads is not None and num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None and num_interop_threads > 0:
+        try:
+            torch.set_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # inter-op threads can only be set once, before any parallel work has started
+            logging.warning('could not set inter-op threads, parallel work has already started')
+
+    return torch.get_num_threads(), torch.get_num_interop_threads()
@@ -9,19 +9,26 @@ from certa.models.dm import DMERModel
 from certa.models.ermodel import ERModel
 
 
-def from_type(type: str):
+_models = {}
+
+
+def from_type(type: str, lazy: bool = False):
     model = ERModel()
     if "dm" == type:
         model = DMERModel()
     elif "deeper" == type:
-        model = DeepERModel()
+        model = DeepERModel(lazy=lazy)
     elif "ditto" == type:
-        model = EMTERModel()
+        model = EMTERModel(lazy=lazy)
     return model
 
 
-def get_model(mtype: str, modeldir: str, datadir: str, modelname: str):
-    model = from_type(mtype)
+def get_model(mtype: str, modeldir: str, datadir: str, modelname: str, cache: bool = True):
+    key = (mtype, os.path.abspath(modeldir))
+    if cache and key in _models:
+        return _models[key]
+
+    model = from_type(mtype, lazy=True)
 
     if mtype == 'ditto':
         modeldir = modeldir + '/model.pt'
@@ -31,29 +38,32 @@ def get_model(mtype: str, modeldir: str, datadir: str, modelname: str):
         pass
 
     print(f'working on {modelname}')
-    print(f'reading data from {datadir}')
-
-    lsource = pd.read_csv(datadir + '/tableA.csv')
-    rsource = pd.read_csv(datadir + '/tableB.csv')
-    gt = pd.read_csv(datadir + '/train.csv')
-    valid = pd.read_csv(datadir + '/valid.csv')
-    test = pd.read_csv(datadir + '/test.csv')
-
-    print(f'data loaded')
 
+    ready = False
     try:
         try:
             print(f'loading model from {modeldir}')
             model.load(modeldir)
+            ready = True
         except:
             print(model)
             print(f'no valid model found at {modeldir}, now training')
+            print(f'reading data from {datadir}')
+
+            lsource = pd.read_csv(datadir + '/tableA.csv')
+            rsource = pd.read_csv(datadir + '/tableB.csv')
+            gt = pd.read_csv(datadir + '/train.csv')
+            valid = pd.read_csv(datadir + '/valid.csv')
+            test = pd.read_csv(datadir + '/test.csv')
+
+            print(f'data loaded')
             print('merging sources')
             train_df = merge_sources(gt, 'ltable_', 'rtable_', lsource, rsource, ['label'], ['id'])
             test_df = merge_sources(test, 'ltable_', 'rtable_', lsource, rsource, ['label'], [])
             valid_df = merge_sources(valid, 'ltable_', 'rtable_', lsource, rsource, ['label'], ['id'])
             print(f'training model with {len(train_df)} samples ({len(valid_df)} validation, {len(test_df)} test)')
             model.train(train_df, valid_df, modelname)
+            ready = True
             print('evaluating model')
             precision, recall, fmeasure = model.evaluation(test_df)
             text_file = open(modeldir + 'report.txt', "a")
@@ -64,4 +74,29 @@ def get_model(mtype: str, modeldir: str, datadir: str, modelname: str):
     except:
         pass
 
+    # a model that could neither be loaded nor trained is not cached, so that the next call tries again
+    if cache and ready:
+        _models[key] = model
     return model
+
+
+def preload_models(specs: list, share_memory: bool = False):
+    '''
+    Load (or train) a set of models in the current process, so that worker processes forked afterwards reuse them
+    without loading them again.
+    :param specs: a list of (mtype, modeldir, datadir, modelname) tuples, as accepted by get_model
+    :param share_memory: move the parameters of torch models to shared memory, so that they can also be passed to
+    spawned worker processes without being copied
+    :return: the loaded models, in the same order as specs
+    '''
+    models = []
+    for spec in specs:
+        model = get_model(*spec)
+        if share_memory and hasattr(model.model, 'share_memory'):
+            model.model.share_memory()
+        models.append(model)
+    return models
+
+
+def clear_models():
+    _models.clear()
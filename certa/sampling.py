@@ -0,0 +1,193 @@
+import numpy as np
+import pandas as pd
+
+from certa.triangles_method import attribute_masks, mask_bits
+
+
+def attribute_differences(candidates: pd.DataFrame, r1: pd.Series, r2: pd.Series, lprefix='ltable_',
+                          rprefix='rtable_'):
+    '''
+    Compare each candidate support pair with the explained pair r1, r2.
+    :param candidates: the candidate support pairs
+    :param r1: the "left" record
+    :param r2: the "right" record
+    :param lprefix: the prefix of attributes from the "left" table
+    :param rprefix: the prefix of attributes from the "right" table
+    :return: the (prefixed) attributes, a boolean matrix telling which attributes of each candidate differ from the
+        explained pair and the token similarity of each candidate with the explained pair
+    '''
+    attributes = []
+    differs = []
+    similarities = []
+    for prefix, record in [(lprefix, r1), (rprefix, r2)]:
+        for a in record.index:
+            if a == 'id' or prefix + a not in candidates.columns:
+                continue
+            values = candidates[prefix + a].astype(str).values
+            tokens = set(str(record[a]).split())
+            attributes.append(prefix + a)
+            differs.append(values != str(record[a]))
+            similarities.append([_jaccard(tokens, set(v.split())) for v in values])
+    if len(attributes) == 0:
+        return [], np.zeros((len(candidates), 0), dtype=bool), np.zeros(len(candidates))
+    return attributes, np.stack(differs, axis=1), np.mean(similarities, axis=0)
+
+
+def _jaccard(a: set, b: set):
+    union = len(a | b)
+    return len(a & b) / union if union > 0 else 1.0
+
+
+def extremes(candidates: pd.DataFrame, n: int, r1: pd.Series, r2: pd.Series, lprefix='ltable_', rprefix='rtable_',
+             rng=None):
+    '''
+    The first and the last n/2 candidates (the original CERTA selection).
+    '''
+    return pd.concat([candidates[:int(n / 2)], candidates[-int(n / 2):]], axis=0)
+
+
+def uniform(candidates: pd.DataFrame, n: int, r1: pd.Series, r2: pd.Series, lprefix='ltable_', rprefix='rtable_',
+            rng=None):
+    '''
+    n candidates drawn uniformly at random.
+    '''
+    return candidates.sample(n=n, random_state=np.random.default_rng(rng))
+
+
+def stratified(candidates: pd.DataFrame, n: int, r1: pd.Series, r2: pd.Series, lprefix='ltable_',
+               rprefix='rtable_', strata: int = 5, rng=None):
+    '''
+    n candidates drawn in turn from strata of increasing similarity with the explained pair, so that both near and
+    far support records are used.
+    '''
+    _, _, similarities = attribute_differences(candidates, r1, r2, lprefix, rprefix)
+    rng = np.random.default_rng(rng)
+    strata = max(1, min(strata, n))
+    order = np.argsort(similarities, kind='stable')
+    buckets = [list(rng.permutation(b)) for b in np.array_split(order, strata)]
+    selected = []
+    while len(selected) < n:
+        for b in buckets:
+            if len(b) > 0 and len(selected) < n:
+                selected.append(b.pop())
+    return candidates.iloc[selected]
+
+
+def diversity(candidates: pd.DataFrame, n: int, r1: pd.Series, r2: pd.Series, lprefix='ltable_',
+              rprefix='rtable_', rng=None):
+    '''
+    n candidates greedily chosen to cover as many distinct differing attributes as possible: each pick maximizes the
+    no. of attributes (differing from the explained pair) not covered yet, coverage restarts once all the attributes
+    are covered.
+    '''
+    _, differs, similarities = attribute_differences(candidates, r1, r2, lprefix, rprefix)
+    available = np.ones(len(candidates), dtype=bool)
+    covered = np.zeros(differs.shape[1], dtype=bool)
+    # break ties towards the least similar candidates
+    tie_break = 1 - similarities
+    selected = []
+    while len(selected) < n:
+        gains = (differs & ~covered).sum(axis=1) + tie_break / 2
+        gains[~available] = -1
+        pick = int(np.argmax(gains))
+        selected.append(pick)
+        available[pick] = False
+        covered |= differs[pick]
+        if covered[differs[available].any(axis=0)].all():
+            covered[:] = False
+    return candidates.iloc[selected]
+
+
+def importance(candidates: pd.DataFrame, n: int, r1: pd.Series, r2: pd.Series, lprefix='ltable_',
+               rprefix='rtable_', rng=None):
+    '''
+    n candidates drawn without replacement with probability proportional to the confidence of their (opposite)
+    prediction times the fraction of attributes differing from the explained pair.
+    '''
+    _, differs, _ = attribute_differences(candidates, r1, r2, lprefix, rprefix)
+    confidence = np.abs(candidates['match_score'].astype(float).values - 0.5) * 2 \
+        if 'match_score' in candidates.columns else np.ones(len(candidates))
+    weights = confidence * (differs.mean(axis=1) if differs.shape[1] > 0 else 1) + 1e-6
+    selected = np.random.default_rng(rng).choice(len(candidates), size=n, replace=False, p=weights / weights.sum())
+    return candidates.iloc[selected]
+
+
+strategies = {'extremes': extremes, 'random': uniform, 'stratified': stratified, 'diversity': diversity,
+              'importance': importance}
+
+
+def get_sampler(strategy):
+    '''
+    Get a support sampling strategy.
+    :param strategy: the name of a strategy in strategies or a callable with the same signature (rng being the
+        np.random.Generator, or the seed, of its random choices)
+    :return: a function selecting n of the candidate support pairs
+    '''
+    if callable(strategy):
+        return strategy
+    if strategy not in strategies:
+        raise ValueError('unknown sampling strategy %s, expected one of %s' % (strategy, list(strategies.keys())))
+    return strategies[strategy]
+
+
+def sample_support(candidates: pd.DataFrame, n: int, r1: pd.Series, r2: pd.Series, strategy='extremes',
+                   lprefix='ltable_', rprefix='rtable_', rng=None):
+    '''
+    Select n of the candidate support pairs using the given strategy (all of them when there are not more than n).
+    rng is the np.random.Generator (or the seed) used by the random strategies, unseeded if None.
+    '''
+    if len(candidates) <= n:
+        return candidates
+    return get_sampler(strategy)(candidates, n, r1, r2, lprefix=lprefix, rprefix=rprefix, rng=rng)
+
+
+def saliency_curve(flipped_predictions: pd.DataFrame, triangles: list, attributes: list):
+    '''
+    Compute the saliency of each attribute using only the first k open triangles, for each k.
+    :param flipped_predictions: the flipped lattice predictions of each triangle (as returned by explain_samples),
+        including the ones assumed flipped without being predicted, i.e. the flips the saliency is computed from
+    :param triangles: the open triangles, in the order they were processed
+    :param attributes: the (prefixed) attributes of the saliency
+    :return: a pd.DataFrame with a row per no. of triangles and a column per attribute
+    '''
+    if len(triangles) == 0:
+        return pd.DataFrame()
+    positions = dict()
+    for i, t in enumerate(triangles):
+        positions.setdefault(' '.join(t), i)
+    if len(flipped_predictions) > 0:
+        rows = flipped_predictions['triangle'].map(positions).values.astype(float)
+        known = ~np.isnan(rows)
+        rows = rows[known].astype(int)
+        altered = flipped_predictions['alteredAttributes'].values[known]
+    else:
+        rows, altered = np.zeros(0, dtype=int), []
+    index = {a: i for i, a in enumerate(attributes)}
+    flips = np.bincount(rows, minlength=len(triangles)).astype(float)
+    attribute_flips = np.zeros((len(triangles), len(attributes)))
+    if len(rows) > 0:
+        np.add.at(attribute_flips, rows, mask_bits(attribute_masks(altered, index), len(attributes)))
+    # as in get_saliency, each triangle also flips with the entire attribute set
+    seen = np.arange(1, len(triangles) + 1)[:, None]
+    curve = (seen + np.cumsum(attribute_flips, axis=0)) / (seen + np.cumsum(flips)[:, None])
+    return pd.DataFrame(curve, columns=attributes, index=pd.RangeIndex(1, len(triangles) + 1, name='triangles'))
+
+
+def saliency_convergence(flipped_predictions: pd.DataFrame, triangles: list, attributes: list,
+                         tolerance: float = 0.05):
+    '''
+    Compute how many open triangles are needed for the saliency to converge, i.e. the smallest no. of triangles k such
+    that the saliency computed on the first k' >= k triangles is always within tolerance of the final one (for each
+    attribute).
+    :param flipped_predictions: the flipped lattice predictions of each triangle (see saliency_curve)
+    :param triangles: the open triangles, in the order they were processed
+    :param attributes: the (prefixed) attributes of the saliency
+    :param tolerance: the maximum absolute difference with the final saliency of any attribute
+    :return: the no. of triangles (0 if there are no triangles)
+    '''
+    curve = saliency_curve(flipped_predictions, triangles, attributes)
+    if len(curve) == 0:
+        return 0
+    distance = np.abs(curve.values - curve.values[-1]).max(axis=1)
+    far = np.nonzero(distance > tolerance)[0]
+    return int(far[-1]) + 2 if len(far) > 0 else 1
@@ -0,0 +1,158 @@
+import asyncio
+import copy
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from certa.explain import CertaExplainer
+
+
+class PredictBatcher:
+    '''
+    Coalesces the predict_fn calls issued by concurrent explanations into shared micro-batches.
+
+    Calls are queued until max_batch_size rows are pending or max_wait seconds have passed since the first pending
+    call, then the rows of the calls having the same columns are concatenated and predicted with a single call to
+    predict_fn in the model executor. The predictions (a pd.DataFrame or a np.ndarray with a row per record) are split
+    back and routed to each caller.
+    '''
+
+    def __init__(self, predict_fn, max_batch_size: int = 1024, max_wait: float = 0.005, executor=None):
+        '''
+        :param predict_fn: the ER model prediction function
+        :param max_batch_size: the no. of pending rows which triggers a model call
+        :param max_wait: the maximum time (in seconds) a call waits for other calls to join its batch
+        :param executor: the executor running predict_fn (a single worker thread by default)
+        '''
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.owns_executor = executor is None
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.pending_rows = 0
+        self.flush_handle = None
+        self.batches = 0
+        self.rows = 0
+        self.calls = 0
+
+    async def predict(self, x: pd.DataFrame):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((x, future))
+        self.pending_rows += len(x)
+        self.calls += 1
+        if self.pending_rows >= self.max_batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.max_wait, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        pending, self.pending, self.pending_rows = self.pending, [], 0
+        groups = dict()
+        for x, future in pending:
+            groups.setdefault(tuple(x.columns), []).append((x, future))
+        for group in groups.values():
+            asyncio.ensure_future(self._run(group))
+
+    async def _run(self, group: list):
+        frames = [x for x, _ in group]
+        batch = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0].reset_index(drop=True)
+        self.batches += 1
+        self.rows += len(batch)
+        try:
+            predictions = await asyncio.get_running_loop().run_in_executor(self.executor, self.predict_fn, batch)
+            if not isinstance(predictions, (pd.DataFrame, np.ndarray)):
+                raise TypeError('predict_fn must return a pd.DataFrame or a np.ndarray, got %s'
+                                % type(predictions).__name__)
+            if len(predictions) != len(batch):
+                raise ValueError('predict_fn returned %d predictions for %d records' % (len(predictions), len(batch)))
+        except Exception as e:
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        start = 0
+        for x, future in group:
+            end = start + len(x)
+            if not future.done():
+                if isinstance(predictions, pd.DataFrame):
+                    chunk = predictions.iloc[start:end].copy()
+                    chunk.index = x.index
+                else:
+                    chunk = predictions[start:end].copy()
+                future.set_result(chunk)
+            start = end
+
+
+class ExplanationService:
+    '''
+    Asyncio front end to a CertaExplainer, serving concurrent explain requests.
+
+    Each explanation runs in a worker thread and its calls to the prediction function are coalesced with the ones of
+    all the other in-flight explanations by a PredictBatcher, so that the model sees fewer, larger batches.
+    Identical requests received while one is in flight share its computation, each of them gets its own (deep) copy
+    of the result.
+    The ExplanationStats of each request are always returned with its explanation.
+    '''
+
+    def __init__(self, explainer: CertaExplainer, predict_fn, max_batch_size: int = 1024, max_wait: float = 0.005,
+                 max_workers: int = 8, model_executor=None):
+        '''
+        :param explainer: the CertaExplainer
+        :param predict_fn: the ER model prediction function, it must accept batches of any size
+        :param max_batch_size: the no. of pending rows which triggers a model call
+        :param max_wait: the maximum time (in seconds) a prediction waits for other ones to join its batch
+        :param max_workers: the maximum no. of explanations computed at the same time
+        :param model_executor: the executor running predict_fn (a single worker thread by default)
+        '''
+        self.explainer = explainer
+        self.batcher = PredictBatcher(predict_fn, max_batch_size=max_batch_size, max_wait=max_wait,
+                                       executor=model_executor)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.in_flight = dict()
+        self.loop = None
+
+    def _predict_fn(self, x, **kwargs):
+        # called from the explanation threads, blocks until the batch holding x is predicted
+        return asyncio.run_coroutine_threadsafe(self.batcher.predict(x), self.loop).result()
+
+    async def explain(self, l_tuple: pd.Series, r_tuple: pd.Series, **kwargs):
+        '''
+        Explain the prediction on the pair of records l_tuple and r_tuple.
+        :param l_tuple: the "left" record
+        :param r_tuple: the "right" record
+        :param kwargs: the other arguments of CertaExplainer.explain (but predict_fn and return_stats)
+        :return: the same as CertaExplainer.explain with return_stats set (the ExplanationStats are the last item)
+        '''
+        self.loop = asyncio.get_running_loop()
+        kwargs['return_stats'] = True
+        key = (l_tuple.astype(str).to_json(), r_tuple.astype(str).to_json(),
+               json.dumps(kwargs, sort_keys=True, default=str))
+        task = self.in_flight.get(key)
+        if task is None:
+            task = self.loop.run_in_executor(self.executor, lambda: self.explainer.explain(l_tuple, r_tuple,
+                                                                                          self._predict_fn,
+                                                                                          **kwargs))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        # the result is shared by the coalesced requests, so that none of them sees the changes of the others
+        return copy.deepcopy(await asyncio.shield(task))
+
+    async def explain_many(self, pairs: list, **kwargs):
+        '''
+        Explain a list of (l_tuple, r_tuple) pairs concurrently.
+        :return: the list of explanations, in the same order as pairs
+        '''
+        return await asyncio.gather(*[self.explain(l_tuple, r_tuple, **kwargs) for l_tuple, r_tuple in pairs])
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.batcher.owns_executor:
+            self.batcher.executor.shutdown(wait=True)
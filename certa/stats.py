@@ -0,0 +1,89 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class ExplanationStats:
+    '''
+    Collects the timings and the model usage of a single explanation.
+
+    Stages can be nested, so the time of an enclosing stage includes the one of its inner stages, while
+    predict_fn calls and rows are accounted to the innermost running stage.
+    Each hook is a callable taking the event name ('stage' or 'predict') and a dict with the event data.
+    '''
+
+    def __init__(self, hooks: list = None):
+        self.hooks = list(hooks) if hooks is not None else []
+        self.stages = defaultdict(float)
+        self.predict_calls = defaultdict(int)
+        self.predict_rows = defaultdict(int)
+        self.predict_time = defaultdict(float)
+        self.cache_hits = 0
+        self.triangles_requested = 0
+        self.support_found = 0
+        self.triangles_found = 0
+        self.triangles_to_converge = 0
+        self._running = []
+
+    @contextmanager
+    def stage(self, name: str):
+        self._running.append(name)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            elapsed = time.perf_counter() - start
+            self._running.pop()
+            self.stages[name] += elapsed
+            self.emit('stage', {'stage': name, 'seconds': elapsed})
+
+    def current_stage(self):
+        return self._running[-1] if len(self._running) > 0 else 'other'
+
+    def predict(self, predict_fn):
+        '''
+        Wrap a prediction function so that its calls, rows and time are recorded.
+        :param predict_fn: the ER model prediction function
+        :return: the instrumented prediction function
+        '''
+        if getattr(predict_fn, 'stats', None) is self:
+            return predict_fn
+
+        def instrumented(x, *args, **kwargs):
+            start = time.perf_counter()
+            predictions = predict_fn(x, *args, **kwargs)
+            elapsed = time.perf_counter() - start
+            stage = self.current_stage()
+            self.predict_calls[stage] += 1
+            self.predict_rows[stage] += len(x)
+            self.predict_time[stage] += elapsed
+            self.emit('predict', {'stage': stage, 'rows': len(x), 'seconds': elapsed})
+            return predictions
+
+        instrumented.stats = self
+        return instrumented
+
+    def hit(self, count: int = 1):
+        self.cache_hits += count
+
+    def emit(self, event: str, data: dict):
+        for hook in self.hooks:
+            hook(event, data)
+
+    def total_predict_calls(self):
+        return sum(self.predict_calls.values())
+
+    def total_predict_rows(self):
+        return sum(self.predict_rows.values())
+
+    def to_dict(self):
+        return {'stages': dict(self.stages), 'predict_calls': dict(self.predict_calls),
+                'predict_rows': dict(self.predict_rows), 'predict_time': dict(self.predict_time),
+                'cache_hits': self.cache_hits, 'triangles_requested': self.triangles_requested,
+                'support_found': self.support_found, 'triangles_found': self.triangles_found,
+                'triangles_to_converge': self.triangles_to_converge}
+
+    def __repr__(self):
+        return 'ExplanationStats(%s calls, %s rows, %s/%s triangles, %s)' % (
+            self.total_predict_calls(), self.total_predict_rows(), self.triangles_found, self.triangles_requested,
+            ', '.join('%s=%.3fs' % (k, v) for k, v in self.stages.items()))
@@ -1,5 +1,8 @@
+import importlib.util
 import logging
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from functools import partialmethod
 from itertools import combinations
 
@@ -7,6 +10,8 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from certa.stats import ExplanationStats
+
 tqdm.__init__ = partialmethod(tqdm.__init__, disable=True)
 
 
@@ -22,6 +27,64 @@ def _powerset(xs, minlen, maxlen):
             for subset in combinations(xs, i)]
 
 
+class open_triangle(tuple):
+    '''
+    An open triangle <u, v, w>, as the tuple of the source@id identifiers of its records, together with the results
+    of the identity, symmetry and transitivity checks performed by the ER model on it (None until checked).
+    '''
+
+    def __new__(cls, ids, identity: bool = None, symmetry: bool = None, transitivity: bool = None):
+        triangle = super(open_triangle, cls).__new__(cls, ids)
+        triangle.identity = identity
+        triangle.symmetry = symmetry
+        triangle.transitivity = transitivity
+        return triangle
+
+    def checked(self):
+        return self.transitivity is not None
+
+    def __repr__(self):
+        if not self.checked():
+            return 'open_triangle(%s)' % ', '.join(self)
+        return 'open_triangle(%s, identity=%s, symmetry=%s, transitivity=%s)' % (', '.join(self), self.identity,
+                                                                                 self.symmetry, self.transitivity)
+
+
+def _object_array(values):
+    if isinstance(values, np.ndarray) and values.dtype == object:
+        return values
+    array = np.empty(len(values), dtype=object)
+    array[:] = list(values)
+    return array
+
+
+def attribute_masks(attribute_sets, index: dict):
+    '''
+    Encode sets of attributes as bitmasks, bit i being set when the set holds the attribute with index i.
+    :param attribute_sets: the sets (tuples) of attributes
+    :param index: the bit of each attribute
+    :return: the array of bitmasks (of Python ints when there are more than 62 attributes)
+    '''
+    codes, uniques = pd.factorize(_object_array(attribute_sets))
+    dtype = np.int64 if len(index) < 63 else object
+    unique_masks = np.zeros(len(uniques), dtype=dtype)
+    for u, attribute_set in enumerate(uniques):
+        mask = 0
+        for a in attribute_set:
+            mask |= 1 << index[a]
+        unique_masks[u] = mask
+    return unique_masks[codes]
+
+
+def mask_bits(masks: np.ndarray, size: int):
+    '''
+    Expand bitmasks to a (no. of masks, size) matrix of 0 / 1.
+    '''
+    if masks.dtype == object:
+        return np.array([[(int(m) >> i) & 1 for i in range(size)] for m in masks], dtype=np.int64).reshape(-1, size)
+    return (masks[:, None] >> np.arange(size)) & 1
+
+
 def getMixedTriangles(dataset, sources):
     # a triangle is a triple <u, v, w> where <u, v> is a match and <v, w> is a non-match (<u,w> should be a non-match)
     triangles = []
@@ -44,12 +107,12 @@ def getMixedTriangles(dataset, sources):
                 negatives.rtable_id == rid]  # find all tuples where r_id participates in a negative prediction
             for curr_lid in relatedTuples.ltable_id.values:  # collect all other l_ids that also are part of the negative prediction
                 # add a new triangle with l_id1, a r_id1 participating in a positive prediction (with l_id1), and another l_id2 that participates in a negative prediction with r_id1
-                triangles.append((lid, rid, curr_lid))
+                triangles.append(open_triangle((lid, rid, curr_lid)))
         if np.count_nonzero(
                 negatives.ltable_id.values == lid) >= 1:  # dual but starting from l_id1 in positive prediction with r_id1, looking for r_id2s where l_id participates in a negative prediction
             relatedTuples = negatives[negatives.ltable_id == lid]
             for curr_rid in relatedTuples.rtable_id.values:
-                triangles.append((rid, lid, curr_rid))
+                triangles.append(open_triangle((rid, lid, curr_rid)))
     return triangles, sourcesmap
 
 
@@ -121,121 +184,162 @@ def createPerturbationsFromTriangle(triangleIds, sourcesMap, attributes, maxLenA
     return allPerturbations
 
 
-def check_properties(triangle, sourcesMap, predict_fn):
+def check_properties(triangles: list, sourcesMap, predict_fn, lprefix='ltable_', rprefix='rtable_'):
+    '''
+    Check whether the ER model predictions on the records of each open triangle satisfy identity (each record matches
+    itself), symmetry (swapping the records of a pair does not change the prediction) and transitivity (no two
+    matching pairs with a non-matching third one). The pairs needed by all the triangles are predicted with a single
+    call to predict_fn and the results are stored on each open_triangle.
+    :param triangles: the open_triangles
+    :param sourcesMap: the (prefixed) data sources the triangle records come from
+    :param predict_fn: the ER model prediction function
+    :return: the checked triangles
+    '''
+    if len(triangles) == 0:
+        return triangles
     try:
-        t1 = triangle[0].split('@')
-        t2 = triangle[1].split('@')
-        t3 = triangle[2].split('@')
-        if int(t1[0]) == 0:
-            u = pd.DataFrame(sourcesMap.get(int(t1[0])).iloc[int(t1[1])]).transpose()
-            v = pd.DataFrame(sourcesMap.get(int(t2[0])).iloc[int(t2[1])]).transpose()
-            w1 = pd.DataFrame(sourcesMap.get(int(t3[0])).iloc[int(t3[1])]).transpose()
-            u1 = u.copy()
-            v1 = v.copy()
-            w = w1.copy()
-
-        else:
-            u = pd.DataFrame(sourcesMap.get(int(t2[0])).iloc[int(t2[1])]).transpose()
-            v = pd.DataFrame(sourcesMap.get(int(t1[0])).iloc[int(t1[1])]).transpose()
-            w = pd.DataFrame(sourcesMap.get(int(t3[0])).iloc[int(t3[1])]).transpose()
-            u1 = u.copy()
-            v1 = v.copy()
-            w1 = w.copy()
-
-        _renameColumnsWithPrefix('ltable_', u)
-        _renameColumnsWithPrefix('rtable_', u1)
-        _renameColumnsWithPrefix('rtable_', v)
-        _renameColumnsWithPrefix('ltable_', v1)
-        _renameColumnsWithPrefix('rtable_', w)
-        _renameColumnsWithPrefix('ltable_', w1)
-
-        records = pd.concat([
-            # identity
-            pd.concat([u.reset_index(), u1.reset_index()], axis=1),
-            pd.concat([v1.reset_index(), v.reset_index()], axis=1),
-            pd.concat([w1.reset_index(), w.reset_index()], axis=1),
-
-            # symmetry
-            pd.concat([u.reset_index(), v.reset_index()], axis=1),
-            pd.concat([v1.reset_index(), u1.reset_index()], axis=1),
-            pd.concat([u.reset_index(), w.reset_index()], axis=1),
-            pd.concat([w1.reset_index(), u1.reset_index()], axis=1),
-            pd.concat([v1.reset_index(), w.reset_index()], axis=1),
-            pd.concat([w1.reset_index(), v.reset_index()], axis=1),
-
-            # transitivity
-            pd.concat([u.reset_index(), v.reset_index()], axis=1),
-            pd.concat([v1.reset_index(), w.reset_index()], axis=1),
-            pd.concat([u.reset_index(), w.reset_index()], axis=1)
-        ])
-
-        predictions = np.argmax(predict_fn(records)[['nomatch_score', 'match_score']].values, axis=1)
-
-        identity = predictions[0] == 1 and predictions[1] == 1 and predictions[2] == 1
-
-        symmetry = predictions[3] == predictions[4] and predictions[5] == predictions[6] \
-                   and predictions[7] == predictions[8]
-
-        p1 = predictions[9]
-        p2 = predictions[10]
-        p3 = predictions[11]
-
-        matches = 0
-        non_matches = 0
-        if p1 == 1:
-            matches += 1
-        else:
-            non_matches += 1
-        if p2 == 1:
-            matches += 1
-        else:
-            non_matches += 1
-        if p3 == 1:
-            matches += 1
-        else:
-            non_matches += 1
-        transitivity = matches == 3 or non_matches == 3 or (matches == 1 and non_matches == 2)
-
-        return identity, symmetry, transitivity
-    except:
-        return False, False, False
+        prefixes = {0: lprefix, 1: rprefix}
+        records = dict()
+        for triangle in triangles:
+            for record_id in triangle:
+                if record_id not in records:
+                    source_index, rid = str(record_id).split('@')
+                    prefix = prefixes[int(source_index)]
+                    source = sourcesMap[int(source_index)]
+                    record = source[source[prefix + 'id'] == int(rid)].iloc[0]
+                    record.index = [c[len(prefix):] if c.startswith(prefix) else c for c in record.index]
+                    records[record_id] = record.to_dict()
+
+        pairs = dict()
+        checks = []
+        for triangle in triangles:
+            # u and v are the "left" and the "right" records of the pivot pair, w is the free one
+            if str(triangle[0]).startswith('0'):
+                u, v, w = triangle[0], triangle[1], triangle[2]
+            else:
+                u, v, w = triangle[1], triangle[0], triangle[2]
+            triangle_pairs = [(u, u), (v, v), (w, w), (u, v), (v, u), (u, w), (w, u), (v, w), (w, v)]
+            for pair in triangle_pairs:
+                pairs.setdefault(pair, len(pairs))
+            checks.append([pairs[pair] for pair in triangle_pairs])
+
+        rows = []
+        for left, right in pairs.keys():
+            row = {lprefix + k: v for k, v in records[left].items()}
+            row.update({rprefix + k: v for k, v in records[right].items()})
+            rows.append(row)
+        predictions = np.argmax(predict_fn(pd.DataFrame(rows))[['nomatch_score', 'match_score']].values, axis=1)
+        predictions = predictions[np.array(checks)]
+    except Exception as e:
+        logging.warning(f'could not check the triangle properties: {e}')
+        return triangles
+
+    identity = (predictions[:, :3] == 1).all(axis=1)
+    symmetry = (predictions[:, 3] == predictions[:, 4]) & (predictions[:, 5] == predictions[:, 6]) \
+        & (predictions[:, 7] == predictions[:, 8])
+    # only <u, v>, <v, w> and <u, w> matching two out of three times breaks transitivity
+    transitivity = predictions[:, [3, 7, 5]].sum(axis=1) != 2
+    for i, triangle in enumerate(triangles):
+        triangle.identity = bool(identity[i])
+        triangle.symmetry = bool(symmetry[i])
+        triangle.transitivity = bool(transitivity[i])
+    return triangles
+
+
+def filter_triangles(triangles: list, sourcesMap, predict_fn, lprefix, rprefix, discard_bad: bool = True,
+                     stats: ExplanationStats = None):
+    '''
+    Check the properties of the open triangles (see check_properties) and, if discard_bad is set, keep only the
+    transitive ones (all of them if none is transitive).
+    '''
+    if stats is None:
+        stats = ExplanationStats()
+    with stats.stage('checks'):
+        check_properties([t for t in triangles if not t.checked()], sourcesMap, predict_fn, lprefix, rprefix)
+    if discard_bad:
+        good = [t for t in triangles if t.transitivity is not False]
+        if len(good) > 0:
+            return good
+        logging.warning('no transitive triangles, keeping all of them')
+    return triangles
 
 
 def explain_samples(dataset: pd.DataFrame, sources: list, predict_fn: callable, lprefix, rprefix,
-                    class_to_explain: int, attr_length: int, check: bool = False,
-                    discard_bad: bool = False, return_top: bool = False,
-                    persist_predictions: bool = False):
+                    class_to_explain: int, attr_length: int, check: bool = True,
+                    discard_bad: bool = True, return_top: bool = False,
+                    persist_predictions: bool = False, predictions_path: str = 'predictions.parquet',
+                    return_predictions: bool = False, stats: ExplanationStats = None, round_size: int = -1,
+                    tolerance: float = 0.02, max_predict: int = -1, seed: int = 0):
+    '''
+    Generate the open triangles from the support records in dataset and explain the prediction with their lattices.
+    When round_size > 0 the triangles are processed in rounds of round_size triangles and the saliency and the
+    rankings are updated after each round, stopping as soon as they are stable (see stable_explanation) or when the
+    predictions performed by predict_fn (as recorded in stats) reach max_predict. The triangles are shuffled (with the
+    given seed) before being split in rounds.
+    When check is set the properties of the triangles are checked first (see filter_triangles) and, if discard_bad is
+    set, the non transitive ones are not used.
+    '''
+    if stats is None:
+        stats = ExplanationStats()
+    if persist_predictions:
+        _require_parquet()
     _renameColumnsWithPrefix(lprefix, sources[0])
     _renameColumnsWithPrefix(rprefix, sources[1])
 
     attributes = [col for col in list(sources[0]) if col not in [lprefix + 'id']]
     attributes += [col for col in list(sources[1]) if col not in [rprefix + 'id']]
 
-    allTriangles, sourcesMap = getMixedTriangles(dataset, sources)
+    with stats.stage('triangles'):
+        allTriangles, sourcesMap = getMixedTriangles(dataset, sources)
+    if check and len(allTriangles) > 0:
+        allTriangles = filter_triangles(allTriangles, sourcesMap, predict_fn, lprefix, rprefix,
+                                        discard_bad=discard_bad, stats=stats)
+    stats.triangles_found = len(allTriangles)
     if len(allTriangles) > 0:
-        flipped_predictions, rankings, all_predictions = perturb_predict(allTriangles, attributes, check,
-                                                                           class_to_explain, discard_bad,
-                                                                           attr_length, predict_fn, sourcesMap, lprefix,
-                                                                           rprefix)
+        if round_size <= 0:
+            round_size = len(allTriangles)
+        else:
+            # triangles are generated grouped by pivot and side, each round should be representative of all of them
+            order = np.random.default_rng(seed).permutation(len(allTriangles))
+            allTriangles = [allTriangles[i] for i in order]
+        flipped = []
+        rankings = []
+        predictions = []
+        saliency = None
+        explanation = pd.Series(dtype=float)
+        done = 0
+        while done < len(allTriangles):
+            round_triangles = allTriangles[done:done + round_size]
+            round_flipped, round_rankings, round_predictions = perturb_predict(round_triangles, attributes, False,
+                                                                               class_to_explain, False,
+                                                                               attr_length, predict_fn, sourcesMap,
+                                                                               lprefix, rprefix, stats=stats)
+            done += len(round_triangles)
+            flipped.append(round_flipped)
+            rankings += round_rankings
+            predictions.append(round_predictions)
+            with stats.stage('ranking'):
+                previous_saliency, previous_explanation = saliency, explanation
+                saliency = get_saliency(dataset, rankings, done, sum(len(f) for f in flipped), lprefix, rprefix)
+                explanation = aggregateRankings(rankings, lenTriangles=done, attr_length=attr_length)
+            if done < len(allTriangles):
+                if previous_saliency is not None and stable_explanation(previous_saliency, saliency,
+                                                                        previous_explanation, explanation, tolerance):
+                    logging.info(f'explanation stable after {done} triangles')
+                    break
+                if 0 < max_predict <= stats.total_predict_rows():
+                    logging.info(f'prediction budget exhausted after {done} triangles')
+                    break
+        allTriangles = allTriangles[:done]
+        stats.triangles_found = done
+        flipped_predictions = pd.concat(flipped, ignore_index=True)
+        all_predictions = pd.concat(predictions)
         if persist_predictions:
-            all_predictions.to_csv('predictions.csv')
-        explanation = aggregateRankings(rankings, lenTriangles=len(allTriangles), attr_length=attr_length)
-
-        flips = len(flipped_predictions) + len(allTriangles)
-        saliency = dict()
-        for a in dataset.columns:
-            if (a.startswith(lprefix) or a.startswith(rprefix)) and not (a == lprefix + 'id' or a == rprefix + 'id'):
-                saliency[a] = len(allTriangles) / flips # all attributes have a flip for the entire attribute set A
-
-        for ranking in rankings:
-            for k, v in ranking.items():
-                for a in k:
-                    saliency[a] += v / flips
+            persist(all_predictions, predictions_path)
 
         if len(explanation) > 0:
             if len(flipped_predictions) > 0:
-                flipped_predictions['attr_count'] = flipped_predictions.alteredAttributes.astype(str) \
-                    .str.split(',').str.len()
+                flipped_predictions['attr_count'] = flipped_predictions.alteredAttributes.map(len)
                 flipped_predictions = flipped_predictions.sort_values(by=['attr_count'])
             if return_top:
                 series = cf_summary(explanation)
@@ -243,128 +347,217 @@ def explain_samples(dataset: pd.DataFrame, sources: list, predict_fn: callable,
             else:
                 filtered_exp = explanation
 
+            if return_predictions:
+                return saliency, filtered_exp, flipped_predictions, allTriangles, all_predictions
             return saliency, filtered_exp, flipped_predictions, allTriangles
-        else:
-            return dict(), [], pd.DataFrame(), []
     else:
         logging.warning(f'empty triangles !?')
-        return dict(), [], pd.DataFrame(), []
+    if return_predictions:
+        return dict(), [], pd.DataFrame(), [], pd.DataFrame()
+    return dict(), [], pd.DataFrame(), []
+
+
+def get_saliency(dataset: pd.DataFrame, rankings: list, lenTriangles: int, lenFlipped: int, lprefix, rprefix):
+    flips = lenFlipped + lenTriangles
+    attributes = [a for a in dataset.columns if (a.startswith(lprefix) or a.startswith(rprefix))
+                  and not (a == lprefix + 'id' or a == rprefix + 'id')]
+    # all attributes have a flip for the entire attribute set A
+    saliency = np.full(len(attributes), lenTriangles / flips)
+
+    altered = [k for ranking in rankings for k in ranking.keys()]
+    if len(altered) > 0:
+        index = {a: i for i, a in enumerate(attributes)}
+        counts = np.fromiter((v for ranking in rankings for v in ranking.values()), dtype=float, count=len(altered))
+        masks = attribute_masks(altered, index)
+        saliency += counts @ mask_bits(masks, len(attributes)) / flips
+    return dict(zip(attributes, saliency.tolist()))
+
+
+def stable_explanation(previous_saliency: dict, saliency: dict, previous_explanation: pd.Series,
+                       explanation: pd.Series, tolerance: float):
+    '''
+    Whether an explanation did not change (within tolerance) with respect to the one computed on fewer triangles:
+    no two attributes swapped their saliency ranking by more than tolerance, no saliency value moved by more than
+    tolerance and the counterfactual summary holds the same attribute sets.
+    '''
+    for a in saliency:
+        for b in saliency:
+            if previous_saliency.get(a, 0) > previous_saliency.get(b, 0) and saliency[b] - saliency[a] > tolerance:
+                return False
+    if any(abs(saliency[a] - previous_saliency.get(a, 0)) > tolerance for a in saliency):
+        return False
+    if len(previous_explanation) == 0 or len(explanation) == 0:
+        return len(previous_explanation) == len(explanation)
+    return set(cf_summary(previous_explanation).index) == set(cf_summary(explanation).index)
+
+
+_writer = ThreadPoolExecutor(max_workers=1)
+# the pending writes (finished ones remove themselves) and the first write error not raised yet
+_writes = set()
+_write_errors = []
+_writes_lock = threading.Lock()
+
+
+def _require_parquet():
+    if importlib.util.find_spec('pyarrow') is None:
+        raise ImportError('persisting predictions requires pyarrow, install it with pip install certa[parquet]')
+
+
+def _write_parquet(predictions: pd.DataFrame, path: str):
+    # tuples of attributes / values are stored as Arrow lists of strings
+    predictions.assign(**{c: predictions[c].map(lambda t: [str(v) for v in t])
+                          for c in ['alteredAttributes', 'droppedValues', 'copiedValues']
+                          if c in predictions.columns}).to_parquet(path)
+
+
+def _done(future):
+    with _writes_lock:
+        _writes.discard(future)
+        if future.exception() is not None and len(_write_errors) == 0:
+            _write_errors.append(future.exception())
+    if future.exception() is not None:
+        logging.error(f'could not persist predictions: {future.exception()}')
+
+
+def persist(predictions: pd.DataFrame, path: str):
+    '''
+    Write (a copy of) the lattice predictions to a Parquet file in a background (non daemon) thread, pending writes
+    are completed before the interpreter exits.
+    :param predictions: the lattice predictions generated by perturb_predict
+    :param path: the destination file
+    :return: the future of the write, its result raises the write error (if any)
+    '''
+    _require_parquet()
+    future = _writer.submit(_write_parquet, predictions.copy(), path)
+    with _writes_lock:
+        _writes.add(future)
+    future.add_done_callback(_done)
+    return future
+
+
+def wait_persisted():
+    '''
+    Wait for all the pending writes of lattice predictions, raising the first write error (since the last call).
+    '''
+    with _writes_lock:
+        writes = list(_writes)
+    for future in writes:
+        future.exception()
+    with _writes_lock:
+        errors = list(_write_errors)
+        _write_errors.clear()
+    if len(errors) > 0:
+        raise errors[0]
 
 
 def cf_summary(explanation):
+    '''
+    The minimal sets of attributes (no subset of them has the same score) having the highest score.
+    '''
     sorted_attr_pairs = explanation.sort_values(ascending=False)
     explanations = sorted_attr_pairs.loc[sorted_attr_pairs.values == sorted_attr_pairs.values.max()]
-    filtered = [i for i in explanations.keys() if
-                not any(all(c in i for c in b) and len(b) < len(i) for b in explanations.keys())]
-    filtered_exp = {}
-    for te in filtered:
-        filtered_exp[te] = explanations[te]
-    series = pd.Series(index=filtered_exp.keys(), data=filtered_exp.values())
+    attribute_sets = [tuple(k.split('/')) for k in explanations.keys()]
+    index = {a: i for i, a in enumerate(dict.fromkeys(a for t in attribute_sets for a in t))}
+    masks = attribute_masks(attribute_sets, index)
+    # a set is not minimal when another (different) set of the same score is contained in it
+    contained = (masks[:, None] & masks[None, :]) == masks[None, :]
+    contained &= masks[:, None] != masks[None, :]
+    minimal = ~contained.any(axis=1)
+    series = pd.Series(index=explanations.index[minimal], data=explanations.values[minimal])
     return series
 
 
 def perturb_predict(allTriangles, attributes, check, class_to_explain, discard_bad, attr_length, predict_fn,
-                    sourcesMap, lprefix, rprefix, monotonicity=True):
+                    sourcesMap, lprefix, rprefix, monotonicity=True, stats: ExplanationStats = None):
+    if stats is None:
+        stats = ExplanationStats()
+    if check:
+        allTriangles = filter_triangles(allTriangles, sourcesMap, predict_fn, lprefix, rprefix,
+                                        discard_bad=discard_bad, stats=stats)
     if monotonicity:
         all_predictions = pd.DataFrame()
         rankings = []
-        transitivity = True
         flippedPredictions = []
         # lattice stratified predictions
         all_good = False
         for a in range(1, attr_length):
-            t_i = 0
+            with stats.stage('lattice_depth_%d' % a):
+                perturbations = []
+                for triangle in tqdm(allTriangles):
+                    try:
+                        currentPerturbations = createPerturbationsFromTriangle(triangle, sourcesMap, attributes, a,
+                                                                               class_to_explain, lprefix, rprefix)
+                        currentPerturbations['triangle'] = ' '.join(triangle)
+                        perturbations.append(currentPerturbations)
+                    except:
+                        pass
+
+                try:
+                    perturbations_df = pd.concat(perturbations, ignore_index=True)
+                except:
+                    perturbations_df = pd.DataFrame(perturbations)
+                if len(perturbations_df) == 0 or 'alteredAttributes' not in perturbations_df.columns:
+                    continue
+                currPerturbedAttr = perturbations_df.alteredAttributes.values
+                if a != attr_length and not all_good:
+                    predictions = predict_fn(perturbations_df.drop(['alteredAttributes', 'droppedValues', 'copiedValues', 'triangle'], axis=1))
+                    predictions = pd.concat([predictions, perturbations_df[['alteredAttributes', 'droppedValues', 'copiedValues', 'triangle']]], axis=1)
+                    all_predictions = pd.concat([all_predictions, predictions])
+                    proba = predictions[['nomatch_score', 'match_score']].values
+
+                    curr_flippedPredictions = predictions[proba[:, class_to_explain] < 0.5]
+                else:
+                    proba = pd.DataFrame(columns=['nomatch_score', 'match_score'])
+
+                    if class_to_explain == 0:
+                        proba.loc[:, 'nomatch_score'] = np.zeros([len(perturbations_df)])
+                        proba.loc[:, 'match_score'] = np.ones([len(perturbations_df)])
+                    else:
+                        proba.loc[:, 'match_score'] = np.zeros([len(perturbations_df)])
+                        proba.loc[:, 'nomatch_score'] = np.ones([len(perturbations_df)])
+
+                    curr_flippedPredictions = pd.concat([perturbations_df.copy(), proba], axis=1)
+                    proba = proba.values
+
+                flippedPredictions.append(curr_flippedPredictions)
+                ranking = getAttributeRanking(proba, currPerturbedAttr, class_to_explain)
+                rankings.append(ranking)
+
+                if len(curr_flippedPredictions) == len(perturbations_df):
+                    logging.info(f'skipped predictions at depth {a}')
+                    all_good = True
+                else:
+                    logging.debug(f'predicted depth {a}')
+        try:
+            flippedPredictions_df = pd.concat(flippedPredictions, ignore_index=True)
+        except:
+            flippedPredictions_df = pd.DataFrame(flippedPredictions)
+        return flippedPredictions_df, rankings, all_predictions
+    else:
+        with stats.stage('lattice'):
+            rankings = []
+            flippedPredictions = []
             perturbations = []
             for triangle in tqdm(allTriangles):
                 try:
-                    if check:
-                        identity, symmetry, transitivity = check_properties(triangle, sourcesMap, predict_fn)
-                        allTriangles[t_i] = allTriangles[t_i] + (identity, symmetry, transitivity,)
-                    if check and discard_bad and not transitivity:
-                        continue
-                    currentPerturbations = createPerturbationsFromTriangle(triangle, sourcesMap, attributes, a,
+                    currentPerturbations = createPerturbationsFromTriangle(triangle, sourcesMap, attributes,
+                                                                           attr_length,
                                                                            class_to_explain, lprefix, rprefix)
-                    currentPerturbations['triangle'] = ' '.join(triangle)
                     perturbations.append(currentPerturbations)
                 except:
-                    allTriangles[t_i] = allTriangles[t_i] + (False, False, False,)
                     pass
-                t_i += 1
-
             try:
                 perturbations_df = pd.concat(perturbations, ignore_index=True)
             except:
                 perturbations_df = pd.DataFrame(perturbations)
-            if len(perturbations_df) == 0 or 'alteredAttributes' not in perturbations_df.columns:
-                continue
             currPerturbedAttr = perturbations_df.alteredAttributes.values
-            if a != attr_length and not all_good:
-                predictions = predict_fn(perturbations_df.drop(['alteredAttributes', 'droppedValues', 'copiedValues', 'triangle'], axis=1))
-                predictions = pd.concat([predictions, perturbations_df[['alteredAttributes', 'droppedValues', 'copiedValues', 'triangle']]], axis=1)
-                all_predictions = pd.concat([all_predictions, predictions])
-                proba = predictions[['nomatch_score', 'match_score']].values
-
-                curr_flippedPredictions = predictions[proba[:, class_to_explain] < 0.5]
-            else:
-                proba = pd.DataFrame(columns=['nomatch_score', 'match_score'])
-
-                if class_to_explain == 0:
-                    proba.loc[:, 'nomatch_score'] = np.zeros([len(perturbations_df)])
-                    proba.loc[:, 'match_score'] = np.ones([len(perturbations_df)])
-                else:
-                    proba.loc[:, 'match_score'] = np.zeros([len(perturbations_df)])
-                    proba.loc[:, 'nomatch_score'] = np.ones([len(perturbations_df)])
-
-                curr_flippedPredictions = pd.concat([perturbations_df.copy(), proba], axis=1)
-                proba = proba.values
-
+            predictions = predict_fn(perturbations_df)
+            predictions = predictions.drop(columns=['alteredAttributes'])
+            proba = predictions[['nomatch_score', 'match_score']].values
+            curr_flippedPredictions = perturbations_df[proba[:, class_to_explain] < 0.5]
             flippedPredictions.append(curr_flippedPredictions)
             ranking = getAttributeRanking(proba, currPerturbedAttr, class_to_explain)
             rankings.append(ranking)
-
-            if len(curr_flippedPredictions) == len(perturbations_df):
-                logging.info(f'skipped predictions at depth {a}')
-                all_good = True
-            else:
-                logging.debug(f'predicted depth {a}')
-        try:
-            flippedPredictions_df = pd.concat(flippedPredictions, ignore_index=True)
-        except:
-            flippedPredictions_df = pd.DataFrame(flippedPredictions)
-        return flippedPredictions_df, rankings, all_predictions
-    else:
-        rankings = []
-        transitivity = True
-        flippedPredictions = []
-        t_i = 0
-        perturbations = []
-        for triangle in tqdm(allTriangles):
-            try:
-                if check:
-                    identity, symmetry, transitivity = check_properties(triangle, sourcesMap, predict_fn)
-                    allTriangles[t_i] = allTriangles[t_i] + (identity, symmetry, transitivity,)
-                if check and discard_bad and not transitivity:
-                    continue
-                currentPerturbations = createPerturbationsFromTriangle(triangle, sourcesMap, attributes,
-                                                                       attr_length,
-                                                                       class_to_explain, lprefix, rprefix)
-                perturbations.append(currentPerturbations)
-            except:
-                allTriangles[t_i] = allTriangles[t_i] + (False, False, False,)
-                pass
-            t_i += 1
-        try:
-            perturbations_df = pd.concat(perturbations, ignore_index=True)
-        except:
-            perturbations_df = pd.DataFrame(perturbations)
-        currPerturbedAttr = perturbations_df.alteredAttributes.values
-        predictions = predict_fn(perturbations_df)
-        predictions = predictions.drop(columns=['alteredAttributes'])
-        proba = predictions[['nomatch_score', 'match_score']].values
-        curr_flippedPredictions = perturbations_df[proba[:, class_to_explain] < 0.5]
-        flippedPredictions.append(curr_flippedPredictions)
-        ranking = getAttributeRanking(proba, currPerturbedAttr, class_to_explain)
-        rankings.append(ranking)
         try:
             flippedPredictions_df = pd.concat(flippedPredictions, ignore_index=True)
         except:
@@ -374,23 +567,28 @@ def perturb_predict(allTriangles, attributes, check, class_to_explain, discard_b
 
 # for each prediction, if the original class is flipped, set the rank of the altered attributes to 1
 def getAttributeRanking(proba: np.ndarray, alteredAttributes: list, originalClass: int):
-    attributeRanking = {k: 0 for k in alteredAttributes}
-    for i, prob in enumerate(proba):
-        if float(prob[originalClass]) < 0.5:
-            attributeRanking[alteredAttributes[i]] += 1
-    return attributeRanking
+    codes, uniques = pd.factorize(_object_array(alteredAttributes))
+    flipped = np.asarray(proba, dtype=float)[:, originalClass] < 0.5 if len(codes) > 0 else np.zeros(0, dtype=bool)
+    counts = np.bincount(codes, weights=flipped, minlength=len(uniques)).astype(int)
+    return dict(zip(uniques, counts.tolist()))
 
 
 # MaxLenAttributeSet is the max len of perturbed attributes we want to consider
 # for each ranking, sum  the rank of each altered attribute
 # then normalize the aggregated rank wrt the no. of triangles
 def aggregateRankings(ranking_l: list, lenTriangles: int, attr_length: int):
-    aggregateRanking = defaultdict(int)
-    for ranking in ranking_l:
-        for altered_attr in ranking.keys():
-            if len(altered_attr) <= attr_length:
-                aggregateRanking[altered_attr] += ranking[altered_attr]
-    aggregateRanking_normalized = {k: (v / lenTriangles) for (k, v) in aggregateRanking.items()}
-
-    alteredAttr = list(map(lambda t: "/".join(t), aggregateRanking_normalized.keys()))
-    return pd.Series(data=list(aggregateRanking_normalized.values()), index=alteredAttr)
+    altered = [k for ranking in ranking_l for k in ranking.keys()]
+    if len(altered) == 0:
+        return pd.Series(dtype=float)
+    counts = np.fromiter((v for ranking in ranking_l for v in ranking.values()), dtype=float, count=len(altered))
+    index = {a: i for i, a in enumerate(dict.fromkeys(a for t in set(altered) for a in t))}
+    masks = attribute_masks(altered, index)
+    keep = mask_bits(masks, len(index)).sum(axis=1) <= attr_length
+    # one subset id per distinct attribute set, in order of appearance
+    subsets, unique_masks = pd.factorize(masks[keep])
+    aggregated = np.bincount(subsets, weights=counts[keep], minlength=len(unique_masks)) / lenTriangles
+    first = np.full(len(unique_masks), len(subsets))
+    np.minimum.at(first, subsets, np.arange(len(subsets)))
+    kept = [altered[i] for i in np.nonzero(keep)[0]]
+    alteredAttr = ["/".join(kept[i]) for i in first]
+    return pd.Series(data=aggregated, index=alteredAttr)
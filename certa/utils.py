@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 
@@ -226,4 +227,84 @@ class LatticeElement():
         # or
         # a <= b if and only if b = a | b,
         a=self
-        return ( a == a & b ) or ( b == a | b )
\ No newline at end of file
+        return ( a == a & b ) or ( b == a | b )
+
+
+class bitset_lattice(object):
+
+    def __init__(self, Uelements, ranks, triangle=pd.DataFrame()):
+        '''Create a lattice of attribute sets encoded as bitmasks:
+
+        Keyword arguments:
+        Uelements -- list of sets. The lattice set.
+        ranks -- list. The lattice ranking.
+        triangle -- pd.DataFrame. The lattice predictions.
+
+        Returns a lattice instance exposing the same hasse() rendering as lattice, where order and covering
+        relations are computed with bitwise subset tests and popcounts instead of meet / join wrappers.
+        '''
+        self.Uelements = Uelements
+        self.ranks = ranks
+        self.triangle = triangle
+        self.attributes = sorted(set().union(*[set(e) for e in Uelements]))
+        if len(self.attributes) > 64:
+            raise ValueError(f'bitset lattices support up to 64 attributes, got {len(self.attributes)}')
+        positions = {a: i for i, a in enumerate(self.attributes)}
+        self.masks = np.array([sum(1 << positions[a] for a in e) for e in Uelements], dtype=np.uint64)
+
+    def decode(self, mask):
+        return set(a for i, a in enumerate(self.attributes) if int(mask) >> i & 1)
+
+    def popcount(self):
+        bits = (self.masks[:, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+        return bits.sum(axis=1).astype(int)
+
+    def covers(self):
+        '''Return the covering relation as a boolean matrix, covers[s, d] is True iff d covers s.'''
+        masks = self.masks
+        subset = (masks[:, None] & ~masks[None, :]) == 0
+        strict = subset & (masks[:, None] != masks[None, :])
+        sizes = self.popcount()
+        gap = sizes[None, :] - sizes[:, None]
+        covering = strict & (gap == 1)
+        # pairs more than one attribute apart are covers only if no element lies in between
+        wide = strict & (gap > 1)
+        rows = np.flatnonzero(wide.any(axis=1))
+        if len(rows) > 0:
+            strict_f = strict.astype(np.float32)
+            between = (strict_f[rows] @ strict_f) > 0
+            covering[rows] |= wide[rows] & ~between
+        return covering
+
+    def _label(self, mask, compress):
+        matches = np.flatnonzero(self.masks == mask)
+        ebi = str(self.Uelements[matches[0]]) if len(matches) > 0 else str(self.decode(mask))
+        if compress:
+            ebi = compress_text(ebi)
+        return ebi
+
+    def hasse(self, depth=-1, compress=False):
+        covering = self.covers()
+        labels = [compress_text(str(e)) if compress else str(e) for e in self.Uelements]
+        top = np.bitwise_or.reduce(self.masks)
+        bottom = np.bitwise_and.reduce(self.masks)
+        lines = ['digraph G {\nsplines="line"\nrankdir=BT\n',
+                 '\"' + self._label(top, compress) + '\" [shape=box];\n',
+                 '\"' + self._label(bottom, compress) + '\" [shape=box];\n']
+        for s, ebi in enumerate(labels):
+            color = ''
+            if self.ranks[s] > 0.5:
+                color = 'green'
+            if self.ranks[s] < 0.5:
+                color = 'red'
+            lines.append("\"" + ebi + "\" [color=" + color + "];\n")
+            for d in np.flatnonzero(covering[s]):
+                lines.append("\"" + ebi + "\" -> \"" + labels[d] + "\";\n")
+            if depth > 0 and s + 1 == depth:
+                break
+        lines.append("}")
+        return ''.join(lines)
+
+    def __repr__(self):
+        """Represents the lattice as an instance of Lattice."""
+        return 'BitsetLattice(%s)' % self.Uelements
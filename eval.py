@@ -102,7 +102,7 @@ def eval_cf(compare, dataset, exp_dir, lsource, model, model_name, mtype, predic
 
             certas = certas.append(certa_row, ignore_index=True)
 
-            counterfactual_examples.to_csv(dest_file)
+            counterfactual_examples.to_frame().to_csv(dest_file)
 
             if compare:
                 instance = pd.DataFrame(rand_row).transpose().astype(str)
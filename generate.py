@@ -12,6 +12,7 @@ from baselines.landmark import Landmark
 from baselines.lime_c import LimeCounterfactual
 from baselines.mojito import Mojito
 from baselines.shap_c import ShapCounterfactual
+from certa.cache import ExplanationCache, model_fingerprint
 from certa.explain import CertaExplainer
 from certa.local_explain import get_original_prediction, get_row
 from certa.utils import merge_sources
@@ -56,7 +57,12 @@ def generate_all(compare, dataset, exp_dir, lsource, model, model_name, predict_
     train_noids = train_df.copy().astype(str)
     if 'ltable_id' in train_noids.columns and 'rtable_id' in train_noids.columns:
         train_noids = train_df.drop(['ltable_id', 'rtable_id'], axis=1)
-    certa_explainer = CertaExplainer(lsource, rsource, data_augmentation=da)
+    # explanations persist across runs, keyed by the model fingerprint (retrained models do not reuse them)
+    cache_dir = exp_dir + dataset + '/' + model_name
+    os.makedirs(cache_dir, exist_ok=True)
+    certa_explainer = CertaExplainer(lsource, rsource, data_augmentation=da,
+                                     cache=ExplanationCache(cache_dir + '/explanations.db'))
+    fingerprint = model_fingerprint(model)
     if compare:
         mojito = Mojito(test_df.columns,
                         attr_to_copy='left',
@@ -99,26 +105,19 @@ def generate_all(compare, dataset, exp_dir, lsource, model, model_name, predict_
                 print('certa')
                 t0 = time.perf_counter()
                 certa_saliency = None
-                num_triangles = 10
-                while certa_saliency is None:
-                    try:
-                        saliency_df, cf_summary, cf_ex, triangles, lattices = certa_explainer.explain(l_tuple, r_tuple, predict_fn,
-                                                                                              debug=True, num_triangles=num_triangles)
-
-
-                        latency_c = time.perf_counter() - t0
-
-                        certa_saliency = saliency_df.transpose().to_dict()[0]
-                    except:
-                        pass
-                    num_triangles += 50
-                    if num_triangles > 200:
-                        break
+                # up to 200 triangles, processed until the explanation is stable
+                saliency_df, cf_summary, cf_ex, triangles, lattices = certa_explainer.explain(l_tuple, r_tuple, predict_fn,
+                                                                                      debug=True, num_triangles=200,
+                                                                                      adaptive=True,
+                                                                                      model_fingerprint=fingerprint)
+                latency_c = time.perf_counter() - t0
+                if len(saliency_df) > 0:
+                    certa_saliency = saliency_df.transpose().to_dict()[0]
                 certa_row = {'explanation': certa_saliency, 'summary' : cf_summary.to_dict(), 'type': 'certa', 'latency': latency_c,
                              'match': class_to_explain,
                              'label': label, 'row': row_id, 'prediction': prediction}
 
-                cf_ex.to_csv(dest_file)
+                cf_ex.to_frame().to_csv(dest_file)
                 lidx = 0
                 for lattice in lattices:
                     lattice.triangle.to_csv(cf_dir + '/triangle_' + str(lidx) + '.csv')